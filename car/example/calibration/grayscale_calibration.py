@@ -1,4 +1,5 @@
 from picarx import Picarx
+from picarx.grayscale_sampler import GrayscaleSampler
 import time
 import threading
 import readchar
@@ -6,6 +7,8 @@ import os
 
 px = Picarx()
 config_path = px.CONFIG
+# the sampler is the only reader of the grayscale ADCs, the loops below share its samples
+sampler = GrayscaleSampler(px.get_grayscale_data, rate=50, name="Calibration grayscale sampler")
 
 manual = f'''\
         ┌────────────────────────────────────┐
@@ -71,9 +74,16 @@ time.sleep(0.5)
 def read_data_loop():
     global current_grayscale_value, thresholds, run_flag, cali_status
 
+    last_sequence = None
     while run_flag:
         try:
-            current_grayscale_value = px.get_grayscale_data()
+            # only look at each sample once, but look at all of them, so no extreme is missed
+            sequence, _, values = sampler.latest()
+            if sequence == last_sequence:
+                time.sleep(0.01)
+                continue
+            last_sequence = sequence
+            current_grayscale_value = list(values)
 
             # calculate the reference
             if cali_status == 'work':
@@ -93,7 +103,6 @@ def read_data_loop():
         except Exception as e:
             run_flag = False
             print(f'\033[31mread_data_loop error: {e}\033[m')
-        time.sleep(0.2)
 
 # read key thread
 # ==========================================
@@ -222,7 +231,8 @@ def start_cliff_calibrate():
 
 def main():
     global key, current_mode, run_flag
-    # start read data thread
+    # start sampling and the read data thread
+    sampler.start()
     run_flag = True
     _read_data_thead = threading.Thread(target=read_data_loop)
     _read_data_thead.daemon = True
@@ -280,5 +290,6 @@ if __name__ == "__main__":
         # enable cursor
         enable_cursor()
         # stop
+        sampler.stop()
         px.stop()
         time.sleep(0.1)
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+"""
+Batched reads of several ADC channels of the Robot HAT.
+
+ADC.read() writes the channel command to the HAT and reads the two bytes of the result back one
+at a time, which takes three I2C transactions per channel, so nine for a grayscale sample.
+ADCGroup reads a set of channels together, in one of these modes:
+
+    shared  The ADC.read() protocol, with all channels on the bus handle of the first ADC
+            rather than each ADC opening its own. This saves the extra bus handles and the
+            per-ADC overhead, but still costs three transactions per channel, nine per
+            grayscale sample, since recv(2) is two read_byte calls
+    block   Register reads (a register write and a multi-byte read in one transaction) on one
+            bus handle. Channels with consecutive registers, such as A0 to A2, are read in a
+            single transaction, others in one transaction each
+    legacy  ADC.read() on each channel, for ADC objects that do not offer the I2C calls
+
+Shared mode is the default, since it uses the protocol the HAT firmware documents. Block mode
+relies on the firmware answering a register read at the channel registers (0x15 to 0x17 for A0
+to A2) with the channels in order, which is not documented, so it is opt-in. When block mode is
+asked for, the group first reads every channel both ways over several samples, and falls back to
+shared mode unless every block read is within a few counts of the matching shared read. This
+check cannot tell channels apart if they all read the same, for instance over a uniform floor,
+so block mode should be checked once against ADC.read() on the actual hardware, over a surface
+that gives each sensor a different reading, before it is relied on.
+
+The ADC objects are only used through their channel byte (chn), address (ADDR) and I2C methods
+(send, recv, mem_read), so the group works with both robot_hat and sim_robot_hat.
+"""
+
+import logging
+import time
+
+import numpy as np
+
+
+class ADCGroup(object):
+    """Class to read several ADC channels of the Robot HAT together
+
+    Args:
+        adcs: ADC objects to read, in the order the values are returned
+        mode: "shared", "block" or "legacy" (see the module docstring)
+        verify: Check block reads against the ADC.read() protocol, and fall back to shared mode if they differ
+        verify_samples: Number of samples to check block reads over
+        tolerance: Largest difference in counts between the two reads of a channel for block mode to be kept
+    """
+
+    MODES = ("shared", "block", "legacy")
+
+    def __init__(self, adcs, mode:str="shared", verify:bool=True, verify_samples:int=5, tolerance:int=16):
+
+        if mode not in self.MODES:
+            raise ValueError("ADC group mode should be one of {0}, not {1}".format(self.MODES, mode))
+
+        self.adcs = list(adcs)
+
+        # ADC objects without the I2C calls can only be read one by one
+        if not all(hasattr(adc, attr) for adc in self.adcs for attr in ("chn", "ADDR", "send", "recv", "mem_read")):
+            mode = "legacy"
+        self.mode = mode
+
+        if self.mode != "legacy":
+            # Every channel goes through the bus handle of the first ADC
+            self.handle = self.adcs[0]
+            self.addr = self.handle.ADDR
+            self.channels = [adc.chn for adc in self.adcs]
+            self.blocks = self.plan_blocks(self.channels)
+
+        if self.mode == "block" and verify:
+            self.verify(verify_samples, tolerance)
+
+    @staticmethod
+    def plan_blocks(channels):
+        """Split the channel registers into runs of consecutive registers, each read as one block
+
+        Returns a list of (first register, number of registers, [(position in the result, offset in the block)])
+        """
+
+        order = sorted(range(len(channels)), key=lambda idx: channels[idx])
+        blocks = []
+        for idx in order:
+            if blocks and channels[idx] == blocks[-1][0] + blocks[-1][1]:
+                first, count, positions = blocks[-1]
+                positions.append((idx, count))
+                blocks[-1] = (first, count + 1, positions)
+            elif blocks and channels[idx] < blocks[-1][0] + blocks[-1][1]:
+                # The same channel twice, read from the block it is already in
+                first, count, positions = blocks[-1]
+                positions.append((idx, channels[idx] - first))
+            else:
+                blocks.append((channels[idx], 1, [(idx, 0)]))
+
+        return blocks
+
+    def verify(self, samples, tolerance):
+        """Compare block reads with shared reads over several samples, and fall back to shared mode if any differ"""
+
+        for _ in range(samples):
+            block_values = self.read_block()
+            shared_values = self.read_shared()
+
+            if block_values is None or any(abs(b - s) > tolerance for b, s in zip(block_values, shared_values)):
+                logging.warning("ADCGroup: register reads do not match ADC.read(), using shared mode")
+                self.mode = "shared"
+                return
+
+    def read_block(self):
+        """Read the channels with register reads, or return None if the bus does not answer"""
+
+        values = [0] * len(self.adcs)
+        for first, count, positions in self.blocks:
+            data = self.handle.mem_read(2 * count, self.addr, first)
+            if not data or len(data) != 2 * count:
+                return None
+            for idx, offset in positions:
+                values[idx] = (data[2 * offset] << 8) + data[2 * offset + 1]
+
+        return values
+
+    def read_shared(self):
+        """Read the channels with the ADC.read() protocol, on one bus handle"""
+
+        values = []
+        for chn in self.channels:
+            self.handle.send([chn, 0, 0], self.addr)
+            value_h, value_l = self.handle.recv(2, self.addr)
+            values.append((value_h << 8) + value_l)
+
+        return values
+
+    def read(self):
+        """Function to get the values of all channels, as a list in the order of the ADCs"""
+
+        if self.mode == "block":
+            values = self.read_block()
+            if values is not None:
+                return values
+            # A failed block read is retried the slow way rather than dropping the sample
+            return self.read_shared()
+
+        if self.mode == "shared":
+            return self.read_shared()
+
+        return [adc.read() for adc in self.adcs]
+
+    def read_into(self, out:np.ndarray):
+        """Function to get the values of all channels into a preallocated array, one element at a time"""
+
+        if self.mode == "block":
+            for first, count, positions in self.blocks:
+                data = self.handle.mem_read(2 * count, self.addr, first)
+                if not data or len(data) != 2 * count:
+                    # As in read, a failed block read is retried the slow way
+                    for idx, value in enumerate(self.read_shared()):
+                        out[idx] = value
+                    return out
+                for idx, offset in positions:
+                    out[idx] = (data[2 * offset] << 8) + data[2 * offset + 1]
+            return out
+
+        for idx, value in enumerate(self.read()):
+            out[idx] = value
+
+        return out
+
+
+def count_transactions(adcs):
+    """Total I2C transactions on the simulated buses of a set of ADCs (each ADC has its own)"""
+
+    return sum(bus.transactions for bus in {id(adc._smbus): adc._smbus for adc in adcs}.values())
+
+
+if __name__ == "__main__":
+
+    # Samples per second and I2C transactions per sample for a grayscale triplet, reading the three
+    # ADCs one by one, and with an ADCGroup in shared and block mode. Only meaningful
+    # against the simulated bus, which counts its transactions
+    from sim_robot_hat import ADC
+
+    logging.getLogger().setLevel(logging.WARNING)
+    duration = 1.0
+
+    def bench(read, adcs):
+        for adc in adcs:
+            adc._smbus.transactions = 0
+        samples = 0
+        t_end = time.perf_counter() + duration
+        while time.perf_counter() < t_end:
+            read()
+            samples += 1
+        return samples / duration, count_transactions(adcs) / samples
+
+    print("{0:<24}{1:>16}{2:>22}".format("read", "samples/sec", "transactions/sample"))
+
+    adcs = [ADC(pin) for pin in ("A0", "A1", "A2")]
+    rate, transactions = bench(lambda: [adc.read() for adc in adcs], adcs)
+    print("{0:<24}{1:>16.0f}{2:>22.1f}".format("ADC.read() x 3", rate, transactions))
+
+    for mode in ("shared", "block"):
+        adcs = [ADC(pin) for pin in ("A0", "A1", "A2")]
+        group = ADCGroup(adcs, mode=mode)
+        rate, transactions = bench(group.read, adcs)
+        print("{0:<24}{1:>16.0f}{2:>22.1f}".format("ADCGroup " + group.mode, rate, transactions))
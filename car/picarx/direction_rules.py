@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+"""
+The rules of Interpret.get_direction, applied to a whole batch of grayscale samples at once.
+
+They are kept apart from sense_interp, which pulls in RossROS and the Robot HAT drivers, so that
+tools working offline on recorded samples, such as grayscale_tuner.py, only need numpy.
+"""
+
+import numpy as np
+
+
+def directions_from_data(data, l_th, h_th, polarity, prev_direction:float=0.0):
+    """Function to get the turn directions for a batch of sensor data, with the rules of Interpret.get_direction
+
+    Args:
+        data: (N, 3) array of sensor data, one sample per row, oldest first
+        l_th, h_th, polarity: Thresholds and polarity, as numbers or as arrays that broadcast against the N
+            samples, e.g. of shape (K, 1) to evaluate K settings at once
+        prev_direction: Direction before the first sample
+
+    Returns an array of directions, of shape (N,) or the broadcast shape, such as (K, N). Samples that match
+    no rule keep the direction of the last one that did, as get_direction does
+    """
+
+    data = np.asarray(data, dtype=np.float64)
+
+    # Edge values of extreme sensors wrt to center sensor
+    edge = np.stack((data[:, 1] - data[:, 0], data[:, 1] - data[:, 2]))
+    edge_val = np.abs(edge)
+    edge_sign = np.sign(edge)
+    l_th, h_th, polarity = np.asarray(l_th), np.asarray(h_th), np.asarray(polarity)
+
+    # The rules in the order get_direction checks them, the first that matches wins
+    conditions = [(edge_val[0] >= h_th) & (edge_val[1] >= h_th) & (edge_sign[0] == edge_sign[1]) & (edge_sign[1] == polarity),
+                  (edge_val[0] <= l_th) & (edge_val[1] >= l_th) & (edge_sign[1] == polarity),
+                  (edge_val[0] >= h_th) & (edge_val[1] <= l_th) & (edge_sign[0] == -polarity),
+                  (edge_val[0] >= l_th) & (edge_val[1] <= l_th) & (edge_sign[0] == polarity),
+                  (edge_val[0] <= l_th) & (edge_val[1] >= h_th) & (edge_sign[1] == -polarity)]
+    conditions = np.broadcast_arrays(*conditions)
+    directions = np.select(conditions, [0.0, -0.5, -1.0, 0.5, 1.0], default=np.nan)
+
+    # Carry the last known direction forward over the samples that matched no rule
+    known = ~np.isnan(directions)
+    last_known = np.maximum.accumulate(np.where(known, np.arange(directions.shape[-1]), -1), axis=-1)
+    filled = np.take_along_axis(directions, np.maximum(last_known, 0), axis=-1)
+
+    return np.where(last_known >= 0, filled, prev_direction)
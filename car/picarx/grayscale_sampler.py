@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+"""
+Background sampling of the grayscale module.
+
+Each consumer of the grayscale values (Interpret.get_direction, the calibration script,
+Picarx.get_line_status) used to read the ADCs itself, so two consumers doubled the I2C traffic
+and still saw different samples. A GrayscaleSampler owns the ADCs instead: a daemon thread reads
+them at a fixed rate, against fixed deadlines so that the period does not drift, and publishes
+each sample into a slot that any number of readers can take without touching I2C.
+
+The slot is a single (sequence, timestamp, values) tuple that only the sampling thread replaces,
+with one attribute assignment, which is atomic in CPython, so readers take no lock and always
+see a complete sample. The timestamp is the time.monotonic() time halfway through the read, and
+the sequence number tells readers whether a sample is new to them. The sampler can also publish
+each sample into a RossROS bus (such as a LockFreeBus, or a HistoryBus to keep a window of them),
+so that it can feed a graph in place of a Producer.
+
+A thread is enough here: the I2C calls release the GIL while they wait on the bus, so sampling
+does not hold up the other services. The module has no dependencies beyond the standard library,
+so it can also be used with the installed picarx package.
+"""
+
+import logging
+import threading
+import time
+
+
+class GrayscaleSampler(object):
+    """Class to sample the grayscale module in the background and keep the latest sample
+
+    Args:
+        read_function: Function that reads the three grayscale values, such as ADCGroup.read or Picarx.get_grayscale_data
+        rate: Samples per second
+        bus: Optional bus (anything with set_message) to also publish each sample's values into
+        name: Name used in the log and as the writer name on the bus
+    """
+
+    def __init__(self, read_function, rate:float=100.0, bus=None, name:str="Grayscale sampler"):
+
+        if rate <= 0:
+            raise ValueError("Sampling rate should be positive, not {0}".format(rate))
+
+        self.read_function = read_function
+        self.period = 1.0 / rate
+        self.bus = bus
+        self.name = name
+
+        # (sequence, timestamp, values) of the latest sample, None until the first one
+        self.slot = None
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.samples = 0
+        self.errors = 0
+        self.last_error = None  # exception of the latest failed read
+        self.overruns = 0  # sampling deadlines missed because a read took too long
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def sample(self):
+        """Read the ADCs once and publish the values, keeping the previous sample if the read fails"""
+
+        t_start = time.monotonic()
+        try:
+            values = tuple(self.read_function())
+        except Exception as error:
+            # A glitch on the I2C bus, or any other failed read, should not stop the sampling.
+            # Readers can tell from age() or last_error that the slot is going stale
+            self.errors += 1
+            self.last_error = error
+            level = logging.WARNING if self.errors == 1 else logging.DEBUG
+            logging.log(level, "{0}: read failed ({1} so far): {2!r}".format(self.name, self.errors, error))
+            return
+        t_end = time.monotonic()
+
+        sequence = self.slot[0] + 1 if self.slot is not None else 1
+        self.slot = (sequence, (t_start + t_end) / 2, values)
+        self.samples += 1
+
+        if self.bus is not None:
+            self.bus.set_message(list(values), self.name)
+
+    def run(self):
+
+        t_next = time.monotonic()
+        while not self.stop_event.is_set():
+            self.sample()
+
+            t_next += self.period
+            now = time.monotonic()
+            if now > t_next:
+                # Skip the deadlines that have already passed rather than sampling in a burst to catch up
+                missed = int((now - t_next) / self.period) + 1
+                self.overruns += missed
+                t_next += missed * self.period
+
+            self.stop_event.wait(t_next - now)
+
+    def start(self):
+        """Take a first sample, so that the slot is filled as soon as this returns, and start sampling"""
+
+        if self.running:
+            return self
+
+        self.sample()
+        if self.slot is None:
+            raise RuntimeError("{0}: could not read the grayscale module".format(self.name))
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        """Stop sampling, and wait for the sampling thread to finish"""
+
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def latest(self):
+        """Function to get the latest sample as a (sequence, timestamp, values) tuple, without touching I2C"""
+
+        slot = self.slot
+        if slot is None:
+            raise RuntimeError("{0}: no sample yet, start the sampler first".format(self.name))
+
+        return slot
+
+    def read(self):
+        """Function to get the values of the latest sample, as a list like ADCGroup.read"""
+
+        return list(self.latest()[2])
+
+    def age(self):
+        """Seconds since the latest sample was taken"""
+
+        return time.monotonic() - self.latest()[1]
+
+
+if __name__ == "__main__":
+
+    # I2C transactions per second with three consumers reading the grayscale module at different
+    # rates, each doing its own reads, and all of them taking the samples of one sampler at 100 Hz.
+    # Only meaningful against the simulated bus, which counts its transactions
+    from sim_robot_hat import ADC
+    from adc_batch import ADCGroup, count_transactions
+
+    logging.getLogger().setLevel(logging.WARNING)
+    duration = 2.0
+    reader_rates = (200, 100, 50)
+
+    def consume(read, rate, stop_event):
+        while not stop_event.wait(1.0 / rate):
+            read()
+
+    def bench(read, adcs):
+        for adc in adcs:
+            adc._smbus.transactions = 0
+        stop_event = threading.Event()
+        threads = [threading.Thread(target=consume, args=(read, rate, stop_event)) for rate in reader_rates]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        return count_transactions(adcs) / duration
+
+    print("{0:<36}{1:>24}".format("consumers at {0} Hz".format(", ".join(str(r) for r in reader_rates)),
+                                  "transactions/sec"))
+
+    adcs = [ADC(pin) for pin in ("A0", "A1", "A2")]
+    group = ADCGroup(adcs, mode="shared")
+    print("{0:<36}{1:>24.0f}".format("each reading the ADCs", bench(group.read, adcs)))
+
+    adcs = [ADC(pin) for pin in ("A0", "A1", "A2")]
+    group = ADCGroup(adcs, mode="shared")
+    with GrayscaleSampler(group.read, rate=100) as sampler:
+        transactions = bench(sampler.read, adcs)
+    print("{0:<36}{1:>24.0f}".format("sharing a 100 Hz sampler", transactions))
+    print("Sampler: {0} samples, {1} errors, {2} overruns".format(sampler.samples, sampler.errors, sampler.overruns))
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+"""
+This file tunes the thresholds and polarity of the grayscale interpreter offline.
+
+Instead of driving the car once per setting, record grayscale traces with the line position
+labeled, and let the tuner try a grid of l_th, h_th and polarity settings on all of them. Each
+setting is scored by the share of samples where Interpret.get_direction would have given the
+labeled direction. The grid is evaluated with directions_from_data from direction_rules, which
+applies the rules of get_direction to every sample and a whole block of settings in one
+vectorized call, so a grid of a thousand settings over a hundred thousand samples takes seconds.
+Blocks of settings can also be spread over a process pool with --workers.
+
+The best settings are reported with their accuracy, followed by the confusion matrix of the best
+one (labeled direction against the direction it gives).
+
+Traces can be given as
+    .npz files    with a "data" array of shape (N, 3) and a "labels" array of shape (N,)
+    .csv files    with three grayscale columns and a label column, and an optional header line
+    bus logs      recorded by rossros_record.BusRecorder, with --data-bus naming the bus of the
+                  grayscale samples and --label-bus the bus of the labels. Each sample is labeled
+                  with the last label written before it, and samples before the first label are
+                  left out
+Labels are directions as get_direction gives them: -1, -0.5, 0, 0.5 or 1. Each trace is
+interpreted on its own, starting from a previous direction of 0. Traces of raw ADC values can be
+normalized as Sensing does with --normalize mean or normal; recorded sensor buses hold values
+that are already normalized. --simulate generates a labeled trace to try the tuner on.
+
+Usage:
+    python3 grayscale_tuner.py TRACE [TRACE ...] [--data-bus NAME --label-bus NAME]
+                               [--normalize none|mean|normal] [--l-range START STOP COUNT]
+                               [--h-range START STOP COUNT] [--polarities P ...] [--workers N]
+                               [--top N]
+    python3 grayscale_tuner.py --simulate N [options]
+"""
+
+import argparse
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+
+from direction_rules import directions_from_data
+
+
+DIRECTIONS = np.array([-1.0, -0.5, 0.0, 0.5, 1.0])
+
+# Largest number of setting and sample pairs evaluated in one vectorized call, which keeps the
+# temporary arrays of directions_from_data to some tens of megabytes
+BLOCK_ELEMENTS = 2000000
+
+
+def load_trace(path, data_bus=None, label_bus=None):
+    """Read the (data, labels) arrays of a trace from an .npz, .csv or bus log file"""
+
+    if path.endswith(".npz"):
+        with np.load(path) as trace:
+            data, labels = trace["data"], trace["labels"]
+
+    elif path.endswith(".csv"):
+        with open(path) as f:
+            first_line = f.readline()
+        header = any(character.isalpha() for character in first_line)
+        table = np.loadtxt(path, delimiter=",", skiprows=1 if header else 0, ndmin=2)
+        data, labels = table[:, :3], table[:, 3]
+
+    else:
+        if data_bus is None or label_bus is None:
+            raise ValueError("Reading the bus log {0} needs --data-bus and --label-bus".format(path))
+
+        # Imported here, so that npz and csv traces only need numpy, not rossros
+        from rossros_record import readBusLog
+
+        data, labels = [], []
+        label = None
+        for _, name, message in readBusLog(path):
+            if name == label_bus:
+                label = message
+            elif name == data_bus and label is not None:
+                data.append(message)
+                labels.append(label)
+
+    data = np.asarray(data, dtype=np.float64).reshape(-1, 3)
+    labels = np.asarray(labels, dtype=np.float64).reshape(-1)
+
+    if len(data) != len(labels):
+        raise ValueError("{0} has {1} samples but {2} labels".format(path, len(data), len(labels)))
+    unknown = np.setdiff1d(labels, DIRECTIONS)
+    if len(unknown):
+        raise ValueError("{0} has labels that are not directions: {1}".format(path, unknown))
+
+    return data, labels
+
+
+def normalize(data, mode):
+    """Normalize raw grayscale samples as Sensing.get_grayscale_data does"""
+
+    if mode == "mean":
+        return data / (data.mean(axis=1, keepdims=True) + 1e-9)
+    if mode == "normal":
+        return (data - data.mean(axis=1, keepdims=True)) / (data.std(axis=1, keepdims=True) + 1e-9)
+    return data
+
+
+def simulate_trace(n_samples, polarity=-1, seed=0):
+    """
+    Generate a labeled trace of raw grayscale samples: the line position jumps between the five
+    directions, each of which has a typical reading, and the readings are noisy and vary in
+    brightness, as they do over a real floor
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # Typical readings for a dark line on a light floor, with the line under the center sensor,
+    # between the left and center sensors, under the left sensor only, and so on
+    dark, light = 300.0, 1400.0
+    readings = {0.0: (light, dark, light),
+                -0.5: (dark + 150, dark, light),
+                -1.0: (dark, light, light),
+                0.5: (light, dark, dark + 150),
+                1.0: (light, light, dark)}
+
+    # The line position stays put for twenty samples or so at a time
+    changes = np.flatnonzero(rng.random(n_samples) < 0.05)
+    segment_positions = rng.integers(0, len(DIRECTIONS), len(changes) + 1)
+    positions = segment_positions[np.searchsorted(changes, np.arange(n_samples), side="right")]
+    labels = DIRECTIONS[positions]
+
+    data = np.array([readings[label] for label in DIRECTIONS])[positions]
+    if polarity == 1:
+        data = dark + light - data
+    data = data * rng.uniform(0.7, 1.3, (n_samples, 1)) + rng.normal(0, 150, (n_samples, 3))
+
+    return data, labels
+
+
+def build_grid(l_range, h_range, polarities):
+    """All (l_th, h_th, polarity) settings of the grid with l_th below h_th, as an (M, 3) array"""
+
+    l_values = np.linspace(*l_range[:2], int(l_range[2]))
+    h_values = np.linspace(*h_range[:2], int(h_range[2]))
+    grid = np.array(np.meshgrid(l_values, h_values, polarities, indexing="ij")).reshape(3, -1).T
+
+    return grid[grid[:, 0] < grid[:, 1]]
+
+
+# Traces of the worker processes, set once by init_worker so that they are not sent with every block
+worker_traces = None
+
+
+def init_worker(traces):
+
+    global worker_traces
+    worker_traces = traces
+
+
+def evaluate_block(settings, traces=None):
+    """Number of correctly interpreted samples for each of a block of settings, summed over the traces"""
+
+    if traces is None:
+        traces = worker_traces
+
+    l_th, h_th, polarity = (settings[:, idx:idx + 1] for idx in range(3))
+    correct = np.zeros(len(settings), dtype=np.int64)
+    for data, labels in traces:
+        directions = directions_from_data(data, l_th, h_th, polarity)
+        correct += np.count_nonzero(directions == labels, axis=1)
+
+    return correct
+
+
+def evaluate_grid(grid, traces, workers=1):
+    """Accuracy of every setting of the grid over all of the traces"""
+
+    n_samples = sum(len(labels) for _, labels in traces)
+    block_size = max(1, BLOCK_ELEMENTS // max(1, max(len(labels) for _, labels in traces)))
+    blocks = [grid[start:start + block_size] for start in range(0, len(grid), block_size)]
+
+    if workers > 1 and len(blocks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                    initargs=(traces,)) as executor:
+            correct = list(executor.map(evaluate_block, blocks))
+    else:
+        correct = [evaluate_block(block, traces) for block in blocks]
+
+    return np.concatenate(correct) / n_samples
+
+
+def confusion_matrix(setting, traces):
+    """Counts of each labeled direction (rows) against each interpreted direction (columns)"""
+
+    matrix = np.zeros((len(DIRECTIONS), len(DIRECTIONS)), dtype=np.int64)
+    for data, labels in traces:
+        directions = directions_from_data(data, *setting)
+        np.add.at(matrix, (np.searchsorted(DIRECTIONS, labels), np.searchsorted(DIRECTIONS, directions)), 1)
+
+    return matrix
+
+
+def main(args):
+
+    if args.simulate:
+        traces = [simulate_trace(args.simulate, polarity=-1)]
+        source = "simulated trace"
+    else:
+        traces = [load_trace(path, args.data_bus, args.label_bus) for path in args.traces]
+        source = ", ".join(args.traces)
+    traces = [(normalize(data, args.normalize), labels) for data, labels in traces if len(labels)]
+    if not traces:
+        raise ValueError("The traces have no labeled samples")
+
+    grid = build_grid(args.l_range, args.h_range, args.polarities)
+    n_samples = sum(len(labels) for _, labels in traces)
+
+    t_start = time.perf_counter()
+    accuracy = evaluate_grid(grid, traces, args.workers)
+    elapsed = time.perf_counter() - t_start
+
+    print("{0}: {1} samples, {2} settings, evaluated in {3:.2f} s with {4} worker(s)".format(
+        source, n_samples, len(grid), elapsed, args.workers))
+
+    print()
+    print("{0:>8}{1:>8}{2:>10}{3:>10}".format("l_th", "h_th", "polarity", "accuracy"))
+    for idx in np.argsort(-accuracy, kind="stable")[:args.top]:
+        l_th, h_th, polarity = grid[idx]
+        print("{0:>8.3f}{1:>8.3f}{2:>10.0f}{3:>9.1f}%".format(l_th, h_th, polarity, accuracy[idx] * 100))
+
+    best = grid[np.argmax(accuracy)]
+    matrix = confusion_matrix(best, traces)
+
+    print()
+    print("Confusion matrix of l_th={0:.3f}, h_th={1:.3f}, polarity={2:.0f} (rows labeled, columns interpreted)".format(
+        *best))
+    print("{0:>10}".format("") + "".join("{0:>10}".format(direction) for direction in DIRECTIONS))
+    for direction, row in zip(DIRECTIONS, matrix):
+        print("{0:>10}".format(direction) + "".join("{0:>10}".format(count) for count in row))
+
+    print()
+    print("Interpret(l_th={0:.3f}, h_th={1:.3f}, polarity={2:.0f})".format(*best))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Tune the grayscale interpreter thresholds on recorded traces")
+    parser.add_argument("traces", nargs="*", help=".npz, .csv or bus log files of labeled grayscale samples")
+    parser.add_argument("--data-bus", help="bus of the grayscale samples in bus logs")
+    parser.add_argument("--label-bus", help="bus of the labeled directions in bus logs")
+    parser.add_argument("--normalize", choices=("none", "mean", "normal"), default="none",
+                        help="normalize raw samples as Sensing does")
+    parser.add_argument("--l-range", type=float, nargs=3, default=(0.05, 1.0, 20), metavar=("START", "STOP", "COUNT"),
+                        help="values of l_th to try")
+    parser.add_argument("--h-range", type=float, nargs=3, default=(0.2, 2.0, 19), metavar=("START", "STOP", "COUNT"),
+                        help="values of h_th to try")
+    parser.add_argument("--polarities", type=float, nargs="+", default=(-1, 1), help="polarities to try")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes to spread the grid over (0 for one per CPU)")
+    parser.add_argument("--top", type=int, default=5, help="number of best settings to list")
+    parser.add_argument("--simulate", type=int, metavar="N", help="tune on a simulated trace of N samples instead")
+    args = parser.parse_args()
+
+    if not args.traces and not args.simulate:
+        parser.error("give traces to tune on, or --simulate N")
+    if args.workers == 0:
+        args.workers = os.cpu_count() or 1
+    if args.simulate and args.normalize == "none":
+        # The simulated trace is raw ADC values
+        args.normalize = "mean"
+
+    main(args)
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""
+This file benchmarks the grayscale interpretation in sense_interp.
+
+For one sample at a time, it times the numpy version of Interpret.get_direction against the
+plain-float one, and the numpy normalization in get_grayscale_data (still used for other than
+three channels) against Sensing.normalize3. For a batch, it times directions_from_data on an
+(N, 3) array of samples, per sample. All of them are first checked to give the same directions
+on the same samples. The samples are random grayscale readings, normalized as Sensing does, so
+that every rule of get_direction is exercised.
+
+Usage:
+    python3 interp_bench.py [--samples N] [--repeat N]
+"""
+
+import argparse
+import logging
+import timeit
+
+import numpy as np
+
+from sense_interp import Interpret, Sensing, directions_from_data
+
+
+def per_call(function, samples, repeat):
+    """Best time per call of function over the samples, in seconds"""
+
+    def run():
+        for sample in samples:
+            function(sample)
+
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(samples)
+
+
+def main(n_samples, repeat):
+
+    rng = np.random.default_rng(0)
+    raw = rng.integers(0, 4096, (n_samples, 3))
+    data = np.array([Sensing.normalize3(*sample) for sample in raw])
+
+    interpreter = Interpret()
+
+    # Check that every version gives the same directions
+    interpreter.prev_direction = 0.0
+    reference = [interpreter.get_direction_numpy(sample.copy()) for sample in data]
+    interpreter.prev_direction = 0.0
+    scalar = [interpreter.get_direction(sample) for sample in data]
+    batch = directions_from_data(data, interpreter.l_th, interpreter.h_th, interpreter.polarity).tolist()
+    if not reference == scalar == batch:
+        raise RuntimeError("The versions of get_direction disagree")
+
+    raw_lists = raw.tolist()
+    rows = [sample.copy() for sample in data]
+
+    def numpy_normalize(sample):
+        return sample / (np.mean(sample) + 1e-9)
+
+    def scalar_normalize(sample):
+        return np.array(Sensing.normalize3(*sample))
+
+    results = [("normalize, numpy", per_call(numpy_normalize, raw_lists, repeat)),
+               ("normalize, normalize3", per_call(scalar_normalize, raw_lists, repeat)),
+               ("get_direction_numpy", per_call(interpreter.get_direction_numpy, rows, repeat)),
+               ("get_direction", per_call(interpreter.get_direction, rows, repeat))]
+
+    batch_time = min(timeit.repeat(lambda: directions_from_data(data, interpreter.l_th, interpreter.h_th,
+                                                                interpreter.polarity),
+                                   number=1, repeat=repeat))
+    results.append(("directions_from_data, N={0}".format(n_samples), batch_time / n_samples))
+
+    print("{0:<34}{1:>16}".format("version", "us per sample"))
+    for label, seconds in results:
+        print("{0:<34}{1:>16.3f}".format(label, seconds * 1e6))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the grayscale interpretation")
+    parser.add_argument("--samples", type=int, default=10000, help="number of samples to time over")
+    parser.add_argument("--repeat", type=int, default=5, help="runs to take the best of")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    main(args.samples, args.repeat)
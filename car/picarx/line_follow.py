@@ -166,9 +166,10 @@ def lf_grayscale_concurrent(l_th:float=0.35, h_th:float=0.8, polarity:int=-1, sc
     """Function to run line following using grayscale sensors concurrently"""
 
     # Create the bus for all three processes
-    sensor_bus = Bus()
-    interpret_bus = Bus()
-    control_bus = Bus()
+    # Each bus has a single writer, so the lock-free bus can be used in place of the locked utils.Bus
+    sensor_bus = rr.LockFreeBus(None, "Sensor bus")
+    interpret_bus = rr.LockFreeBus(None, "Interpret bus")
+    control_bus = rr.LockFreeBus(None, "Control bus")
 
     # Create the sensor, interpreter and controller objects
     sensor = Sensing()
@@ -14,23 +14,30 @@ logging.getLogger().setLevel(logging.DEBUG)
 
 def main(l_th:float=0.35, h_th:float=0.8, polarity:int=-1, obj_th:float=15.0, scale:float=30.0, speed:int=22,
         Gsdelay:float=0.1, Usdelay:float=0.1, Gidelay:float=0.1, Uidelay:float=0.1, cdelay:float=0.1, rdelay:float=0.1,
-        terminate_time:int=60):
+        terminate_time:int=60, event_driven:bool=True, skip_unchanged:bool=True,
+        trace_latency:bool=True):
 
     # Create objects
     Gsensor = Sensing() # Grayscale sensor
-    Usensor = SenseUltra() # Ultrasonic sensor
+    Usensor = SenseUltra(rate=1.0 / Usdelay) # Ultrasonic sensor, ranging in the background so reads never block
     Ginterp = Interpret(l_th=l_th, h_th=h_th, polarity=polarity) # Grayscale interpreter
     Uinterp = InterpretUltra(threshold=obj_th) # Ultrasonic interpreter
     controller = LineFollowControl(scale=scale) # Line follow controller
     robot = LineFollower(speed=speed) # Robot
 
     # Create buses
-    bGsensor = rr.Bus(Gsensor.get_grayscale_data(), "Grayscale sensor bus")
-    bUsensor = rr.Bus(Usensor.get_ultrasonic_data(), "Ultrasonic sensor bus")
-    bGinterp = rr.Bus(Ginterp.get_direction(), "Grayscale interpreter bus")
-    bUinterp = rr.Bus(Uinterp.get_obstacle(), "Ultrasonic interpreter bus")
-    bControl = rr.Bus(controller.get_control_angle(), "Control Angle bus")
-    bTerminate = rr.Bus(0, "Termination Bus")
+    # With event_driven set, the buses wake up the services reading from them on every write, so that each
+    # stage reacts as soon as its inputs change, and the delays of the downstream stages only act as timeouts
+    # With trace_latency set, the messages carry the time their sensor sample was taken through every stage,
+    # so that the robot control service can report the sensor-to-actuation latency of each path
+    bGsensor = rr.Bus(Gsensor.get_grayscale_data(), "Grayscale sensor bus", notify=event_driven, trace_age=trace_latency)
+    bUsensor = rr.Bus(Usensor.get_ultrasonic_data(), "Ultrasonic sensor bus", notify=event_driven, trace_age=trace_latency)
+    bGinterp = rr.Bus(Ginterp.get_direction(), "Grayscale interpreter bus", notify=event_driven, trace_age=trace_latency)
+    bUinterp = rr.Bus(Uinterp.get_obstacle(), "Ultrasonic interpreter bus", notify=event_driven, trace_age=trace_latency)
+    bControl = rr.Bus(controller.get_control_angle(), "Control Angle bus", notify=event_driven, trace_age=trace_latency)
+    # The termination event triggers by itself once terminate_time has passed, and wakes up every service
+    # waiting on it straight away, so no termination timer service is needed
+    bTerminate = rr.TerminationEvent(terminate_time, "Termination Event")
 
     # Create producers, consumers and consumers-producers
     readGsensor = rr.Producer(
@@ -38,7 +45,8 @@ def main(l_th:float=0.35, h_th:float=0.8, polarity:int=-1, obj_th:float=15.0, sc
         bGsensor,  # output data bus
         Gsdelay,  # delay between data generation cycles
         bTerminate,  # bus to watch for termination signal
-        "Read Grayscale sensor signal"
+        "Read Grayscale sensor signal",
+        rate=1.0 / Gsdelay # sample against fixed deadlines so that the sampling period does not drift
     )
 
     readUsensor = rr.Producer(
@@ -46,7 +54,8 @@ def main(l_th:float=0.35, h_th:float=0.8, polarity:int=-1, obj_th:float=15.0, sc
         bUsensor,  # output data bus
         Usdelay,  # delay between data generation cycles
         bTerminate,  # bus to watch for termination signal
-        "Read Ultrasonic sensor signal"
+        "Read Ultrasonic sensor signal",
+        rate=1.0 / Usdelay # sample against fixed deadlines so that the sampling period does not drift
     )
 
     interpretGsensor = rr.ConsumerProducer(
@@ -55,7 +64,9 @@ def main(l_th:float=0.35, h_th:float=0.8, polarity:int=-1, obj_th:float=15.0, sc
         bGinterp,  # output data bus
         Gidelay,  # delay between data interpretation cycles
         bTerminate,  # bus to watch for termination signal
-        "Interpret Grayscale sensor signal"
+        "Interpret Grayscale sensor signal",
+        wait_for_change=event_driven, # wait for new input data instead of sleeping
+        skip_unchanged=skip_unchanged # don't redo the work if the inputs have not been written
     )
 
     interpretUsensor = rr.ConsumerProducer(
@@ -64,7 +75,9 @@ def main(l_th:float=0.35, h_th:float=0.8, polarity:int=-1, obj_th:float=15.0, sc
         bUinterp,  # output data bus
         Uidelay,  # delay between data interpretation cycles
         bTerminate,  # bus to watch for termination signal
-        "Interpret Ultrasonic sensor signal"
+        "Interpret Ultrasonic sensor signal",
+        wait_for_change=event_driven, # wait for new input data instead of sleeping
+        skip_unchanged=skip_unchanged # don't redo the work if the inputs have not been written
     )
 
     controlAngle = rr.ConsumerProducer(
@@ -73,7 +86,9 @@ def main(l_th:float=0.35, h_th:float=0.8, polarity:int=-1, obj_th:float=15.0, sc
         bControl,  # output data bus
         cdelay,  # delay between data control cycles
         bTerminate,  # bus to watch for termination signal
-        "Control Angle"
+        "Control Angle",
+        wait_for_change=event_driven, # wait for new input data instead of sleeping
+        skip_unchanged=skip_unchanged # don't redo the work if the inputs have not been written
     )
 
     robotControl = rr.Consumer(
@@ -81,16 +96,9 @@ def main(l_th:float=0.35, h_th:float=0.8, polarity:int=-1, obj_th:float=15.0, sc
         (bControl, bUinterp),  # input data buses
         rdelay,  # delay between data control cycles
         bTerminate,  # bus to watch for termination signal
-        "Robot Control"
-    )
-
-    # Create a termination signal
-    termination = rr.Timer(
-        bTerminate, # output data bus
-        terminate_time, # time to wait before sending termination signal
-        0.01, # delay between checking for termination time
-        bTerminate, # bus to check for termination signal
-        "Termination Timer"
+        "Robot Control",
+        wait_for_change=event_driven, # wait for new input data instead of sleeping
+        skip_unchanged=skip_unchanged # don't redo the work if the inputs have not been written
     )
 
     # List of producer-consumers to execute concurrently
@@ -99,12 +107,21 @@ def main(l_th:float=0.35, h_th:float=0.8, polarity:int=-1, obj_th:float=15.0, sc
                             interpretGsensor,
                             interpretUsensor,
                             controlAngle,
-                            robotControl,
-                            termination]
+                            robotControl]
 
     # Run the concurrent execution
     rr.runConcurrently(producer_consumer_list)
 
+    # Report how often each service ran, and how many cycles were skipped for unchanged inputs
+    for service in producer_consumer_list:
+        stats = service.getStats()
+        logging.info(f"{stats['name']}: {stats['cycles']} cycles, {stats['skipped_cycles']} skipped as unchanged")
+
+    # Report how old the sensor data was by the time the robot acted on it
+    for path, latency in robotControl.getLatencyReport().items():
+        logging.info(f"{path}: p50 {latency['p50'] * 1000:.1f} ms, p90 {latency['p90'] * 1000:.1f} ms, "
+                     f"p99 {latency['p99'] * 1000:.1f} ms")
+
     # Kill the robot
     atexit.register(robot.stop)
 
@@ -15,6 +15,10 @@ except ImportError:
 import logging
 import atexit
 
+from adc_batch import ADCGroup
+from grayscale_sampler import GrayscaleSampler
+from ultrasonic_engine import UltrasonicEngine
+
 reset_mcu()
 time.sleep(0.2)
 
@@ -110,6 +114,10 @@ class Picarx(object):
         # --------- grayscale module init ---------
         adc0, adc1, adc2 = [ADC(pin) for pin in grayscale_pins]
         self.grayscale = Grayscale_Module(adc0, adc1, adc2, reference=None)
+        # Read the three channels together on one bus handle
+        self.grayscale_adcs = ADCGroup([adc0, adc1, adc2])
+        # Background sampler, see start_grayscale_sampler
+        self.grayscale_sampler = None
         # get reference
         self.line_reference = self.config_flie.get("line_reference", default_value=str(self.DEFAULT_LINE_REF))
         self.line_reference = [float(i) for i in self.line_reference.strip().strip('[]').split(',')]
@@ -123,6 +131,8 @@ class Picarx(object):
         # --------- ultrasonic init ---------
         tring, echo= ultrasonic_pins
         self.ultrasonic = Ultrasonic(Pin(tring), Pin(echo))
+        # Background ranging, see start_ultrasonic_engine
+        self.ultrasonic_engine = None
 
         # --------- intialize servos ---------
         self.zeros_servos()
@@ -310,10 +320,47 @@ class Picarx(object):
             self.set_motor_speed(2, -speed)
 
     def get_distance(self):
+        # Once the engine runs, the latest filtered distance is returned without waiting on the sensor
+        if self.ultrasonic_engine is not None:
+            return self.ultrasonic_engine.read()
         return self.ultrasonic.read()
 
+    def start_ultrasonic_engine(self, rate:float=20.0):
+        '''Range in the background at a fixed rate, and serve get_distance from the latest filtered distance'''
+
+        if self.ultrasonic_engine is None:
+            self.ultrasonic_engine = UltrasonicEngine(self.ultrasonic.trig, self.ultrasonic.echo, rate=rate,
+                                                      name="Picarx ultrasonic engine")
+            atexit.register(self.stop_ultrasonic_engine)
+        self.ultrasonic_engine.start()
+
+        return self.ultrasonic_engine
+
+    def stop_ultrasonic_engine(self):
+        if self.ultrasonic_engine is not None:
+            self.ultrasonic_engine.stop()
+            self.ultrasonic_engine = None
+
     def get_grayscale_data(self):
-        return list.copy(self.grayscale.read())
+        # Once the sampler runs, every caller shares its latest sample rather than reading the ADCs
+        if self.grayscale_sampler is not None:
+            return self.grayscale_sampler.read()
+        return self.grayscale_adcs.read()
+
+    def start_grayscale_sampler(self, rate:float=100.0):
+        '''Sample the grayscale module in the background at a fixed rate, and serve get_grayscale_data from it'''
+
+        if self.grayscale_sampler is None:
+            self.grayscale_sampler = GrayscaleSampler(self.grayscale_adcs.read, rate=rate, name="Picarx grayscale sampler")
+            atexit.register(self.stop_grayscale_sampler)
+        self.grayscale_sampler.start()
+
+        return self.grayscale_sampler
+
+    def stop_grayscale_sampler(self):
+        if self.grayscale_sampler is not None:
+            self.grayscale_sampler.stop()
+            self.grayscale_sampler = None
 
     def set_grayscale_reference(self, value):
         if isinstance(value, list) and len(value) == 3:
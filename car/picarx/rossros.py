@@ -1,9 +1,31 @@
 #! /usr/bin/python3
+import bisect
+import collections
 import concurrent.futures
+import contextlib
+import threading
 import time
+import math
+import os
 import logging
+import numpy as np
 from readerwriterlock import rwlock
-from logdecorator import log_on_start, log_on_end, log_on_error
+
+# The log_on_* decorators wrap every bus access and every step of a service in formatted DEBUG
+# messages, which costs more than the work itself on a small board. They are only applied when
+# the ROSSROS_TRACE environment variable is set (e.g. ROSSROS_TRACE=1) when this module is
+# imported; otherwise they are replaced by decorators that hand back the undecorated function
+TRACE = os.environ.get("ROSSROS_TRACE", "0").lower() not in ("", "0", "false", "no", "off")
+
+if TRACE:
+    from logdecorator import log_on_start, log_on_end, log_on_error
+else:
+    def _untraced(*_args, **_kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+    log_on_start = log_on_end = log_on_error = _untraced
 
 DEBUG = logging.DEBUG
 logging_format = "%(asctime)s: %(message)s"
@@ -18,7 +40,9 @@ class Bus:
 
     def __init__(self,
                 initial_message=0,
-                name="Unnamed Bus"):
+                name="Unnamed Bus",
+                notify=False,  # wake up services waiting on this bus whenever it is written
+                trace_age=False):  # carry the origin times of the sensor data behind each message
 
         self.message = initial_message
         self.name = name
@@ -26,6 +50,21 @@ class Bus:
         # Set up the class so that functions can get a lock while working
         self.lock = rwlock.RWLockFairD()
 
+        # Sequence number, incremented on every write so that readers can tell new messages from old ones
+        self.sequence = 0
+
+        # time.monotonic() time of the last write, so that readers can tell how old the message is
+        self.timestamp = time.monotonic()
+
+        # For traced buses, the time.monotonic() times at which the producers behind the current
+        # message took their samples, keyed by the path of bus names the data travelled along
+        self.trace_age = trace_age
+        self.origins = {}
+
+        # Condition variables of services that are waiting for this bus to change
+        self.notify = notify
+        self.subscribers = []
+
     @log_on_start(DEBUG, "{self.name:s}: Initiating read by {_name:s}")
     @log_on_error(DEBUG, "{self.name:s}: Error on read by {_name:s}")
     @log_on_end(DEBUG, "{self.name:s}: Finished read by {_name:s}")
@@ -39,10 +78,534 @@ class Bus:
     @log_on_start(DEBUG, "{self.name:s}: Initiating write by {_name:s}")
     @log_on_error(DEBUG, "{self.name:s}: Error on write by {_name:s}")
     @log_on_end(DEBUG, "{self.name:s}: Finished write by {_name:s}")
-    def set_message(self, message, _name='Unspecified function'):
+    def set_message(self, message, _name='Unspecified function', origins=None):
+
+        with self.lock.gen_wlock():
+            self.message = message
+            self.sequence += 1
+            self.timestamp = time.monotonic()
+            if self.trace_age:
+                self.origins = origins or {}
+
+        # Wake up any services waiting for new data on this bus
+        if self.notify:
+            self.notify_subscribers()
+
+    def subscribe(self, condition):
+        """
+        Register a condition variable to be notified whenever a new message is written to the bus
+        """
+
+        self.subscribers.append(condition)
+
+    def unsubscribe(self, condition):
+        """
+        Stop notifying a condition variable registered with subscribe. The list is replaced rather
+        than changed in place, so that a writer notifying the subscribers is not disturbed
+        """
+
+        self.subscribers = [c for c in self.subscribers if c is not condition]
+
+    def notify_subscribers(self):
+
+        for condition in self.subscribers:
+            with condition:
+                condition.notify_all()
+
+
+class LockFreeBus(Bus):
+    """
+    Bus for one writer and any number of readers that takes no locks. The message is kept together
+    with its sequence number, write time and origins in a single tuple, and every write replaces
+    the whole tuple with one attribute assignment, which is atomic in CPython. A reader therefore
+    always sees a complete message without having to lock, as long as only one service (or thread)
+    writes to the bus. Has the get_message/set_message interface of Bus and the read/write
+    interface of utils.Bus
+    """
+
+    def __init__(self,
+                initial_message=0,
+                name="Unnamed Lock-free Bus",
+                notify=False,  # wake up services waiting on this bus whenever it is written
+                trace_age=False):  # carry the origin times of the sensor data behind each message
+
+        self.name = name
+        self.notify = notify
+        self.subscribers = []
+        self.trace_age = trace_age
+
+        # (message, sequence number, write time, origins)
+        self.slot = (initial_message, 0, time.monotonic(), {})
+
+    @property
+    def message(self):
+        return self.slot[0]
+
+    @property
+    def sequence(self):
+        return self.slot[1]
+
+    @property
+    def timestamp(self):
+        return self.slot[2]
+
+    @property
+    def origins(self):
+        return self.slot[3]
+
+    @log_on_start(DEBUG, "{self.name:s}: Initiating read by {_name:s}")
+    @log_on_error(DEBUG, "{self.name:s}: Error on read by {_name:s}")
+    @log_on_end(DEBUG, "{self.name:s}: Finished read by {_name:s}")
+    def get_message(self, _name='Unspecified function'):
+
+        return self.slot[0]
+
+    @log_on_start(DEBUG, "{self.name:s}: Initiating write by {_name:s}")
+    @log_on_error(DEBUG, "{self.name:s}: Error on write by {_name:s}")
+    @log_on_end(DEBUG, "{self.name:s}: Finished write by {_name:s}")
+    def set_message(self, message, _name='Unspecified function', origins=None):
+
+        # Only this writer changes the slot, so the sequence number can be read and bumped without a lock
+        self.slot = (message, self.slot[1] + 1, time.monotonic(), (origins or {}) if self.trace_age else {})
+
+        # Wake up any services waiting for new data on this bus
+        if self.notify:
+            self.notify_subscribers()
+
+    # Same interface as utils.Bus
+    def read(self):
+        return self.slot[0]
+
+    def write(self, message):
+        self.set_message(message)
+
+
+class QueueBus(Bus):
+    """
+    Bus that queues its messages in order instead of keeping only the latest one, for consumers
+    such as loggers and recorders that must see every sample even if they run slower than the
+    producer. The queue holds at most `capacity` messages. When it is full, the policy decides
+    what a write does: "block" waits for a reader to make room (for at most block_timeout seconds,
+    if given), "drop_oldest" discards the oldest queued message, and "drop_newest" discards the
+    message being written. Messages discarded either way, including writes that time out, are
+    counted in `dropped`
+
+    get_message drains the queue, returning up to batch_size messages (all of them by default) as
+    a list, oldest first, so that a consumer function can process a batch in one call. The list
+    is empty if nothing has been written since the last read. Services running under
+    runTopologically share one thread with the readers, so should not use the "block" policy
+    """
+
+    POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self,
+                initial_messages=(),  # messages to start the queue with
+                name="Unnamed Queue Bus",
+                capacity=100,  # most messages held in the queue
+                policy="drop_oldest",  # what to do when the queue is full
+                batch_size=None,  # most messages returned by one read (None for all)
+                block_timeout=None,  # longest time a blocked write waits for room (None for ever)
+                notify=False,  # wake up services waiting on this bus whenever it is written
+                trace_age=False):  # carry the origin times of the sensor data behind the latest message
+
+        if policy not in self.POLICIES:
+            raise ValueError("queue policy should be one of {0}, not {1}".format(self.POLICIES, policy))
+        if capacity < 1:
+            raise ValueError("queue capacity should be at least 1, not {0}".format(capacity))
+
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+        self.batch_size = batch_size
+        self.block_timeout = block_timeout
+        self.notify = notify
+        self.subscribers = []
+        self.trace_age = trace_age
+
+        # Writers and readers both change the queue, so they share one lock
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+        self.sequence = 0
+        self.timestamp = time.monotonic()
+        self.origins = {}
+
+        for message in initial_messages:
+            self.set_message(message, "Initial messages")
+
+    def __len__(self):
+        return len(self.queue)
+
+    @log_on_start(DEBUG, "{self.name:s}: Initiating read by {_name:s}")
+    @log_on_error(DEBUG, "{self.name:s}: Error on read by {_name:s}")
+    @log_on_end(DEBUG, "{self.name:s}: Finished read by {_name:s}")
+    def get_message(self, _name='Unspecified function'):
+
+        return self.drain(self.batch_size)
+
+    def drain(self, max_items=None):
+        """Remove and return up to max_items queued messages (all of them if None), oldest first"""
+
+        with self.condition:
+            count = len(self.queue) if max_items is None else min(max_items, len(self.queue))
+            messages = [self.queue.popleft() for _ in range(count)]
+
+            # Let any blocked writers know there is room
+            if count:
+                self.condition.notify_all()
+
+        return messages
+
+    @log_on_start(DEBUG, "{self.name:s}: Initiating write by {_name:s}")
+    @log_on_error(DEBUG, "{self.name:s}: Error on write by {_name:s}")
+    @log_on_end(DEBUG, "{self.name:s}: Finished write by {_name:s}")
+    def set_message(self, message, _name='Unspecified function', origins=None):
+
+        with self.condition:
+
+            # Make room according to the policy, or give up on this message
+            if len(self.queue) >= self.capacity:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return
+                elif self.policy == "drop_oldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                elif not self.condition.wait_for(lambda: len(self.queue) < self.capacity, self.block_timeout):
+                    self.dropped += 1
+                    return
+
+            self.queue.append(message)
+            self.sequence += 1
+            self.timestamp = time.monotonic()
+            if self.trace_age:
+                self.origins = origins or {}
+
+        # Wake up any services waiting for new data on this bus
+        if self.notify:
+            self.notify_subscribers()
+
+
+class ArrayBus(Bus):
+    """
+    Bus for numpy messages of a fixed dtype and shape (grayscale triplets, ultrasonic distances,
+    camera line shifts), that does not allocate a new array for every message. The bus holds two
+    preallocated buffers: readers are given a read-only view of the front one, while the writer
+    fills the back one, either by copying a message in with set_message or in place with
+    write_into/back_buffer and publish. Publishing swaps the two buffers around
+
+    The view a reader gets is a window onto a buffer, not a snapshot: the next write swaps the
+    buffers, and the one after that fills the reader's buffer in again, possibly while the reader
+    is still looking at it. A reader that is slower than the writer can therefore see a message
+    change under it, or half of two messages, so readers that keep a message past the next write
+    or need it consistent should copy it straight away. Only one service should write to the bus
+    """
+
+    def __init__(self,
+                initial_message=0,
+                name="Unnamed Array Bus",
+                shape=(),  # shape of the numpy payload, () for a scalar
+                dtype=np.float64,  # type of the numpy payload
+                notify=False,  # wake up services waiting on this bus whenever it is written
+                trace_age=False):  # carry the origin times of the sensor data behind each message
+
+        super().__init__(None, name, notify, trace_age)
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.buffers = (np.zeros(self.shape, self.dtype), np.zeros(self.shape, self.dtype))
+
+        # The read-only views given to readers are made once, rather than on every read
+        self.views = tuple(buffer.view() for buffer in self.buffers)
+        for view in self.views:
+            view.flags.writeable = False
+
+        self.front = 0
+        np.copyto(self.buffers[0], initial_message)
+        self.message = self.views[0]
+
+    def back_buffer(self):
+        """The buffer the next message is written into, which readers only see once it is published"""
+
+        return self.buffers[1 - self.front]
+
+    @log_on_start(DEBUG, "{self.name:s}: Initiating publish by {_name:s}")
+    @log_on_error(DEBUG, "{self.name:s}: Error on publish by {_name:s}")
+    @log_on_end(DEBUG, "{self.name:s}: Finished publish by {_name:s}")
+    def publish(self, _name='Unspecified function', origins=None):
+        """Make the back buffer, once it has been filled in, the message of the bus"""
 
         with self.lock.gen_wlock():
+            self.front = 1 - self.front
+            self.message = self.views[self.front]
+            self.sequence += 1
+            self.timestamp = time.monotonic()
+            if self.trace_age:
+                self.origins = origins or {}
+
+        # Wake up any services waiting for new data on this bus
+        if self.notify:
+            self.notify_subscribers()
+
+    @contextlib.contextmanager
+    def write_into(self, _name='Unspecified function', origins=None):
+        """
+        Context manager that gives the back buffer to be filled in place, and publishes it at the
+        end of the block. Nothing is published if the block raises
+        """
+
+        yield self.back_buffer()
+        self.publish(_name, origins)
+
+    @log_on_start(DEBUG, "{self.name:s}: Initiating write by {_name:s}")
+    @log_on_error(DEBUG, "{self.name:s}: Error on write by {_name:s}")
+    @log_on_end(DEBUG, "{self.name:s}: Finished write by {_name:s}")
+    def set_message(self, message, _name='Unspecified function', origins=None):
+
+        np.copyto(self.back_buffer(), message)
+        self.publish(_name, origins)
+
+
+class TerminationEvent:
+    """
+    Termination signal that services can wait on, in place of a termination bus that every service
+    reads on every cycle. It is a threading.Event with an optional deadline: it triggers when set()
+    is called, or once duration seconds have passed since it was created, which does away with the
+    Timer service. Services given a TerminationEvent as a termination bus check it without taking
+    any locks, and sleep between cycles by waiting on it, so they stop as soon as it triggers
+    rather than up to one delay later
+
+    It also has the get_message/set_message interface of a termination bus, so it can be mixed
+    with termination buses and used as the output bus of a Timer: writing a value that is true
+    and non-negative triggers it, as it would trigger a service watching a termination bus
+    """
+
+    def __init__(self,
+                duration=None,  # seconds after which to trigger by itself (None for no deadline)
+                name="Unnamed termination event"):
+
+        self.name = name
+        self.event = threading.Event()
+        self.deadline = time.monotonic() + duration if duration else None
+        self.subscribers = []
+
+        self.sequence = 0
+        self.timestamp = time.monotonic()
+
+    def is_set(self):
+        """Whether the event has triggered, triggering it first if its deadline has passed"""
+
+        if not self.event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.set()
+
+        return self.event.is_set()
+
+    def set(self):
+        """Trigger the event, waking up every service waiting on it"""
+
+        if self.event.is_set():
+            return
+
+        self.event.set()
+        self.sequence += 1
+        self.timestamp = time.monotonic()
+
+        for condition in self.subscribers:
+            with condition:
+                condition.notify_all()
+
+    def remaining(self):
+        """Seconds until the deadline, or None if there is no deadline"""
+
+        if self.deadline is None:
+            return None
+
+        return max(0.0, self.deadline - time.monotonic())
+
+    def wait(self, timeout=None):
+        """
+        Sleep for up to timeout seconds (for ever if None), returning early if the event triggers.
+        Returns whether it has triggered
+        """
+
+        remaining = self.remaining()
+        if remaining is not None and (timeout is None or remaining < timeout):
+            timeout = remaining
+
+        self.event.wait(timeout)
+
+        return self.is_set()
+
+    def subscribe(self, condition):
+        """
+        Register a condition variable to be notified when the event triggers
+        """
+
+        self.subscribers.append(condition)
+
+    def unsubscribe(self, condition):
+        """
+        Stop notifying a condition variable registered with subscribe
+        """
+
+        self.subscribers = [c for c in self.subscribers if c is not condition]
+
+    def get_message(self, _name='Unspecified function'):
+
+        return self.is_set()
+
+    def set_message(self, message, _name='Unspecified function', origins=None):
+
+        if message and message >= 0:
+            self.set()
+
+
+class HistoryBus(Bus):
+    """
+    Bus that also keeps the last `capacity` messages and the times they were written, in a
+    preallocated numpy ring buffer, so that consumers can filter over a window of samples
+    (e.g. the median of the last five ultrasonic readings) without keeping their own lists.
+    Messages have to fit a numpy array of the given shape and dtype. get_message still
+    returns the latest message, so a HistoryBus can stand in for a Bus anywhere
+
+    Appending is O(1). Window queries (last, since, window) return the requested samples oldest
+    first, as views into the buffer when they do not wrap around its end and as copies of just
+    the window when they do. Views are overwritten by later writes, so keep a copy of anything
+    that has to outlive the next few messages. The statistics (mean, median, min, max) are
+    computed over a window of either the last n samples or the last `seconds` seconds.
+    A message can be given the time.monotonic() time it was taken at instead of the time it is
+    written, as long as the times do not go backwards
+    """
+
+    def __init__(self,
+                initial_message=0,
+                name="Unnamed History Bus",
+                capacity=100,  # number of messages kept
+                shape=(),  # shape of each message, () for scalars
+                dtype=np.float64,  # type of the messages
+                notify=False,  # wake up services waiting on this bus whenever it is written
+                trace_age=False):  # carry the origin times of the sensor data behind each message
+
+        super().__init__(initial_message, name, notify, trace_age)
+
+        # Preallocated ring buffer of write times and messages
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+        self.index = 0  # slot that the next message goes into
+        self.size = 0  # number of slots filled
+
+        self.append(initial_message, time.monotonic())
+
+    def append(self, message, timestamp):
+
+        self.times[self.index] = timestamp
+        self.values[self.index] = message
+        self.index = (self.index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    @log_on_start(DEBUG, "{self.name:s}: Initiating write by {_name:s}")
+    @log_on_error(DEBUG, "{self.name:s}: Error on write by {_name:s}")
+    @log_on_end(DEBUG, "{self.name:s}: Finished write by {_name:s}")
+    def set_message(self, message, _name='Unspecified function', origins=None, timestamp=None):
+
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        with self.lock.gen_wlock():
+            # The window queries binary search the times, so they have to stay in order
+            if timestamp < self.times[self.index - 1]:
+                raise ValueError("{0}: timestamp {1} is older than the last message's {2}".format(
+                    self.name, timestamp, self.times[self.index - 1]))
+
             self.message = message
+            self.sequence += 1
+            self.timestamp = timestamp
+            if self.trace_age:
+                self.origins = origins or {}
+            self.append(message, timestamp)
+
+        # Wake up any services waiting for new data on this bus
+        if self.notify:
+            self.notify_subscribers()
+
+    # Same interface as utils.Bus, so that the history can also be used by the plain thread loops
+    def read(self):
+        return self.get_message()
+
+    def write(self, message):
+        self.set_message(message)
+
+    # Number of samples in the window of the last n samples or last `seconds` seconds
+    def windowLength(self, n=None, seconds=None):
+
+        if seconds is not None:
+            cutoff = time.monotonic() - seconds
+
+            # The times are sorted within the older part (after the write index) and the
+            # newer part (before it) of the buffer, so each can be binary searched
+            newer = self.times[:self.index]
+            older = self.times[self.index:self.size]
+            length = (len(newer) - np.searchsorted(newer, cutoff)) + (len(older) - np.searchsorted(older, cutoff))
+        elif n is not None:
+            length = n
+        else:
+            length = self.size
+
+        return int(min(length, self.size))
+
+    # Samples in the window, oldest first
+    def windowUnlocked(self, n=None, seconds=None):
+
+        length = self.windowLength(n, seconds)
+        start = (self.index - length) % self.capacity
+
+        if start + length <= self.capacity:
+            return self.times[start:start + length], self.values[start:start + length]
+        else:
+            return (np.concatenate((self.times[start:], self.times[:self.index])),
+                    np.concatenate((self.values[start:], self.values[:self.index])))
+
+    def window(self, n=None, seconds=None):
+        """
+        Return the (times, values) arrays of the last n samples or of the samples written in
+        the last `seconds` seconds (all stored samples if neither is given), oldest first
+        """
+
+        with self.lock.gen_rlock():
+            return self.windowUnlocked(n, seconds)
+
+    def last(self, n):
+        """Return the last n messages, oldest first"""
+
+        return self.window(n=n)[1]
+
+    def since(self, seconds):
+        """Return the messages written in the last `seconds` seconds, oldest first"""
+
+        return self.window(seconds=seconds)[1]
+
+    # Apply a numpy reduction to the messages in a window, while holding the lock
+    def reduceWindow(self, reduction, n, seconds):
+
+        with self.lock.gen_rlock():
+            values = self.windowUnlocked(n, seconds)[1]
+            if len(values) == 0:
+                return None
+            return reduction(values, axis=0)
+
+    def mean(self, n=None, seconds=None):
+        return self.reduceWindow(np.mean, n, seconds)
+
+    def median(self, n=None, seconds=None):
+        return self.reduceWindow(np.median, n, seconds)
+
+    def min(self, n=None, seconds=None):
+        return self.reduceWindow(np.min, n, seconds)
+
+    def max(self, n=None, seconds=None):
+        return self.reduceWindow(np.max, n, seconds)
 
 
 def ensureTuple(value):
@@ -58,14 +621,114 @@ def ensureTuple(value):
     return value_tuple
 
 
+class Histogram:
+    """
+    Fixed-size histogram of durations in seconds, with logarithmically spaced bins (ten per decade
+    from one microsecond to a hundred seconds), so that recording a value costs one binary search
+    and the memory used does not grow with the number of values. Percentiles are estimated as the
+    upper edge of the bin they fall in
+    """
+
+    EDGES = [10.0 ** (exponent / 10.0) for exponent in range(-60, 21)]
+
+    def __init__(self):
+
+        self.counts = [0] * (len(self.EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def record(self, value):
+
+        self.counts[bisect.bisect_left(self.EDGES, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def percentile(self, fraction):
+
+        if not self.count:
+            return None
+
+        threshold = fraction * self.count
+        cumulative = 0
+        for index, bin_count in enumerate(self.counts):
+            cumulative += bin_count
+            if cumulative >= threshold:
+                break
+
+        # Values above the last edge can only be bounded by the largest value seen
+        if index == len(self.EDGES):
+            return self.maximum
+        return min(self.EDGES[index], self.maximum)
+
+    def snapshot(self):
+        """Return the count, mean, minimum, maximum and 50th/90th/99th percentiles as a dictionary"""
+
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "min": self.minimum,
+                "max": self.maximum,
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99)}
+
+
 class ConsumerProducer:
     """
     Class that turns a provided function into a service that reads from
     the input buses, stores the resulting data into the output buses,
     and watches a set of termination buses for a "True" or non-negative signal, at which
     point the service shuts down
+
+    With wait_for_change set, the service does not sleep for a fixed delay between cycles. Instead it
+    blocks until one of its input buses is written or a termination bus triggers, so that it reacts
+    to new data as soon as it arrives. Only buses created with notify=True wake the service up; the
+    delay is then used as the longest time to wait before checking all the buses again (0 waits forever)
+
+    With a rate set, the delay is ignored and the cycles are started against fixed deadlines on the
+    time.monotonic() clock, so that the time spent doing the work does not stretch the period. When a
+    cycle overruns its deadline, the overrun policy decides whether the missed cycles are skipped
+    ("skip") or run back to back until the schedule has caught up ("catch_up"). The achieved rate
+    and the jitter of the cycle start times are available from getStats()
+
+    With skip_unchanged set, a cycle in which none of the input buses has been written since the
+    last time the function ran is skipped: the function is not called and nothing is written to
+    the output buses, so unchanged data does not trigger redundant work downstream (such as
+    repeated steering commands). getStats() reports how many cycles were skipped
+
+    Unless telemetry is switched off, every cycle records the compute time (calling the function
+    and writing its outputs), the age of the oldest input message when it was read, and the time
+    since the start of the previous cycle into fixed-size histograms. A cycle whose compute time is
+    longer than the delay counts as an overrun. getTelemetry() returns a snapshot of all of these,
+    and a TelemetryReporter service prints them periodically
+
+    Buses created with trace_age=True carry the times at which the sensor data behind their
+    message was sampled. A Producer stamps its traced output buses with the time it started its
+    cycle, and every service passes the origins of its traced inputs on to its traced outputs,
+    adding the output bus to the path they travelled along. Each service records, per path, how
+    old the origin samples were when it finished its cycle, so that getLatencyReport() on the
+    actuator service gives the sensor-to-actuation latency of every path that reaches it. The
+    origins are read just after the message without holding the lock, so a write in between can
+    attribute a cycle to a slightly newer sample
+
+    A TerminationEvent can be given in place of (or alongside) the termination buses. It is checked
+    without taking any locks, and the service sleeps between cycles by waiting on it, so that the
+    service stops as soon as it triggers
+
+    Services can declare a priority class ("realtime", "high", "normal" or "low") and a set of CPUs
+    to run on, so that steady-rate control keeps its timing while printers and telemetry lag
+    behind. runConcurrently ignores them; rossros_priority.runPrioritized applies them to the
+    thread of each service, as far as the operating system and its privileges allow
     """
 
+    OVERRUN_POLICIES = ("skip", "catch_up")
+    PRIORITIES = ("realtime", "high", "normal", "low")
+
     @log_on_start(DEBUG, "{name:s}: Starting to create consumer-producer")
     @log_on_error(DEBUG, "{name:s}: Encountered an error while creating consumer-producer")
     @log_on_end(DEBUG, "{name:s}: Finished creating consumer-producer")
@@ -75,7 +738,23 @@ class ConsumerProducer:
                 output_buses,
                 delay=0,
                 termination_buses=Bus(False, "Default consumer_producer termination bus"),
-                name="Unnamed consumer_producer"):
+                name="Unnamed consumer_producer",
+                wait_for_change=False,  # block until an input bus changes instead of sleeping
+                rate=None,  # cycles per second, scheduled against fixed deadlines (None uses the delay)
+                overrun="skip",  # what to do with missed deadlines, "skip" or "catch_up"
+                skip_unchanged=False,  # skip cycles in which no input bus has been written
+                telemetry=True,  # record compute time, input age and period histograms
+                priority="normal",  # scheduling class, applied by rossros_priority.runPrioritized
+                cpu_affinity=None):  # CPUs to pin the service to, applied by rossros_priority.runPrioritized
+
+        if overrun not in self.OVERRUN_POLICIES:
+            raise ValueError("overrun policy should be one of {0}, not {1}".format(self.OVERRUN_POLICIES, overrun))
+        if rate is not None and rate <= 0:
+            raise ValueError("rate should be a positive number of cycles per second, not {0}".format(rate))
+        if rate is not None and wait_for_change:
+            raise ValueError("{0}: a service can either run at a fixed rate or wait for changes, not both".format(name))
+        if priority not in self.PRIORITIES:
+            raise ValueError("priority should be one of {0}, not {1}".format(self.PRIORITIES, priority))
 
         self.consumer_producer_function = consumer_producer_function
         self.input_buses = ensureTuple(input_buses)
@@ -83,12 +762,67 @@ class ConsumerProducer:
         self.delay = delay
         self.termination_buses = ensureTuple(termination_buses)
         self.name = name
+        self.wait_for_change = wait_for_change
+        self.rate = rate
+        self.overrun = overrun
+        self.skip_unchanged = skip_unchanged
+        self.telemetry = telemetry
+        self.priority = priority
+        self.cpu_affinity = None if cpu_affinity is None else set(cpu_affinity)
+
+        # Sleep on the first termination event, if there is one, so that it can cut sleeps short
+        self.termination_event = next(
+            (bus for bus in self.termination_buses if isinstance(bus, TerminationEvent)), None)
+
+        # Timing histograms. Producers have no real inputs, so they do not measure input age
+        self.has_inputs = True
+        self.compute_time = Histogram()
+        self.input_age = Histogram()
+        self.period = Histogram()
+        self.compute_start_time = None
+
+        # End-to-end latency histograms, keyed by the path of buses the data came along
+        self.input_origins = {}
+        self.path_latency = {}
+
+        # Scheduling statistics
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped_deadlines = 0
+        self.first_cycle_time = None
+        self.last_cycle_time = None
+        self.next_deadline = None
+        self.input_sequences = None
+        self.processed_sequences = None
+        self.skipped_cycles = 0
+        self.jitter_sum = 0.0
+        self.jitter_sum_sq = 0.0
+        self.jitter_max = 0.0
 
     @log_on_start(DEBUG, "{self.name:s}: Starting consumer-producer service")
     @log_on_error(DEBUG, "{self.name:s}: Encountered an error while executing consumer-producer")
     @log_on_end(DEBUG, "{self.name:s}: Closing down consumer-producer service")
     def __call__(self):
 
+        # Ask the input and termination buses to wake this service up when they change
+        if self.wait_for_change:
+            change_condition = threading.Condition()
+            for bus in self.input_buses + self.termination_buses:
+                bus.subscribe(change_condition)
+
+        try:
+            self.runCycles(change_condition if self.wait_for_change else None)
+        finally:
+            # Stop the buses notifying this run, so that restarting the service does not pile up subscribers
+            if self.wait_for_change:
+                for bus in self.input_buses + self.termination_buses:
+                    bus.unsubscribe(change_condition)
+
+    # Run cycles until a termination bus triggers
+    def runCycles(self, change_condition):
+
+        self.startSchedule()
+
         while True:
 
             # Check if the loop should terminate
@@ -97,16 +831,180 @@ class ConsumerProducer:
                 break
 
             # Collect all of the values from the input buses into a list
-            input_values = self.collectbusesToValues(self.input_buses)
+            input_values = self.beginCycle()
+
+            # Nothing new on the input buses, so nothing to do this cycle
+            if input_values is not None:
+
+                # Get the output value or tuple of values corresponding to the inputs
+                output_values = self.consumer_producer_function(*input_values)
+
+                # Deal the values into the output buses
+                self.endCycle(output_values)
+
+            # Wait for new data, sleep until the next deadline, or pause for set amount of time
+            if self.wait_for_change:
+                self.waitForChange(change_condition, self.input_sequences)
+            else:
+                self.sleep(self.pauseTime())
+
+    # The steps of a cycle are split out of __call__ so that other executors can
+    # run them around their own way of calling the function and waiting
+
+    # Set the first deadline for fixed-rate services to now
+    def startSchedule(self):
+
+        if self.rate:
+            self.next_deadline = time.monotonic()
+
+    # Record the start of the cycle and collect the input values, or return None
+    # if the cycle should be skipped because the inputs have not changed
+    def beginCycle(self):
 
-            # Get the output value or tuple of values corresponding to the inputs
-            output_values = self.consumer_producer_function(*input_values)
+        # Record when this cycle started
+        self.recordCycleStart()
 
-            # Deal the values into the output buses
-            self.dealValuesTobuses(output_values, self.output_buses)
+        # Note which messages are about to be read, so that later writes can be detected
+        self.input_sequences = self.collectbusesToSequences(self.input_buses)
+
+        if self.skip_unchanged:
+            if self.input_sequences == self.processed_sequences:
+                self.skipped_cycles += 1
+                return None
+            self.processed_sequences = self.input_sequences
+
+        input_values = self.collectbusesToValues(self.input_buses)
+        self.compute_start_time = time.monotonic()
+
+        # Origin times of the data behind the inputs. A producer's data originates now
+        if self.has_inputs:
+            self.input_origins = self.collectbusesToOrigins(self.input_buses)
+        else:
+            self.input_origins = {(): self.compute_start_time}
 
-            # Pause for set amount of time
-            time.sleep(self.delay)
+        if self.telemetry and self.has_inputs:
+            oldest = min(bus.timestamp for bus in self.input_buses)
+            self.input_age.record(self.compute_start_time - oldest)
+
+        return input_values
+
+    # Deal the output values of the cycle into the output buses
+    def endCycle(self, output_values):
+
+        self.dealValuesTobuses(output_values, self.output_buses, self.input_origins)
+        end_time = time.monotonic()
+
+        # How old the sensor data behind the inputs was once this cycle had acted on it
+        if self.has_inputs:
+            for path, origin_time in self.input_origins.items():
+                if path not in self.path_latency:
+                    self.path_latency[path] = Histogram()
+                self.path_latency[path].record(end_time - origin_time)
+
+        if self.telemetry:
+            compute_time = end_time - self.compute_start_time
+            self.compute_time.record(compute_time)
+
+            # Fixed-rate services count their overruns against the schedule instead
+            if not self.rate and not self.wait_for_change and 0 < self.delay < compute_time:
+                self.overruns += 1
+
+    # Sleep between cycles, waking up early if the termination event triggers
+    def sleep(self, seconds):
+
+        if self.termination_event is not None:
+            self.termination_event.wait(seconds)
+        else:
+            time.sleep(seconds)
+
+    # How long to sleep for before the next cycle
+    def pauseTime(self):
+
+        if self.rate:
+            return self.scheduleNextCycle()
+        else:
+            return self.delay
+
+    # Count the cycle, and measure how late it started relative to its deadline
+    def recordCycleStart(self):
+
+        now = time.monotonic()
+
+        if self.first_cycle_time is None:
+            self.first_cycle_time = now
+        elif self.telemetry:
+            self.period.record(now - self.last_cycle_time)
+        self.last_cycle_time = now
+        self.cycles += 1
+
+        if self.rate:
+            jitter = now - self.next_deadline
+            self.jitter_sum += jitter
+            self.jitter_sum_sq += jitter * jitter
+            self.jitter_max = max(self.jitter_max, jitter)
+
+    # Move the deadline on by one period, applying the overrun policy if the work took
+    # too long, and return how long to sleep for until the next deadline
+    def scheduleNextCycle(self):
+
+        period = 1.0 / self.rate
+        now = time.monotonic()
+        self.next_deadline += period
+
+        if now > self.next_deadline:
+            self.overruns += 1
+
+            # Drop the deadlines that have already passed, and start again on the next one
+            if self.overrun == "skip":
+                missed = math.floor((now - self.next_deadline) / period) + 1
+                self.next_deadline += missed * period
+                self.skipped_deadlines += missed
+
+        return max(0.0, self.next_deadline - now)
+
+    def getStats(self):
+        """
+        Return a dictionary with the number of cycles run, the achieved rate (cycles per second),
+        and, for fixed-rate services, the mean, standard deviation and maximum jitter (seconds
+        between a deadline and the start of its cycle), the number of overruns and the number
+        of deadlines skipped. skipped_cycles counts the cycles skipped because the inputs had
+        not changed
+        """
+
+        stats = {"name": self.name,
+                 "cycles": self.cycles,
+                 "achieved_rate": None,
+                 "target_rate": self.rate,
+                 "jitter_mean": None,
+                 "jitter_std": None,
+                 "jitter_max": None,
+                 "overruns": self.overruns,
+                 "skipped_deadlines": self.skipped_deadlines,
+                 "skipped_cycles": self.skipped_cycles}
+
+        if self.cycles > 1 and self.last_cycle_time > self.first_cycle_time:
+            stats["achieved_rate"] = (self.cycles - 1) / (self.last_cycle_time - self.first_cycle_time)
+
+        if self.rate and self.cycles:
+            jitter_mean = self.jitter_sum / self.cycles
+            stats["jitter_mean"] = jitter_mean
+            stats["jitter_std"] = math.sqrt(max(0.0, self.jitter_sum_sq / self.cycles - jitter_mean * jitter_mean))
+            stats["jitter_max"] = self.jitter_max
+
+        return stats
+
+    def getTelemetry(self):
+        """
+        Return a snapshot of the compute time, input age and period histograms (see
+        Histogram.snapshot), together with the number of cycles and overruns
+        """
+
+        return {"name": self.name,
+                "cycles": self.cycles,
+                "overruns": self.overruns,
+                "compute_time": self.compute_time.snapshot(),
+                "input_age": self.input_age.snapshot() if self.has_inputs else None,
+                "period": self.period.snapshot()}
 
     # Take in a bus or a tuple of buses, and store their
     # messages into a list
@@ -127,12 +1025,58 @@ class ConsumerProducer:
 
         return values
 
+    def getLatencyReport(self):
+        """
+        Return a dictionary of end-to-end latency snapshots (see Histogram.snapshot), from the
+        sampling of the data to the end of this service's cycle, keyed by the path of buses the
+        data travelled along, e.g. "Grayscale sensor bus -> Grayscale interpreter bus -> Robot Control"
+        """
+
+        report = {}
+        for path, histogram in self.path_latency.items():
+            report[" -> ".join(path + (self.name,))] = histogram.snapshot()
+
+        return report
+
+    # Take in a bus or a tuple of buses, and collect the origin times of the
+    # messages on the traced ones into a dictionary keyed by path
+    def collectbusesToOrigins(self, buses):
+
+        origins = {}
+        for p in ensureTuple(buses):
+            if getattr(p, "trace_age", False):
+                origins.update(p.origins)
+
+        return origins
+
+    # Take in a bus or a tuple of buses, and store their sequence numbers into a list
+    def collectbusesToSequences(self, buses):
+
+        return [p.sequence for p in ensureTuple(buses)]
+
+    # Block until any of the input buses has been written since the sequence numbers
+    # were recorded, a termination bus has triggered, or the delay runs out
+    def waitForChange(self, condition, sequences):
+
+        timeout = self.delay if self.delay > 0 else None
+
+        # Wake up in time for the deadline of the termination event
+        if self.termination_event is not None:
+            remaining = self.termination_event.remaining()
+            if remaining is not None and (timeout is None or remaining < timeout):
+                timeout = remaining
+
+        with condition:
+            condition.wait_for(
+                lambda: self.collectbusesToSequences(self.input_buses) != sequences or self.checkTerminationbuses(),
+                timeout)
+
     # Take in  a tuple of values and a tuple of buses, and deal the values
     # into the buses
     @log_on_start(DEBUG, "{self.name:s}: Starting dealing values into buses")
     @log_on_error(DEBUG, "{self.name:s}: Encountered an error while dealing values into buses")
     @log_on_end(DEBUG, "{self.name:s}: Finished dealing values into buses")
-    def dealValuesTobuses(self, values, buses):
+    def dealValuesTobuses(self, values, buses, origins=None):
 
         # Wrap buses in a tuple if it isn't one already
         buses = ensureTuple(buses)
@@ -155,18 +1099,28 @@ class ConsumerProducer:
                 values = tuple([values]*len(buses))
 
         for idx, v in enumerate(values):
-            buses[idx].set_message(v, self.name)
+            bus = buses[idx]
+
+            # Traced buses pass the origins on, with themselves added to the path
+            if origins is not None and getattr(bus, "trace_age", False):
+                bus.set_message(v, self.name, {path + (bus.name,): t for path, t in origins.items()})
+            else:
+                bus.set_message(v, self.name)
 
     @log_on_start(DEBUG, "{self.name:s}: Starting to check termination buses")
     @log_on_error(DEBUG, "{self.name:s}: Encountered an error while checking termination buses")
     @log_on_end(DEBUG, "{self.name:s}: Finished checking termination buses")
     def checkTerminationbuses(self):
 
-        # Look at all of the termination buses
-        termination_bus_values = self.collectbusesToValues(self.termination_buses)
+        # Look at all of the termination buses, reading termination events without any locks
+        for bus in self.termination_buses:
+            if isinstance(bus, TerminationEvent):
+                if bus.is_set():
+                    return True
+                continue
 
-        # If any of the termination buses have triggered (gone true or non-negative), signal the loop to end
-        for tbv in termination_bus_values:
+            # If any of the termination buses have triggered (gone true or non-negative), signal the loop to end
+            tbv = bus.get_message(self.name)
             if tbv and tbv >= 0:
                 return True
 
@@ -185,9 +1139,12 @@ class Producer(ConsumerProducer):
                 output_buses,
                 delay=0,
                 termination_buses=Bus(False, "Default producer termination bus"),
-                name="Unnamed producer"):
+                name="Unnamed producer",
+                **kwargs):  # further options passed on to ConsumerProducer
 
-        # Producers don't use an input bus
+        # Producers don't use an input bus, so there are no changes to wait for
+        if kwargs.get("skip_unchanged"):
+            raise ValueError("{0}: producers have no input buses to skip unchanged cycles on".format(name))
         input_buses = Bus(0, "Default producer input bus")
 
         # Match naming convention for this class with its parent class
@@ -202,7 +1159,11 @@ class Producer(ConsumerProducer):
             output_buses,
             delay,
             termination_buses,
-            name)
+            name,
+            **kwargs)
+
+        # The input bus is a placeholder, so its age means nothing
+        self.has_inputs = False
 
 
 class Consumer(ConsumerProducer):
@@ -219,7 +1180,8 @@ class Consumer(ConsumerProducer):
                 input_buses,
                 delay=0,
                 termination_buses=Bus(False, "Default consumer termination bus"),
-                name="Unnamed consumer"):
+                name="Unnamed consumer",
+                **kwargs):  # further options passed on to ConsumerProducer
 
         # Match naming convention for this class with its parent class
         consumer_producer_function = consumer_function
@@ -234,7 +1196,50 @@ class Consumer(ConsumerProducer):
             output_buses,
             delay,
             termination_buses,
-            name)
+            name,
+            **kwargs)
+
+
+class InPlaceProducer(Producer):
+    """
+    Special case of the producer class for ArrayBus outputs, whose function fills the back buffer
+    of the bus in place (it is passed the buffer as its only argument) instead of returning a new
+    array, which is then published. Nothing is allocated for the message on each cycle
+    """
+
+    @log_on_start(DEBUG, "{name:s}: Starting to create in-place producer")
+    @log_on_error(DEBUG, "{name:s}: Encountered an error while creating in-place producer")
+    @log_on_end(DEBUG, "{name:s}: Finished creating in-place producer")
+    def __init__(self,
+                producer_function,  # function that fills in the numpy array it is given
+                output_bus,  # ArrayBus to write to
+                delay=0,
+                termination_buses=Bus(False, "Default producer termination bus"),
+                name="Unnamed in-place producer",
+                **kwargs):  # further options passed on to ConsumerProducer
+
+        if not isinstance(output_bus, ArrayBus):
+            raise TypeError("{0}: in-place producers write to an ArrayBus, not {1}".format(
+                name, type(output_bus).__name__))
+
+        def fill(): producer_function(output_bus.back_buffer())
+
+        super().__init__(
+            fill,
+            output_bus,
+            delay,
+            termination_buses,
+            name,
+            **kwargs)
+
+    def dealValuesTobuses(self, values, buses, origins=None):
+
+        # The function has already filled the buffer in, so it only has to be published
+        for bus in ensureTuple(buses):
+            if origins is not None and bus.trace_age:
+                bus.publish(self.name, {path + (bus.name,): t for path, t in origins.items()})
+            else:
+                bus.publish(self.name)
 
 
 class Timer(Producer):
@@ -253,14 +1258,16 @@ class Timer(Producer):
                 duration=5,  # how many seconds the timer should run for (0 is forever)
                 delay=0,  # how many seconds to sleep for between checking time
                 termination_buses=Bus(False, "Default timer termination bus"),
-                name="Unnamed termination timer"):
+                name="Unnamed termination timer",
+                **kwargs):  # further options passed on to ConsumerProducer
 
         super().__init__(
             self.timer,  # Timer class defines its own producer function
             output_buses,
             delay,
             termination_buses,
-            name)
+            name,
+            **kwargs)
 
         self.duration = duration
         self.t_start = time.time()
@@ -292,14 +1299,19 @@ class Printer(Consumer):
                 delay=0,  # how many seconds to sleep for between printing data
                 termination_buses=Bus(False, "Default printer termination bus"),  # buses to check for termination
                 name="Unnamed termination timer",  # name of this printer
-                print_prefix="Unspecified printer: "):  # prefix for output
+                print_prefix="Unspecified printer: ",  # prefix for output
+                **kwargs):  # further options passed on to ConsumerProducer
+
+        # Output for people can fall behind the services that drive the car
+        kwargs.setdefault("priority", "low")
 
         super().__init__(
             self.print_bus,  # Printer class defines its own printing function
             printer_bus,
             delay,
             termination_buses,
-            name)
+            name,
+            **kwargs)
 
         self.print_prefix = print_prefix
 
@@ -322,6 +1334,59 @@ class Printer(Consumer):
         print(output_string)                               # Print the formatted output
 
 
+class TelemetryReporter(Consumer):
+    """
+    TelemetryReporter is a consumer that prints the timing telemetry of a set of services at
+    specified intervals: cycles, overruns, and the median and 99th percentile of the compute
+    time, input age and period of each service, in milliseconds
+    """
+
+    @log_on_start(DEBUG, "{name:s}: Starting to create telemetry reporter")
+    @log_on_error(DEBUG, "{name:s}: Encountered an error while creating telemetry reporter")
+    @log_on_end(DEBUG, "{name:s}: Finished creating telemetry reporter")
+    def __init__(self,
+                services,  # list of services whose telemetry should be printed
+                delay=1,  # how many seconds to sleep for between reports
+                termination_buses=Bus(False, "Default reporter termination bus"),  # buses to check for termination
+                name="Unnamed telemetry reporter",  # name of this reporter
+                **kwargs):  # further options passed on to ConsumerProducer
+
+        # Output for people can fall behind the services that drive the car
+        kwargs.setdefault("priority", "low")
+
+        super().__init__(
+            self.report,  # TelemetryReporter class defines its own reporting function
+            Bus(0, "Default reporter input bus"),  # the telemetry is read from the services, not from a bus
+            delay,
+            termination_buses,
+            name,
+            **kwargs)
+
+        self.services = services
+
+    @staticmethod
+    def format_ms(snapshot, key):
+
+        if snapshot is None or snapshot[key] is None:
+            return "-"
+        return "{0:.2f}".format(snapshot[key] * 1000)
+
+    def report(self, _input_value):
+
+        lines = ["{0:<36}{1:>8}{2:>9}  {3:>17}  {4:>17}  {5:>17}".format(
+            "service", "cycles", "overruns", "compute p50/p99", "input age p50/p99", "period p50/p99")]
+
+        for service in self.services:
+            t = service.getTelemetry()
+            columns = []
+            for key in ("compute_time", "input_age", "period"):
+                columns.append(self.format_ms(t[key], "p50") + "/" + self.format_ms(t[key], "p99"))
+            lines.append("{0:<36}{1:>8}{2:>9}  {3:>17}  {4:>17}  {5:>17}".format(
+                t["name"][:36], t["cycles"], t["overruns"], *columns))
+
+        print("\n".join(lines))
+
+
 @log_on_start(DEBUG, "runConcurrently: Starting concurrent execution")
 @log_on_error(DEBUG, "runConcurrently: Encountered an error during concurrent execution")
 @log_on_end(DEBUG, "runConcurrently: Finished concurrent execution")
@@ -343,3 +1408,155 @@ def runConcurrently(producer_consumer_list):
     # Loop over the executors that were created above, running their result methods
     for e in executor_list:
         e.result()
+
+
+def topologicalOrder(producer_consumer_list):
+    """
+    Order a set of services so that every service comes after the services that write to its
+    input buses, keeping the given order where there is a choice. Termination buses do not count
+    as connections. Raises a ValueError if the data buses connect the services in a cycle
+    """
+
+    # A service depends on every other service that writes to one of its input buses
+    dependencies = []
+    for cp in producer_consumer_list:
+        dependencies.append({idx for idx, other in enumerate(producer_consumer_list)
+                             if other is not cp
+                             and any(bus is output for bus in cp.input_buses for output in other.output_buses)})
+
+    # Repeatedly take the first service whose dependencies have all been placed
+    order = []
+    placed = set()
+    while len(order) < len(producer_consumer_list):
+        for idx, cp in enumerate(producer_consumer_list):
+            if idx not in placed and dependencies[idx] <= placed:
+                order.append(cp)
+                placed.add(idx)
+                break
+        else:
+            cycle = [cp.name for idx, cp in enumerate(producer_consumer_list) if idx not in placed]
+            raise ValueError("topologicalOrder: services are connected in a cycle: {0}".format(", ".join(cycle)))
+
+    return order
+
+
+class NullLock:
+    """
+    Stand-in for a readerwriterlock lock when all readers and writers run in one thread
+    """
+
+    def gen_rlock(self):
+        return contextlib.nullcontext()
+
+    def gen_wlock(self):
+        return contextlib.nullcontext()
+
+
+def sleepUntilTerminated(events, condition, seconds):
+    """
+    Sleep for up to seconds, returning early if any of the termination events triggers. The
+    condition variable must be subscribed to all of them
+    """
+
+    # The events only trigger on their deadlines when they are checked, so do not sleep past the first one
+    for event in events:
+        remaining = event.remaining()
+        if remaining is not None and remaining < seconds:
+            seconds = remaining
+
+    with condition:
+        # Check while holding the condition, so that a trigger in between is not missed
+        if not any(event.is_set() for event in events):
+            condition.wait(seconds)
+
+
+@log_on_start(DEBUG, "runTopologically: Starting topologically ordered execution")
+@log_on_error(DEBUG, "runTopologically: Encountered an error during topologically ordered execution")
+@log_on_end(DEBUG, "runTopologically: Finished topologically ordered execution")
+def runTopologically(producer_consumer_list, locked_buses=()):
+    """
+    runTopologically executes a set of ConsumerProducer functions cooperatively in the calling
+    thread. The services are put in dependency order (see topologicalOrder), and every pass over
+    them runs each service that is due: fixed-rate and delay-based services when their deadline
+    or delay is up, and wait_for_change services when one of their inputs has been written (or
+    their delay has run out). Data therefore flows from sensor to actuator within a single pass.
+    Since no other service touches the buses while it runs, their locks are swapped for NullLocks
+    and restored at the end. Buses that are also written or read by threads outside the graph,
+    such as the bus a GrayscaleSampler publishes into, must be listed in locked_buses (as buses
+    or by name) to keep their locks. The termination buses of every service are checked on every
+    pass, and each service stops once one of them triggers
+    """
+
+    order = topologicalOrder(producer_consumer_list)
+
+    # Collect the buses that have readerwriterlock locks, and take the locks out of the hot path
+    buses = {}
+    for cp in order:
+        for bus in cp.input_buses + cp.output_buses + cp.termination_buses:
+            if hasattr(bus, "lock") and not any(bus is b or bus.name == b for b in locked_buses):
+                buses[id(bus)] = bus
+    saved_locks = {bus_id: bus.lock for bus_id, bus in buses.items()}
+
+    # Wake the pass loop when any of the termination events triggers
+    events = []
+    for cp in order:
+        if cp.termination_event is not None and all(cp.termination_event is not e for e in events):
+            events.append(cp.termination_event)
+    termination_condition = threading.Condition()
+    for event in events:
+        event.subscribe(termination_condition)
+
+    try:
+        for bus in buses.values():
+            bus.lock = NullLock()
+
+        # Every service is due straight away
+        now = time.monotonic()
+        next_due = {}
+        for cp in order:
+            cp.startSchedule()
+            next_due[cp] = now
+
+        active = list(order)
+        while active:
+
+            for cp in list(active):
+
+                # Check if the service should terminate, which is cheap without the locks
+                if cp.checkTerminationbuses():
+                    active.remove(cp)
+                    continue
+
+                # Run when the deadline has come, or the inputs have changed for event-driven services
+                due = time.monotonic() >= next_due[cp]
+                if not due and cp.wait_for_change:
+                    due = cp.collectbusesToSequences(cp.input_buses) != cp.input_sequences
+                if not due:
+                    continue
+
+                input_values = cp.beginCycle()
+                if input_values is not None:
+                    output_values = cp.consumer_producer_function(*input_values)
+                    cp.endCycle(output_values)
+
+                # Event-driven services wait at most their delay, or until their inputs change
+                if cp.wait_for_change:
+                    next_due[cp] = time.monotonic() + cp.delay if cp.delay > 0 else math.inf
+                else:
+                    next_due[cp] = time.monotonic() + cp.pauseTime()
+
+            # Sleep until the next service is due. If every service is waiting for changes
+            # with no time limit, only another thread can write the buses, so poll for that.
+            # The sleep is cut short if the termination event of any remaining service triggers
+            if active:
+                wake_time = min(next_due[cp] for cp in active)
+                if wake_time == math.inf:
+                    wake_time = time.monotonic() + 0.01
+                sleepUntilTerminated([cp.termination_event for cp in active if cp.termination_event is not None],
+                                     termination_condition, max(0.0, wake_time - time.monotonic()))
+
+    finally:
+        for bus_id, bus in buses.items():
+            bus.lock = saved_locks[bus_id]
+        for event in events:
+            event.unsubscribe(termination_condition)
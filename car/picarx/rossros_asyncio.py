@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+"""
+asyncio-based execution for RossROS graphs.
+
+runConcurrently needs one OS thread per service, each of which spends most of its time asleep.
+runAsync runs the same Producer/Consumer/ConsumerProducer/Timer/Printer objects as coroutines on
+a single event loop instead: the sleeps become awaits, and only the service functions that block
+on hardware are handed to a small, bounded thread pool. Termination buses are checked at the
+start of every cycle, exactly as in the threaded loop.
+
+By default the functions of plain Producers and Consumers (the sensor and actuator ends of a
+graph) are offloaded to the pool, and those of ConsumerProducers, Timers and Printers run on the
+event loop. The offload argument lists the services to offload explicitly.
+"""
+
+import asyncio
+import concurrent.futures
+
+import rossros as rr
+from rossros import log_on_start, log_on_end, log_on_error, DEBUG
+
+
+class AsyncWakeup:
+    """
+    Stand-in for a condition variable that can be passed to Bus.subscribe, and sets an asyncio
+    event on the loop when the bus is written from any thread
+    """
+
+    def __init__(self, loop):
+
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def notify_all(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+def isBlockingService(cp):
+    """
+    Default choice of services to offload: Producers and Consumers talk to hardware,
+    Timers, Printers and ConsumerProducers only compute
+    """
+
+    return isinstance(cp, (rr.Producer, rr.Consumer)) and not isinstance(cp, (rr.Timer, rr.Printer))
+
+
+async def waitForChangeAsync(cp, wakeup, sequences):
+    """
+    Wait until one of the input buses of the service has been written since the sequence
+    numbers were recorded, a termination bus has triggered, or the delay runs out
+    """
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + cp.delay if cp.delay > 0 else None
+
+    # Wake up in time for the deadline of the termination event
+    if cp.termination_event is not None:
+        remaining = cp.termination_event.remaining()
+        if remaining is not None and (deadline is None or loop.time() + remaining < deadline):
+            deadline = loop.time() + remaining
+
+    while True:
+        wakeup.event.clear()
+
+        # Check after clearing the event, so that a write in between is not missed
+        if cp.collectbusesToSequences(cp.input_buses) != sequences or cp.checkTerminationbuses():
+            return
+
+        timeout = None if deadline is None else deadline - loop.time()
+        if timeout is not None and timeout <= 0:
+            return
+
+        try:
+            await asyncio.wait_for(wakeup.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return
+
+
+async def sleepAsync(cp, wakeup, seconds):
+    """
+    Sleep between cycles, waking up early if the termination event of the service triggers,
+    as ConsumerProducer.sleep does in the threaded loop
+    """
+
+    event = cp.termination_event
+    if event is None:
+        await asyncio.sleep(seconds)
+        return
+
+    # The event only triggers on its deadline when it is checked, so do not sleep past it
+    remaining = event.remaining()
+    if remaining is not None:
+        seconds = min(seconds, remaining)
+
+    wakeup.event.clear()
+
+    # Check after clearing the event, so that a trigger in between is not missed
+    if event.is_set():
+        return
+
+    try:
+        await asyncio.wait_for(wakeup.event.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def runService(cp, executor=None):
+    """
+    Coroutine version of ConsumerProducer.__call__. If an executor is given, the service
+    function is run in it, otherwise it is called directly on the event loop
+    """
+
+    loop = asyncio.get_running_loop()
+
+    # Ask the input and termination buses to wake this service up when they change, or
+    # the termination event to cut its sleep short when it triggers
+    wakeup = AsyncWakeup(loop)
+    if cp.wait_for_change:
+        notifiers = cp.input_buses + cp.termination_buses
+    elif cp.termination_event is not None:
+        notifiers = [cp.termination_event]
+    else:
+        notifiers = []
+    for notifier in notifiers:
+        notifier.subscribe(wakeup)
+
+    try:
+        await runCycles(cp, wakeup, executor)
+    finally:
+        # Stop the buses notifying this run, so that restarting the service does not pile up subscribers
+        for notifier in notifiers:
+            notifier.unsubscribe(wakeup)
+
+
+async def runCycles(cp, wakeup, executor):
+    """
+    Coroutine version of ConsumerProducer.runCycles
+    """
+
+    loop = asyncio.get_running_loop()
+    cp.startSchedule()
+
+    while True:
+
+        # Check if the loop should terminate
+        if cp.checkTerminationbuses():
+            break
+
+        # Collect all of the values from the input buses into a list
+        input_values = cp.beginCycle()
+
+        # Nothing new on the input buses, so nothing to do this cycle
+        if input_values is not None:
+
+            # Get the output value or tuple of values corresponding to the inputs
+            if executor is not None:
+                output_values = await loop.run_in_executor(executor, cp.consumer_producer_function, *input_values)
+            else:
+                output_values = cp.consumer_producer_function(*input_values)
+
+            # Deal the values into the output buses
+            cp.endCycle(output_values)
+
+        # Wait for new data, sleep until the next deadline, or pause for set amount of time
+        if cp.wait_for_change:
+            await waitForChangeAsync(cp, wakeup, cp.input_sequences)
+        else:
+            await sleepAsync(cp, wakeup, cp.pauseTime())
+
+
+async def runServices(producer_consumer_list, offload, max_workers):
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        # Create a coroutine for each service, giving the blocking ones the thread pool
+        coroutine_list = []
+        for cp in producer_consumer_list:
+            coroutine_list.append(runService(cp, executor if cp in offload else None))
+
+        # Run all of the services until they have all finished, keeping any errors
+        results = await asyncio.gather(*coroutine_list, return_exceptions=True)
+
+    # Raise the first error, as runConcurrently does once all services have stopped
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+@log_on_start(DEBUG, "runAsync: Starting asyncio execution")
+@log_on_error(DEBUG, "runAsync: Encountered an error during asyncio execution")
+@log_on_end(DEBUG, "runAsync: Finished asyncio execution")
+def runAsync(producer_consumer_list, offload=None, max_workers=2):
+    """
+    runAsync executes a set of ConsumerProducer functions as coroutines on one asyncio event loop,
+    running the functions of the offloaded services in a thread pool of at most max_workers threads
+    """
+
+    if offload is None:
+        offload = [cp for cp in producer_consumer_list if isBlockingService(cp)]
+
+    asyncio.run(runServices(producer_consumer_list, offload, max_workers))
+
+
+if __name__ == "__main__":
+
+    import math
+    import time
+
+    # The signal generators and multiplier from rr_demo.py, run on a single event loop
+    def square():
+        return (2 * math.floor(time.time() % 2)) - 1
+
+    def sawtooth():
+        return time.time() % 1
+
+    def mult(a, b):
+        return a * b
+
+    bSquare = rr.Bus(square(), "Square wave bus")
+    bSawtooth = rr.Bus(sawtooth(), "Sawtooth wave Bus")
+    bMultiplied = rr.Bus(sawtooth() * square(), "Multiplied wave bus")
+    bTerminate = rr.Bus(0, "Termination Bus")
+
+    readSquare = rr.Producer(square, bSquare, 0.05, bTerminate, "Read square wave signal")
+    readSawtooth = rr.Producer(sawtooth, bSawtooth, 0.05, bTerminate, "Read sawtooth wave signal")
+    multiplyWaves = rr.ConsumerProducer(mult, (bSquare, bSawtooth), bMultiplied, 0.05, bTerminate, "Multiply Waves")
+    printBuses = rr.Printer((bSquare, bSawtooth, bMultiplied, bTerminate), 0.25, bTerminate,
+                            "Print raw and derived data", "Data bus readings are: ")
+    terminationTimer = rr.Timer(bTerminate, 3, 0.01, bTerminate, "Termination timer")
+
+    runAsync([readSquare, readSawtooth, multiplyWaves, printBuses, terminationTimer])
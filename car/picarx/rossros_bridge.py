@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+"""
+Bridging RossROS buses between processes and hosts over datagram sockets.
+
+A BusSender is a Consumer that publishes the messages on its input buses over a UDP or
+Unix-domain datagram socket, and a BusReceiver is a Producer on the other end that mirrors them
+into local buses with the same names. Perception can then run on a laptop and control on the car,
+or a graph can be split across processes, without changing the services on either side.
+
+Each cycle, the sender packs every input bus that has been written since its last cycle into as
+few datagrams as possible, so a bus written several times between cycles is sent once, with its
+latest message. A datagram is a header (magic bytes, a session number picked when the sender is
+created and the number of entries) followed by the entries, each of which is the sequence number
+of the message on that bus, the bus name and the payload packed as in rossros_record. Datagrams
+can be lost or arrive out of order, so the receiver drops any entry that is not newer than the
+last one it took for the same bus and session. The sender also repeats all of its buses every
+resend_interval seconds, so that a bus that rarely changes is not left stale by a lost datagram.
+
+Unlike a bus log, the bridge never pickles: anyone who can reach the receiver's port could
+otherwise run code on the car by sending it a pickle. Messages have to be None, booleans,
+numbers, numeric numpy arrays or flat lists and tuples of numbers; the sender raises a
+ValueError for anything else, and the receiver counts datagrams with pickled (or otherwise
+undecodable) payloads in malformed and drops them.
+
+Addresses are (host, port) tuples for UDP and file system paths for Unix-domain sockets:
+
+    sender:    BusSender(buses, datagramSocket(), ("192.168.1.20", 5005), ...)
+    receiver:  BusReceiver(datagramSocket(("0.0.0.0", 5005)), buses, ...)
+"""
+
+import os
+import random
+import socket
+import struct
+import time
+
+import rossros as rr
+from rossros import log_on_start, log_on_end, log_on_error, DEBUG
+from rossros_record import packMessage, unpackMessage
+
+
+MAGIC = b"RRBR"
+DATAGRAM = struct.Struct("<4sIH")  # magic, session, number of entries
+ENTRY = struct.Struct("<QHBI")  # sequence, name length, payload tag, payload length
+
+# Largest datagram the sender builds, below the UDP limit of 65507 bytes
+MAX_DATAGRAM = 65000
+
+
+def datagramSocket(bind_address=None):
+    """
+    Create a UDP socket, or a Unix-domain datagram socket if the address is a path, and bind it
+    to the address if one is given. A stale socket file left at the path is removed first
+    """
+
+    if isinstance(bind_address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if os.path.exists(bind_address):
+            os.unlink(bind_address)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    if bind_address is not None:
+        sock.bind(bind_address)
+
+    return sock
+
+
+def packDatagrams(session, entries):
+    """Pack (sequence, bus name, message) entries into a list of datagrams"""
+
+    datagrams = []
+    packed_entries = []
+    size = DATAGRAM.size
+
+    for sequence, name, message in entries:
+        tag, payload = packMessage(message, allow_pickle=False)
+        name = name.encode()
+        entry = ENTRY.pack(sequence, len(name), tag, len(payload)) + name + payload
+
+        if DATAGRAM.size + len(entry) > MAX_DATAGRAM:
+            raise ValueError("Message for bus {0} is too large for a datagram".format(name.decode()))
+
+        # Start a new datagram once this one is full
+        if size + len(entry) > MAX_DATAGRAM:
+            datagrams.append(DATAGRAM.pack(MAGIC, session, len(packed_entries)) + b"".join(packed_entries))
+            packed_entries = []
+            size = DATAGRAM.size
+
+        packed_entries.append(entry)
+        size += len(entry)
+
+    if packed_entries:
+        datagrams.append(DATAGRAM.pack(MAGIC, session, len(packed_entries)) + b"".join(packed_entries))
+
+    return datagrams
+
+
+def unpackDatagram(datagram):
+    """
+    Return the session and the (sequence, bus name, message) entries of a datagram. Raises a
+    ValueError for datagrams that are not from a BusSender, and for pickled payloads
+    """
+
+    magic, session, count = DATAGRAM.unpack_from(datagram, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a bus bridge datagram")
+
+    entries = []
+    offset = DATAGRAM.size
+    for _ in range(count):
+        sequence, name_length, tag, payload_length = ENTRY.unpack_from(datagram, offset)
+        offset += ENTRY.size
+        name = datagram[offset:offset + name_length].decode()
+        offset += name_length
+        message = unpackMessage(tag, datagram[offset:offset + payload_length], allow_pickle=False)
+        offset += payload_length
+        entries.append((sequence, name, message))
+
+    return session, entries
+
+
+class BusSender(rr.Consumer):
+    """
+    Consumer that publishes the messages on its input buses to a BusReceiver over a datagram
+    socket. Errors from the socket (such as no receiver listening yet) are counted in send_errors
+    rather than stopping the service, since the receiver may come up later
+    """
+
+    @log_on_start(DEBUG, "{name:s}: Starting to create bus sender")
+    @log_on_error(DEBUG, "{name:s}: Encountered an error while creating bus sender")
+    @log_on_end(DEBUG, "{name:s}: Finished creating bus sender")
+    def __init__(self,
+                input_buses,  # buses to publish
+                sock,  # datagram socket to send from
+                address=None,  # address of the receiver, None if the socket is connected
+                delay=0,
+                termination_buses=rr.Bus(False, "Default sender termination bus"),
+                name="Unnamed bus sender",
+                resend_interval=1.0,  # seconds after which all buses are sent again, changed or not
+                **kwargs):  # further options passed on to ConsumerProducer
+
+        super().__init__(
+            self.send,  # BusSender class defines its own consumer function
+            input_buses,
+            delay,
+            termination_buses,
+            name,
+            **kwargs)
+
+        self.sock = sock
+        self.address = address
+        self.resend_interval = resend_interval
+
+        # A new session tells the receiver to forget the sequence numbers of an earlier sender
+        self.session = random.getrandbits(32)
+        self.sent_sequences = [None] * len(self.input_buses)
+        self.bridge_sequences = [0] * len(self.input_buses)
+        self.t_last_resend = time.monotonic()
+
+        self.datagrams = 0
+        self.messages = 0
+        self.send_errors = 0
+
+    def send(self, *values):
+
+        now = time.monotonic()
+        resend = now - self.t_last_resend >= self.resend_interval
+        if resend:
+            self.t_last_resend = now
+
+        # Coalesce every bus that has changed since the last cycle into the same datagrams
+        entries = []
+        for idx, (bus, message) in enumerate(zip(self.input_buses, values)):
+            sequence = self.input_sequences[idx]
+            if sequence == self.sent_sequences[idx] and not resend:
+                continue
+            if sequence != self.sent_sequences[idx]:
+                self.sent_sequences[idx] = sequence
+                self.bridge_sequences[idx] += 1
+            entries.append((self.bridge_sequences[idx], bus.name, message))
+
+        for datagram in packDatagrams(self.session, entries):
+            try:
+                if self.address is None:
+                    self.sock.send(datagram)
+                else:
+                    self.sock.sendto(datagram, self.address)
+                self.datagrams += 1
+            except OSError:
+                self.send_errors += 1
+
+        self.messages += len(entries)
+
+
+class BusReceiver(rr.Producer):
+    """
+    Producer that writes the messages received from a BusSender into the output buses with the
+    same names. Each cycle takes every datagram waiting on the socket and writes the newest
+    message for each bus; messages for buses that are not among the output buses are passed over.
+    Entries that are not newer than the last message taken for their bus (late datagrams, and the
+    sender's periodic repeats of messages that did arrive) are counted in dropped_stale,
+    datagrams that cannot be decoded (including any with pickled payloads) in malformed, and
+    socket errors (such as ICMP port unreachable on a connected socket) in receive_errors
+    """
+
+    @log_on_start(DEBUG, "{name:s}: Starting to create bus receiver")
+    @log_on_error(DEBUG, "{name:s}: Encountered an error while creating bus receiver")
+    @log_on_end(DEBUG, "{name:s}: Finished creating bus receiver")
+    def __init__(self,
+                sock,  # bound or connected datagram socket to receive on
+                output_buses,  # buses to write the received messages into, matched by name
+                delay=0,
+                termination_buses=rr.Bus(False, "Default receiver termination bus"),
+                name="Unnamed bus receiver",
+                **kwargs):  # further options passed on to ConsumerProducer
+
+        super().__init__(
+            self.receive,  # BusReceiver class defines its own producer function
+            output_buses,
+            delay,
+            termination_buses,
+            name,
+            **kwargs)
+
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.buses = {bus.name: bus for bus in self.output_buses}
+
+        self.session = None
+        self.last_sequences = {}
+
+        self.datagrams = 0
+        self.messages = 0
+        self.dropped_stale = 0
+        self.malformed = 0
+        self.receive_errors = 0
+
+    def receive(self):
+        """Return the (bus, message) pairs to write this cycle"""
+
+        latest = {}
+        while True:
+            try:
+                datagram = self.sock.recv(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # Leave the rest for the next cycle rather than stopping the service
+                self.receive_errors += 1
+                break
+
+            try:
+                session, entries = unpackDatagram(datagram)
+            except (ValueError, TypeError, struct.error):
+                self.malformed += 1
+                continue
+            self.datagrams += 1
+
+            # A restarted sender numbers its messages from the beginning again
+            if session != self.session:
+                self.session = session
+                self.last_sequences = {}
+
+            for sequence, name, message in entries:
+                if name not in self.buses:
+                    continue
+                if sequence <= self.last_sequences.get(name, 0):
+                    self.dropped_stale += 1
+                    continue
+                self.last_sequences[name] = sequence
+                latest[name] = message
+
+        self.messages += len(latest)
+
+        return [(self.buses[name], message) for name, message in latest.items()]
+
+    def dealValuesTobuses(self, values, buses, origins=None):
+
+        # Only the buses with a new message this cycle are written
+        for bus, message in values:
+            super().dealValuesTobuses(message, bus, origins)
+
+
+if __name__ == "__main__":
+
+    import numpy as np
+
+    # Loopback test: a sensor graph and a control graph joined by a pair of connected
+    # Unix-domain datagram sockets, so no network is needed
+    send_sock, receive_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def sample():
+        return np.random.normal(1.0, 0.1, 3)
+
+    def count():
+        count.n += 1
+        return count.n
+    count.n = 0
+
+    # Sending side
+    bSample = rr.Bus(sample(), "Grayscale sample bus")
+    bCount = rr.Bus(0, "Count bus")
+    bTerminate = rr.Bus(0, "Termination bus")
+
+    readSample = rr.Producer(sample, bSample, 0.02, bTerminate, "Sample grayscale")
+    countUp = rr.Producer(count, bCount, 0.1, bTerminate, "Count")
+    sendBuses = BusSender((bSample, bCount), send_sock, None, 0.01, bTerminate, "Send buses")
+
+    # Receiving side, with buses of the same names
+    bRemoteSample = rr.Bus(np.zeros(3), "Grayscale sample bus")
+    bRemoteCount = rr.Bus(0, "Count bus")
+
+    receiveBuses = BusReceiver(receive_sock, (bRemoteSample, bRemoteCount), 0.01, bTerminate, "Receive buses")
+    printRemote = rr.Printer(bRemoteCount, 0.25, bTerminate, "Print received count", "Received count: ")
+    terminationTimer = rr.Timer(bTerminate, 2, 0.01, bTerminate, "Termination timer")
+
+    rr.runConcurrently([readSample, countUp, sendBuses, receiveBuses, printRemote, terminationTimer])
+
+    print("Sent {0} messages in {1} datagrams, received {2} messages in {3} datagrams, {4} stale".format(
+        sendBuses.messages, sendBuses.datagrams, receiveBuses.messages, receiveBuses.datagrams,
+        receiveBuses.dropped_stale))
+    print("Last count sent {0}, received {1}".format(bCount.get_message(), bRemoteCount.get_message()))
+    print("Last sample sent {0}, received {1}".format(bSample.get_message(), bRemoteSample.get_message()))
+
+    # Datagrams that arrive out of order are dropped
+    session = 1
+    sock_a, sock_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    bLate = rr.Bus(0, "Count bus")
+    receiveLate = BusReceiver(sock_b, bLate, 0, bTerminate, "Receive out of order")
+    for sequence in (1, 3, 2):
+        for datagram in packDatagrams(session, [(sequence, "Count bus", sequence * 10)]):
+            sock_a.send(datagram)
+    receiveLate.dealValuesTobuses(receiveLate.receive(), receiveLate.output_buses)
+    print("Out of order: kept {0}, dropped {1} stale".format(bLate.get_message(), receiveLate.dropped_stale))
+
+    # Pickled payloads are refused rather than unpickled
+    import pickle
+    from rossros_record import TAG_PICKLE
+    name = b"Count bus"
+    payload = pickle.dumps([1, 2, 3])
+    sock_a.send(DATAGRAM.pack(MAGIC, session, 1) + ENTRY.pack(10, len(name), TAG_PICKLE, len(payload)) + name + payload)
+    receiveLate.dealValuesTobuses(receiveLate.receive(), receiveLate.output_buses)
+    print("Pickled payload: kept {0}, {1} malformed".format(bLate.get_message(), receiveLate.malformed))
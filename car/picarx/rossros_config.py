@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+"""
+Declarative configuration of RossROS graphs.
+
+Instead of wiring buses and services by hand, as line_follow_rr.py and rr_demo.py do, a graph can
+be described in a JSON (or, if PyYAML is installed, YAML) spec and built and run with
+
+    python3 rossros_config.py line_follow_rr.json [--check]
+
+so that alternative layouts, rates and executors can be tried by editing the spec. The spec has
+these sections:
+
+    objects    Objects to create first, by name: {"class": import path, "kwargs": {...}}
+    buses      Buses by name: {"type": rossros class name or import path, "initial": value,
+               "initial_call": function to call for the initial value, and any further
+               keyword arguments of the bus}. The bus name defaults to its key
+    services   List of services: {"type": "Producer", "InPlaceProducer", "ConsumerProducer",
+               "Consumer", "Timer" or "Printer", "name", "function", "inputs", "outputs",
+               "delay", "termination", and "options" with any further keyword arguments,
+               such as rate, wait_for_change, skip_unchanged or priority}
+    executor   "concurrent" (the default), "topological", "async", "multiprocess",
+               "prioritized" or "supervised", with "executor_options" passed on to it
+    on_exit    Functions to call once the executor has returned, such as stopping the motors
+
+Functions are given as import paths ("math.sin") or as methods of the objects
+("Ginterp.get_direction"). Inputs, outputs and termination take a bus name or a list of them.
+
+Before anything runs, the graph is checked: every bus a service names has to be declared, every
+declared bus has to be used, every bus that is read has to be written by a service (termination
+buses excepted), and the data buses must not connect the services in a cycle. All problems are
+reported together in one ValueError. Buses that are written but never read only log a warning.
+"""
+
+import importlib
+import json
+import logging
+
+import rossros as rr
+from rossros import log_on_start, log_on_end, log_on_error, DEBUG
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# The positional arguments each service type takes, ahead of the delay, name and termination buses.
+# "output" is the one bus listed in outputs, for the types that take a single bus rather than a tuple
+SERVICE_ARGUMENTS = {"ConsumerProducer": ("function", "inputs", "outputs"),
+                     "Producer": ("function", "outputs"),
+                     "InPlaceProducer": ("function", "output"),
+                     "Consumer": ("function", "inputs"),
+                     "Timer": ("outputs",),
+                     "Printer": ("inputs",)}
+
+EXECUTORS = {"concurrent": ("rossros", "runConcurrently"),
+             "topological": ("rossros", "runTopologically"),
+             "async": ("rossros_asyncio", "runAsync"),
+             "multiprocess": ("rossros_mp", "runMultiprocess"),
+             "prioritized": ("rossros_priority", "runPrioritized"),
+             "supervised": ("rossros_supervisor", "runSupervised")}
+
+
+def loadSpec(path):
+    """Read a graph spec from a JSON file, or a YAML file if PyYAML is installed"""
+
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ImportError("Reading {0} needs PyYAML, or the spec can be written as JSON".format(path))
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def importObject(path):
+    """Import a module attribute given as "package.module.attribute" """
+
+    module_name, _, attribute = path.rpartition(".")
+    if not module_name:
+        raise ValueError("{0} is not an import path of the form module.attribute".format(path))
+
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def listOf(value):
+    """Bus references can be a single name or a list of names"""
+
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+class Pipeline:
+    """
+    A graph built from a spec: its objects, buses and services by name, and the executor to run
+    them with
+    """
+
+    def __init__(self, spec):
+
+        self.spec = spec
+        self.objects = {}
+        self.buses = {}
+        self.services = []
+
+        unknown = set(spec) - {"objects", "buses", "services", "executor", "executor_options", "on_exit"}
+        if unknown:
+            raise ValueError("Unknown sections in graph spec: {0}".format(", ".join(sorted(unknown))))
+
+        # Check the wiring before creating anything, since the objects may start up hardware
+        self.validate()
+
+        for name, entry in spec.get("objects", {}).items():
+            self.objects[name] = importObject(entry["class"])(*entry.get("args", []), **entry.get("kwargs", {}))
+
+        for name, entry in spec.get("buses", {}).items():
+            self.buses[name] = self.buildBus(name, entry)
+
+        for entry in spec.get("services", []):
+            self.services.append(self.buildService(entry))
+
+    def resolveFunction(self, reference):
+        """Find a function given as a method of one of the objects, or as an import path"""
+
+        head, _, rest = reference.partition(".")
+        if head in self.objects:
+            target = self.objects[head]
+            for attribute in rest.split(".") if rest else []:
+                target = getattr(target, attribute)
+            return target
+
+        return importObject(reference)
+
+    def buildBus(self, name, entry):
+
+        entry = dict(entry)
+        bus_type = entry.pop("type", "Bus")
+        bus_class = getattr(rr, bus_type) if hasattr(rr, bus_type) else importObject(bus_type)
+        entry.setdefault("name", name)
+
+        # A termination event has no initial message
+        if bus_class is rr.TerminationEvent:
+            return bus_class(**entry)
+
+        if "initial_call" in entry:
+            initial_message = self.resolveFunction(entry.pop("initial_call"))()
+        else:
+            initial_message = entry.pop("initial", 0)
+
+        return bus_class(initial_message, **entry)
+
+    def buildService(self, entry):
+
+        service_type = entry.get("type", "ConsumerProducer")
+        if service_type not in SERVICE_ARGUMENTS:
+            raise ValueError("Unknown service type {0}, should be one of {1}".format(
+                service_type, ", ".join(SERVICE_ARGUMENTS)))
+
+        values = {"function": lambda: self.resolveFunction(entry["function"]),
+                  "inputs": lambda: tuple(self.buses[bus] for bus in listOf(entry.get("inputs"))),
+                  "outputs": lambda: tuple(self.buses[bus] for bus in listOf(entry.get("outputs"))),
+                  "output": lambda: self.buses[listOf(entry.get("outputs"))[0]]}
+        args = [values[argument]() for argument in SERVICE_ARGUMENTS[service_type]]
+
+        kwargs = dict(entry.get("options", {}))
+        kwargs["delay"] = entry.get("delay", 0)
+        kwargs["name"] = entry.get("name", "Unnamed " + service_type)
+        termination = tuple(self.buses[bus] for bus in listOf(entry.get("termination")))
+        if termination:
+            kwargs["termination_buses"] = termination
+
+        return getattr(rr, service_type)(*args, **kwargs)
+
+    def validate(self):
+        """Check the buses named by the services against the declared buses"""
+
+        declared = self.spec.get("buses", {})
+        problems = []
+        readers = {}
+        writers = {}
+        termination = set()
+        service_names = []
+
+        for idx, entry in enumerate(self.spec.get("services", [])):
+            service_name = entry.get("name", "service {0}".format(idx))
+            service_names.append(service_name)
+            service_type = entry.get("type", "ConsumerProducer")
+            if service_type not in SERVICE_ARGUMENTS:
+                problems.append("{0} has unknown type {1}".format(service_name, service_type))
+            arguments = SERVICE_ARGUMENTS.get(service_type, ())
+
+            if "function" in arguments and "function" not in entry:
+                problems.append("{0} has no function".format(service_name))
+            if "output" in arguments and len(listOf(entry.get("outputs"))) != 1:
+                problems.append("{0} should have exactly one output".format(service_name))
+
+            for section, users in (("inputs", readers), ("outputs", writers), ("termination", None)):
+                for bus in listOf(entry.get(section)):
+                    if bus not in declared:
+                        problems.append("{0} uses undeclared bus {1}".format(service_name, bus))
+                    elif users is None:
+                        termination.add(bus)
+                    else:
+                        users.setdefault(bus, []).append(service_name)
+
+        for bus in declared:
+            if bus not in readers and bus not in writers and bus not in termination:
+                problems.append("bus {0} is not connected to any service".format(bus))
+            elif bus in readers and bus not in writers and bus not in termination:
+                problems.append("bus {0} is read by {1} but written by no service".format(
+                    bus, ", ".join(readers[bus])))
+            elif bus in writers and bus not in readers and bus not in termination:
+                logging.warning("Graph spec: bus {0} is written by {1} but read by no service".format(
+                    bus, ", ".join(writers[bus])))
+
+        cycle = self.findCycle(service_names)
+        if cycle:
+            problems.append("services are connected in a cycle: {0}".format(", ".join(cycle)))
+
+        if problems:
+            raise ValueError("Graph spec is invalid:\n    " + "\n    ".join(problems))
+
+    def findCycle(self, service_names):
+        """
+        Names of the services left over when the services are put in dependency order, as
+        rr.topologicalOrder does, but from the bus names in the spec so that nothing has to be
+        built first. Empty if the data buses do not connect the services in a cycle
+        """
+
+        services = self.spec.get("services", [])
+        inputs = [set(listOf(entry.get("inputs"))) for entry in services]
+        outputs = [set(listOf(entry.get("outputs"))) for entry in services]
+
+        # A service depends on every other service that writes to one of its input buses
+        dependencies = [{other for other in range(len(services)) if other != idx and inputs[idx] & outputs[other]}
+                        for idx in range(len(services))]
+
+        # Repeatedly place the services whose dependencies have all been placed
+        placed = set()
+        while True:
+            ready = {idx for idx in range(len(services)) if idx not in placed and dependencies[idx] <= placed}
+            if not ready:
+                break
+            placed |= ready
+
+        return [service_names[idx] for idx in range(len(services)) if idx not in placed]
+
+    @log_on_start(DEBUG, "Pipeline: Starting to run graph from spec")
+    @log_on_error(DEBUG, "Pipeline: Encountered an error while running graph from spec")
+    @log_on_end(DEBUG, "Pipeline: Finished running graph from spec")
+    def run(self):
+
+        executor_name = self.spec.get("executor", "concurrent")
+        if executor_name not in EXECUTORS:
+            raise ValueError("Unknown executor {0}, should be one of {1}".format(executor_name, ", ".join(EXECUTORS)))
+        module_name, function_name = EXECUTORS[executor_name]
+        executor = getattr(importlib.import_module(module_name), function_name)
+
+        try:
+            return executor(self.services, **self.spec.get("executor_options", {}))
+        finally:
+            for reference in listOf(self.spec.get("on_exit")):
+                self.resolveFunction(reference)()
+
+
+def buildPipeline(path):
+    """Load a graph spec from a file and build it, checking it on the way"""
+
+    return Pipeline(loadSpec(path))
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build and run a RossROS graph from a JSON or YAML spec")
+    parser.add_argument("spec", help="graph spec file")
+    parser.add_argument("--check", action="store_true", help="only build and check the graph, without running it")
+    args = parser.parse_args()
+
+    pipeline = buildPipeline(args.spec)
+    print("{0}: {1} buses, {2} services, executor {3}".format(
+        args.spec, len(pipeline.buses), len(pipeline.services), pipeline.spec.get("executor", "concurrent")))
+
+    if not args.check:
+        pipeline.run()
@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+"""
+Process-based execution for RossROS graphs.
+
+runConcurrently runs every service in a thread of the same interpreter, so CPU-heavy services
+(camera line detection, numpy interpretation) take turns on the GIL. runMultiprocess instead
+runs each ConsumerProducer in its own process, so they can use separate cores.
+
+Plain Buses live in the memory of one process and are not seen by the others, so every bus that
+is shared between services run this way has to be a SharedBus. A SharedBus holds a fixed-shape
+numpy payload (a scalar by default) in a multiprocessing.shared_memory block, guarded by a
+sequence lock: the writer makes the sequence counter odd while it is writing and even again when
+it is done, and readers retry if the counter was odd or changed while they were copying.
+
+Python has no memory barriers, and numpy stores into shared memory are plain stores, so on a
+weakly ordered CPU such as the ARM cores of a Raspberry Pi another core may see the counter and
+the payload updated in either order, and a lock-free reader could take a half-written payload
+for a complete one. Lock-free reads are therefore only used for scalar payloads, which are a
+single aligned store and cannot be seen half written. Readers of multi-element payloads take the
+write lock, whose acquire and release order the memory accesses on every CPU.
+
+runMultiprocess raises a ValueError if a bus that connects two services is not a SharedBus,
+since the services would otherwise each see their own copy of it and never communicate.
+"""
+
+import atexit
+import inspect
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import rossros as rr
+from rossros import log_on_start, log_on_end, log_on_error, DEBUG
+
+
+class SharedBus:
+    """
+    Bus for passing fixed-shape numpy messages between processes, with the same
+    get_message/set_message interface as rossros.Bus
+    """
+
+    # Bytes reserved at the start of the shared block for the sequence counter and write time
+    HEADER_SIZE = 16
+
+    def __init__(self,
+                initial_message=0,
+                name="Unnamed shared bus",
+                shape=(),  # shape of the numpy payload, () for a scalar
+                dtype=np.float64):  # type of the numpy payload
+
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        # Create the shared block, and make sure it is removed when the creating process exits
+        size = self.HEADER_SIZE + max(1, int(np.prod(self.shape))) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.owner_pid = os.getpid()
+        atexit.register(self.unlink)
+
+        # Writers are serialised across processes, readers never take the lock
+        self.write_lock = multiprocessing.Lock()
+
+        self._attach()
+        self.set_message(initial_message)
+
+    def _attach(self):
+
+        self._counter = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf, offset=0)
+        self._timestamp = np.ndarray((1,), dtype=np.float64, buffer=self.shm.buf, offset=8)
+        self._payload = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf, offset=self.HEADER_SIZE)
+
+    def __getstate__(self):
+
+        # Pass the name of the shared block rather than its contents, for the "spawn" start method
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype, "shm_name": self.shm.name,
+                "owner_pid": self.owner_pid, "write_lock": self.write_lock}
+
+    def __setstate__(self, state):
+
+        self.name = state["name"]
+        self.shape = state["shape"]
+        self.dtype = state["dtype"]
+        self.owner_pid = state["owner_pid"]
+        self.write_lock = state["write_lock"]
+        self.shm = shared_memory.SharedMemory(name=state["shm_name"])
+        self._attach()
+
+    @property
+    def sequence(self):
+        """Number of messages written to the bus"""
+
+        return int(self._counter[0]) // 2
+
+    @property
+    def timestamp(self):
+        """time.monotonic() time of the last write, which is the same clock in every process"""
+
+        return float(self._timestamp[0])
+
+    @log_on_start(DEBUG, "{self.name:s}: Initiating read by {_name:s}")
+    @log_on_error(DEBUG, "{self.name:s}: Error on read by {_name:s}")
+    @log_on_end(DEBUG, "{self.name:s}: Finished read by {_name:s}")
+    def get_message(self, _name='Unspecified function'):
+
+        # Without memory barriers, only a scalar is safe to read without the lock (see the module docstring)
+        if self._payload.size > 1:
+            with self.write_lock:
+                return self._payload.copy()
+
+        while True:
+            start = self._counter[0]
+
+            # The writer is half way through, try again
+            if start & 1:
+                time.sleep(0)
+                continue
+
+            message = self._payload.copy()
+
+            # Nothing was written while copying, so the copy is consistent
+            if self._counter[0] == start:
+                break
+
+        if self.shape == ():
+            message = message.item()
+
+        return message
+
+    @log_on_start(DEBUG, "{self.name:s}: Initiating write by {_name:s}")
+    @log_on_error(DEBUG, "{self.name:s}: Error on write by {_name:s}")
+    @log_on_end(DEBUG, "{self.name:s}: Finished write by {_name:s}")
+    def set_message(self, message, _name='Unspecified function'):
+
+        with self.write_lock:
+            self._counter[0] += 1
+            self._payload[...] = message
+            self._timestamp[0] = time.monotonic()
+            self._counter[0] += 1
+
+    def subscribe(self, condition):
+        """
+        Condition variables cannot be shared between processes, so services waiting for changes
+        on a shared bus pick them up when their wait times out
+        """
+
+        pass
+
+    def unsubscribe(self, condition):
+
+        pass
+
+    def close(self):
+        """Detach this process from the shared block"""
+
+        self._counter = None
+        self._timestamp = None
+        self._payload = None
+        self.shm.close()
+
+    def unlink(self):
+        """Remove the shared block, once all processes have finished with it"""
+
+        if os.getpid() != self.owner_pid:
+            return
+
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def defaultTerminationBus(cp):
+    """The termination bus a service gets when it is built without any, or None if it has no default"""
+
+    parameter = inspect.signature(type(cp).__init__).parameters.get("termination_buses")
+    if parameter is None or parameter.default is inspect.Parameter.empty:
+        return None
+
+    return parameter.default
+
+
+@log_on_start(DEBUG, "runMultiprocess: Starting multiprocess execution")
+@log_on_error(DEBUG, "runMultiprocess: Encountered an error during multiprocess execution")
+@log_on_end(DEBUG, "runMultiprocess: Finished multiprocess execution")
+def runMultiprocess(producer_consumer_list, start_method="fork"):
+    """
+    runMultiprocess runs each of a set of ConsumerProducer functions in its own process, and
+    waits for all of them to finish. The default "fork" start method lets the processes inherit
+    the services and the hardware objects they use, without having to pickle them. Every bus that
+    more than one of the services uses has to be a SharedBus, or a ValueError is raised, apart from
+    the default termination buses of services built without termination buses
+    """
+
+    # Buses that connect services in different processes have to live in shared memory. The
+    # default termination buses of the service classes are left out: every service built without
+    # termination buses shares one of them, but as long as no service writes to it, it never
+    # changes and each process can keep its own copy
+    written = {id(bus) for cp in producer_consumer_list for bus in cp.output_buses}
+    defaults = {id(bus) for bus in map(defaultTerminationBus, producer_consumer_list)
+                if bus is not None and id(bus) not in written}
+    users = {}
+    for cp in producer_consumer_list:
+        for bus in set(cp.input_buses + cp.output_buses + cp.termination_buses):
+            if id(bus) not in defaults:
+                users.setdefault(id(bus), (bus, []))[1].append(cp.name)
+    unshared = ["{0} ({1})".format(getattr(bus, "name", bus), ", ".join(names))
+                for bus, names in users.values() if len(names) > 1 and not isinstance(bus, SharedBus)]
+    if unshared:
+        raise ValueError("runMultiprocess: buses shared between services have to be SharedBuses: {0}".format(
+            "; ".join(unshared)))
+
+    context = multiprocessing.get_context(start_method)
+
+    # Create one process per service
+    process_list = []
+    for cp in producer_consumer_list:
+        process_list.append(context.Process(target=cp, name=cp.name))
+
+    for p in process_list:
+        p.start()
+
+    # Wait for all of the processes to finish, then report any that failed
+    for p in process_list:
+        p.join()
+
+    failed = [p.name for p in process_list if p.exitcode != 0]
+    if failed:
+        raise RuntimeError("runMultiprocess: services exited with an error: {0}".format(", ".join(failed)))
+
+
+if __name__ == "__main__":
+
+    # Stand-in for a CPU-heavy interpretation stage: a noisy grayscale triplet, and an interpreter
+    # that burns a few milliseconds of numpy work before comparing the outer channels
+    def sample():
+        return np.random.normal(1.0, 0.1, 3)
+
+    def interpret(data):
+        work = np.outer(data, data)
+        for _ in range(2000):
+            work = np.tanh(work)
+        return float(data[2] - data[0])
+
+    bSample = SharedBus(np.ones(3), "Grayscale sample bus", shape=(3,))
+    bInterp = SharedBus(0.0, "Interpretation bus")
+    bTerminate = SharedBus(0, "Termination bus")
+
+    readSample = rr.Producer(sample, bSample, 0.01, bTerminate, "Sample grayscale")
+    interpretSample = rr.ConsumerProducer(interpret, bSample, bInterp, 0.0, bTerminate, "Interpret grayscale")
+    printInterp = rr.Printer(bInterp, 0.25, bTerminate, "Print interpretation", "Interpretation: ")
+    terminationTimer = rr.Timer(bTerminate, 3, 0.01, bTerminate, "Termination timer")
+
+    runMultiprocess([readSample, interpretSample, printInterp, terminationTimer])
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+"""
+Prioritized execution for RossROS graphs.
+
+runConcurrently runs every service in an equal thread, so a CPU-hungry camera service can push
+the steering service off its schedule. runPrioritized runs the same services, one thread each,
+but first applies the priority class and CPU affinity each service declares (the priority and
+cpu_affinity options of ConsumerProducer) to the thread it runs in:
+
+    realtime  SCHED_FIFO at priority 50, or nice -10 if real-time scheduling is not permitted
+    high      nice -5
+    normal    nice 0
+    low       nice 10
+
+Linux applies scheduling policies, nice values and affinities to single threads, so the settings
+of one service do not leak into the others. Raising the priority of a thread needs root or
+CAP_SYS_NICE; without them, the service falls back to the best setting it is allowed and carries
+on, and a warning is logged. Operating systems without these calls leave the thread as it is.
+What was applied to each service is kept in its applied_scheduling attribute, and
+schedulingReport() collects them.
+
+SCHED_FIFO threads are never preempted by ordinary ones, so the realtime class is only for short,
+periodic services that sleep between cycles, never for one that busy-loops.
+"""
+
+import concurrent.futures
+import logging
+import os
+import threading
+
+import rossros as rr
+from rossros import log_on_start, log_on_end, log_on_error, DEBUG
+
+
+# How each priority class is applied: the SCHED_FIFO priority to try first (None to skip it), and
+# the nice value to use otherwise
+PRIORITY_CLASSES = {"realtime": {"fifo": 50, "nice": -10},
+                    "high": {"fifo": None, "nice": -5},
+                    "normal": {"fifo": None, "nice": 0},
+                    "low": {"fifo": None, "nice": 10}}
+
+
+def applyAffinity(cpus):
+    """Pin the calling thread to a set of CPUs, and return a description of what was applied"""
+
+    if cpus is None:
+        return "any CPU"
+
+    if not hasattr(os, "sched_setaffinity"):
+        return "any CPU (affinity not supported)"
+
+    # Only pin to the CPUs this process is allowed to use
+    cpus = set(cpus) & os.sched_getaffinity(0)
+    if not cpus:
+        return "any CPU (requested CPUs not available)"
+
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as error:
+        return "any CPU ({0})".format(error.strerror)
+
+    return "CPUs {0}".format(",".join(str(cpu) for cpu in sorted(cpus)))
+
+
+def applyPriority(priority):
+    """
+    Apply a priority class to the calling thread, falling back to what is permitted, and return
+    a description of what was applied
+    """
+
+    settings = PRIORITY_CLASSES[priority]
+
+    if settings["fifo"] is not None and hasattr(os, "sched_setscheduler"):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(settings["fifo"]))
+            return "SCHED_FIFO {0}".format(settings["fifo"])
+        except OSError:
+            pass
+
+    if not hasattr(os, "setpriority") or not hasattr(threading, "get_native_id"):
+        return "unchanged (priorities not supported)"
+
+    # On Linux, the nice value of a thread is set through its thread id
+    thread_id = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, thread_id, settings["nice"])
+    except OSError:
+        return "nice {0} (wanted {1}, not permitted)".format(os.getpriority(os.PRIO_PROCESS, thread_id),
+                                                             settings["nice"])
+
+    return "nice {0}".format(settings["nice"])
+
+
+def runWithPriority(cp):
+    """Apply the scheduling settings of a service to the current thread, then run the service"""
+
+    cp.applied_scheduling = {"priority": applyPriority(cp.priority),
+                             "affinity": applyAffinity(cp.cpu_affinity)}
+
+    if any("(" in setting for setting in cp.applied_scheduling.values()):
+        logging.warning("{0}: running with {1}, {2}".format(cp.name, cp.applied_scheduling["priority"],
+                                                            cp.applied_scheduling["affinity"]))
+
+    cp()
+
+
+@log_on_start(DEBUG, "runPrioritized: Starting prioritized execution")
+@log_on_error(DEBUG, "runPrioritized: Encountered an error during prioritized execution")
+@log_on_end(DEBUG, "runPrioritized: Finished prioritized execution")
+def runPrioritized(producer_consumer_list):
+    """
+    runPrioritized executes a set of ConsumerProducer functions concurrently, like runConcurrently,
+    with the priority class and CPU affinity of each service applied to its thread
+    """
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(producer_consumer_list)) as executor:
+
+        executor_list = []
+        for cp in producer_consumer_list:
+            executor_list.append(executor.submit(runWithPriority, cp))
+
+    for e in executor_list:
+        e.result()
+
+
+def schedulingReport(producer_consumer_list):
+    """The priority and affinity applied to each service by runPrioritized, by name"""
+
+    return {cp.name: getattr(cp, "applied_scheduling", None) for cp in producer_consumer_list}
+
+
+if __name__ == "__main__":
+
+    import numpy as np
+
+    # Jitter of a 100 Hz steering service, on its own, next to CPU-hungry camera services at the
+    # same priority, and next to them with steering prioritized and kept apart on its own CPU.
+    # The camera work is numpy, which lets go of the GIL, so it competes for the CPUs as a real
+    # image pipeline would
+    logging.getLogger().setLevel(logging.WARNING)
+
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else [0]
+    steering_cpus = cpus[:1]
+    camera_cpus = cpus[1:] or cpus
+
+    def steer():
+        return sum(i * 0.001 for i in range(200))
+
+    def camera():
+        frame = np.random.random((480, 640))
+        for _ in range(5):
+            frame = np.tanh(frame * 1.1)
+        return float(frame.mean())
+
+    def scenario(with_camera, prioritized):
+        eTerminate = rr.TerminationEvent(3, "Termination event")
+        steering = rr.Producer(steer, rr.Bus(0.0, "Steering bus"), 0, eTerminate, "Steering control", rate=100,
+                               priority="realtime" if prioritized else "normal",
+                               cpu_affinity=steering_cpus if prioritized else None)
+        services = [steering]
+        if with_camera:
+            for idx in range(len(cpus) + 1):
+                services.append(rr.Producer(camera, rr.Bus(0.0, "Camera bus {0}".format(idx)), 0, eTerminate,
+                                            "Camera {0}".format(idx), priority="low" if prioritized else "normal",
+                                            cpu_affinity=camera_cpus if prioritized else None))
+        runPrioritized(services)
+        return steering
+
+    print("{0:<30}{1:>14}{2:>14}{3:>14}{4:>10}   {5}".format("scenario", "jitter mean", "jitter std", "jitter max",
+                                                            "skipped", "steering ran with"))
+    for label, with_camera, prioritized in (("steering alone", False, False),
+                                            ("with camera, equal priority", True, False),
+                                            ("with camera, prioritized", True, True)):
+        steering = scenario(with_camera, prioritized)
+        stats = steering.getStats()
+        applied = steering.applied_scheduling
+        print("{0:<30}{1:>11.3f} ms{2:>11.3f} ms{3:>11.3f} ms{4:>10}   {5}, {6}".format(
+            label, stats["jitter_mean"] * 1000, stats["jitter_std"] * 1000, stats["jitter_max"] * 1000,
+            stats["skipped_deadlines"], applied["priority"], applied["affinity"]))
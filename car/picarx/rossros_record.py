@@ -0,0 +1,425 @@
+#!/usr/bin/python3
+"""
+Recording and replay of RossROS bus traffic.
+
+A BusRecorder is a Consumer that appends every new message on its input buses to an append-only
+binary log, so that the exact sensor streams of a real run can be fed back later. A BusReplayer
+is a Producer that reads such a log and writes the messages back into buses with the same names,
+either with the timing they were recorded with or as fast as the graph takes them, so that
+Interpret, LineFollowControl and the rest of the graph can be tuned and tested without the car.
+
+The log is a memory-mapped file: a 16 byte header (the magic bytes and the offset of the end of
+the last complete record) followed by the records. Each record is the bus write time
+(time.monotonic(), float64), the length of the bus name, a payload type tag and the payload
+length, then the bus name and the packed payload. The end offset is only moved on once a record
+has been written in full, so a log can be read while it is still being recorded, or after the
+recording process has died. The file doubles in size whenever it runs out of room, and is cut
+back to its contents when the recorder is closed.
+"""
+
+import mmap
+import pickle
+import struct
+import time
+
+import numpy as np
+
+import rossros as rr
+from rossros import log_on_start, log_on_end, log_on_error, DEBUG
+
+
+MAGIC = b"RRBUSLOG"
+HEADER = struct.Struct("<8sQ")  # magic, end of the last complete record
+RECORD = struct.Struct("<dHBI")  # write time, name length, payload tag, payload length
+
+# Payload type tags
+TAG_NONE = 0
+TAG_BOOL = 1
+TAG_INT = 2
+TAG_FLOAT = 3
+TAG_ARRAY = 4
+TAG_PICKLE = 5
+TAG_SEQUENCE = 6
+
+# Element codes of lists and tuples of numbers, packed as a flat run of struct values
+SEQUENCE = struct.Struct("<BcI")  # 1 for a tuple or 0 for a list, struct code of the elements, count
+
+
+def packSequence(message):
+    """
+    Pack a flat list or tuple of numbers, such as a grayscale reading, or return None if the message
+    is not one. Elements are packed as booleans if they all are, as integers if they all are, and
+    as floats otherwise
+    """
+
+    if not isinstance(message, (list, tuple)):
+        return None
+
+    if all(isinstance(value, (bool, np.bool_)) for value in message):
+        code = b"?"
+    elif all(isinstance(value, (int, np.integer)) and not isinstance(value, (bool, np.bool_))
+             and -2**63 <= value < 2**63 for value in message):
+        code = b"q"
+    elif all(isinstance(value, (int, float, np.integer, np.floating)) for value in message):
+        code = b"d"
+    else:
+        return None
+
+    values = struct.pack("<{0}{1}".format(len(message), code.decode()), *message)
+    return SEQUENCE.pack(isinstance(message, tuple), code, len(message)) + values
+
+
+def packMessage(message, allow_pickle=True):
+    """
+    Pack a bus message into a type tag and bytes. Scalars, numeric numpy arrays and flat lists and
+    tuples of numbers are packed directly. Anything else is pickled, or refused with a ValueError
+    if allow_pickle is not set
+    """
+
+    if message is None:
+        return TAG_NONE, b""
+
+    if isinstance(message, (bool, np.bool_)):
+        return TAG_BOOL, struct.pack("<?", bool(message))
+
+    if isinstance(message, (int, np.integer)) and -2**63 <= message < 2**63:
+        return TAG_INT, struct.pack("<q", int(message))
+
+    if isinstance(message, (float, np.floating)):
+        return TAG_FLOAT, struct.pack("<d", float(message))
+
+    if isinstance(message, np.ndarray) and message.dtype.kind in "biuf":
+        array = np.ascontiguousarray(message)
+        dtype = array.dtype.str.encode()
+        header = (struct.pack("<BB", len(dtype), array.ndim) + dtype
+                  + struct.pack("<{0}I".format(array.ndim), *array.shape))
+        return TAG_ARRAY, header + array.tobytes()
+
+    sequence = packSequence(message)
+    if sequence is not None:
+        return TAG_SEQUENCE, sequence
+
+    if not allow_pickle:
+        raise ValueError("Messages of type {0} can only be packed by pickling them".format(type(message).__name__))
+
+    return TAG_PICKLE, pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def unpackMessage(tag, payload, allow_pickle=True):
+    """
+    Turn a type tag and bytes from packMessage back into the bus message. Pickled messages are
+    refused with a ValueError if allow_pickle is not set, since unpickling runs arbitrary code
+    """
+
+    if tag == TAG_NONE:
+        return None
+
+    if tag == TAG_BOOL:
+        return struct.unpack("<?", payload)[0]
+
+    if tag == TAG_INT:
+        return struct.unpack("<q", payload)[0]
+
+    if tag == TAG_FLOAT:
+        return struct.unpack("<d", payload)[0]
+
+    if tag == TAG_ARRAY:
+        dtype_length, ndim = struct.unpack_from("<BB", payload, 0)
+        dtype = np.dtype(bytes(payload[2:2 + dtype_length]).decode())
+        if dtype.kind not in "biuf":
+            raise ValueError("Bus array payloads have to be numeric, not {0}".format(dtype))
+        offset = 2 + dtype_length
+        shape = struct.unpack_from("<{0}I".format(ndim), payload, offset)
+        offset += 4 * ndim
+        return np.frombuffer(payload, dtype=dtype, offset=offset).reshape(shape).copy()
+
+    if tag == TAG_SEQUENCE:
+        is_tuple, code, count = SEQUENCE.unpack_from(payload, 0)
+        if code not in (b"?", b"q", b"d"):
+            raise ValueError("Unknown bus sequence element code {0}".format(code))
+        values = struct.unpack_from("<{0}{1}".format(count, code.decode()), payload, SEQUENCE.size)
+        return tuple(values) if is_tuple else list(values)
+
+    if tag == TAG_PICKLE:
+        if not allow_pickle:
+            raise ValueError("Refusing to unpickle a bus payload")
+        return pickle.loads(payload)
+
+    raise ValueError("Unknown bus log payload tag {0}".format(tag))
+
+
+class BusLogWriter:
+    """
+    Append-only writer for a memory-mapped bus log. Only one thread should append to a log
+    """
+
+    def __init__(self,
+                path,
+                initial_size=1 << 20):  # bytes to reserve for the file before it first has to grow
+
+        self.path = path
+        self.file = open(path, "w+b")
+        self.size = max(initial_size, HEADER.size)
+        self.file.truncate(self.size)
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+
+        self.end = HEADER.size
+        HEADER.pack_into(self.mm, 0, MAGIC, self.end)
+
+    def grow(self, needed):
+        """Double the size of the file until it can hold needed bytes, and map it again"""
+
+        size = self.size
+        while size < needed:
+            size *= 2
+
+        self.mm.close()
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self.size = size
+
+    def append(self, timestamp, name, message):
+        """Add a record for a message written to the named bus at the given time.monotonic() time"""
+
+        tag, payload = packMessage(message)
+        name = name.encode()
+        record_end = self.end + RECORD.size + len(name) + len(payload)
+
+        if record_end > self.size:
+            self.grow(record_end)
+
+        RECORD.pack_into(self.mm, self.end, timestamp, len(name), tag, len(payload))
+        offset = self.end + RECORD.size
+        self.mm[offset:offset + len(name)] = name
+        offset += len(name)
+        self.mm[offset:record_end] = payload
+
+        # Only now does the record become part of the log
+        self.end = record_end
+        HEADER.pack_into(self.mm, 0, MAGIC, self.end)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        """Write the log out, and cut the file back to the records it holds"""
+
+        if self.mm.closed:
+            return
+
+        self.mm.flush()
+        self.mm.close()
+        self.file.truncate(self.end)
+        self.file.close()
+
+
+def readBusLog(path):
+    """
+    Generator that yields the (timestamp, bus name, message) records of a bus log in the order
+    they were written
+    """
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+        magic, end = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a bus log".format(path))
+
+        offset = HEADER.size
+        while offset < end:
+            timestamp, name_length, tag, payload_length = RECORD.unpack_from(mm, offset)
+            offset += RECORD.size
+            name = mm[offset:offset + name_length].decode()
+            offset += name_length
+            message = unpackMessage(tag, mm[offset:offset + payload_length])
+            offset += payload_length
+
+            yield timestamp, name, message
+
+
+class BusRecorder(rr.Consumer):
+    """
+    Consumer that appends the messages on its input buses to a bus log. A bus is only recorded
+    when it has been written since the last cycle, with the time of that write, so the delay of
+    the recorder should be shorter than the period of the buses it records
+
+    The log is closed when the service stops. Executors that drive the cycles themselves
+    (runTopologically, runAsync) do not call the service, so close() should be called once they
+    return
+    """
+
+    @log_on_start(DEBUG, "{name:s}: Starting to create bus recorder")
+    @log_on_error(DEBUG, "{name:s}: Encountered an error while creating bus recorder")
+    @log_on_end(DEBUG, "{name:s}: Finished creating bus recorder")
+    def __init__(self,
+                input_buses,  # buses to record
+                path,  # file to write the log to
+                delay=0,
+                termination_buses=rr.Bus(False, "Default recorder termination bus"),
+                name="Unnamed bus recorder",
+                initial_size=1 << 20,  # bytes to reserve for the log before it first has to grow
+                **kwargs):  # further options passed on to ConsumerProducer
+
+        super().__init__(
+            self.record,  # BusRecorder class defines its own consumer function
+            input_buses,
+            delay,
+            termination_buses,
+            name,
+            **kwargs)
+
+        self.log = BusLogWriter(path, initial_size)
+        self.recorded_sequences = [None] * len(self.input_buses)
+        self.records = 0
+
+    def __call__(self):
+
+        try:
+            super().__call__()
+        finally:
+            self.close()
+
+    def record(self, *values):
+
+        for idx, (bus, message) in enumerate(zip(self.input_buses, values)):
+
+            # Only record buses that have been written since they were last recorded
+            sequence = self.input_sequences[idx]
+            if sequence == self.recorded_sequences[idx]:
+                continue
+            self.recorded_sequences[idx] = sequence
+
+            self.log.append(getattr(bus, "timestamp", time.monotonic()), bus.name, message)
+            self.records += 1
+
+    def close(self):
+        self.log.close()
+
+
+class BusReplayer(rr.Producer):
+    """
+    Producer that writes the messages from a bus log back into the output buses with the same
+    names. Records for buses that are not among the output buses are passed over
+
+    In real time, each cycle writes all of the messages that are due, keeping the spacing they
+    were recorded with (scaled by speed). Otherwise each cycle writes the next message, so that
+    with a delay of 0 the log is replayed as fast as the graph takes it. With terminate_at_end
+    set, the replayer writes True into its termination buses once the log has run out, which
+    stops the rest of the graph as well
+    """
+
+    @log_on_start(DEBUG, "{name:s}: Starting to create bus replayer")
+    @log_on_error(DEBUG, "{name:s}: Encountered an error while creating bus replayer")
+    @log_on_end(DEBUG, "{name:s}: Finished creating bus replayer")
+    def __init__(self,
+                path,  # bus log to replay
+                output_buses,  # buses to write the recorded messages into, matched by name
+                delay=0,
+                termination_buses=rr.Bus(False, "Default replayer termination bus"),
+                name="Unnamed bus replayer",
+                realtime=True,  # keep the recorded timing rather than replaying as fast as possible
+                speed=1.0,  # how many times faster than recorded to replay in real time
+                terminate_at_end=False,  # trigger the termination buses when the log runs out
+                **kwargs):  # further options passed on to ConsumerProducer
+
+        super().__init__(
+            self.replay,  # BusReplayer class defines its own producer function
+            output_buses,
+            delay,
+            termination_buses,
+            name,
+            **kwargs)
+
+        self.realtime = realtime
+        self.speed = speed
+        self.terminate_at_end = terminate_at_end
+        self.buses = {bus.name: bus for bus in self.output_buses}
+
+        self.log = readBusLog(path)
+        self.pending = next(self.log, None)
+        self.t_log_start = None if self.pending is None else self.pending[0]
+        self.t_replay_start = None
+        self.replayed = 0
+
+    def replay(self):
+        """Return the (bus, message) pairs to write this cycle"""
+
+        now = time.monotonic()
+        if self.t_replay_start is None:
+            self.t_replay_start = now
+
+        due = []
+        while self.pending is not None:
+            timestamp, name, message = self.pending
+
+            # Not yet time for this message
+            if self.realtime and (timestamp - self.t_log_start) / self.speed > now - self.t_replay_start:
+                break
+
+            self.pending = next(self.log, None)
+
+            if name in self.buses:
+                due.append((self.buses[name], message))
+                if not self.realtime:
+                    break
+
+        self.replayed += len(due)
+
+        # Nothing left to replay, so stop the graph if asked to
+        if self.pending is None and self.terminate_at_end:
+            for bus in self.termination_buses:
+                bus.set_message(True, self.name)
+
+        return due
+
+    def dealValuesTobuses(self, values, buses, origins=None):
+
+        # Only the buses with a recorded message this cycle are written
+        for bus, message in values:
+            super().dealValuesTobuses(message, bus, origins)
+
+
+if __name__ == "__main__":
+
+    import os
+    import tempfile
+    from collections import Counter
+
+    from sense_interp import Sensing, Interpret
+    from controller import LineFollowControl
+
+    path = os.path.join(tempfile.gettempdir(), "grayscale.rrlog")
+
+    # Record two seconds of grayscale data
+    sensor = Sensing()
+    bSensor = rr.Bus(sensor.get_grayscale_data(), "Sensor bus")
+    bTerminate = rr.Bus(0, "Termination bus")
+
+    readSensor = rr.Producer(sensor.get_grayscale_data, bSensor, 0.05, bTerminate, "Read grayscale")
+    recordSensor = BusRecorder(bSensor, path, 0.01, bTerminate, "Record grayscale")
+    terminationTimer = rr.Timer(bTerminate, 2, 0.01, bTerminate, "Termination timer")
+
+    rr.runConcurrently([readSensor, recordSensor, terminationTimer])
+    print("Recorded {0} messages to {1}".format(recordSensor.records, path))
+
+    # Run the interpreter and controller over every recorded sample, with no car and no timing
+    interpreter = Interpret()
+    controller = LineFollowControl()
+    directions = [interpreter.get_direction(message) for _, name, message in readBusLog(path) if name == "Sensor bus"]
+    angles = [controller.get_control_angle(direction) for direction in directions]
+    print("Directions: {0}".format(dict(Counter(directions))))
+    print("Control angles: {0}".format(dict(Counter(angles))))
+
+    # Replay the same data through a graph, twice as fast as it was recorded
+    bSensor = rr.Bus(np.ones(3), "Sensor bus")
+    bInterpret = rr.Bus(0.0, "Interpret bus")
+    bTerminate = rr.Bus(0, "Termination bus")
+
+    replaySensor = BusReplayer(path, bSensor, 0.01, bTerminate, "Replay grayscale", speed=2.0, terminate_at_end=True)
+    interpretSensor = rr.ConsumerProducer(Interpret().get_direction, bSensor, bInterpret, 0.01, bTerminate,
+                                          "Interpret grayscale", skip_unchanged=True)
+
+    t_start = time.monotonic()
+    rr.runConcurrently([replaySensor, interpretSensor])
+    print("Replayed {0} messages in {1:.2f} s, interpreter ran {2} cycles".format(
+        replaySensor.replayed, time.monotonic() - t_start, interpretSensor.cycles))
@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+"""
+Supervised execution for RossROS graphs.
+
+With runConcurrently, an exception in one service only comes out of e.result() after every other
+service has stopped, and in the meantime the car keeps driving on its last motor command.
+runSupervised runs the same services in a thread pool, but watches each of them and reacts as
+soon as one raises: it calls a safe-stop callback (such as Picarx.stop) straight away, and then
+restarts the service after a backoff that doubles with every crash in a row.
+
+The safe stop is held until the crashed service has recovered, since the other services keep
+running and an actuator would otherwise send its last command again on its next cycle. While a
+service is down, every actuator downstream of it (reading, through any number of services, the
+buses it writes) calls the safe stop in place of its own function on each of its cycles. The
+actuators are the plain Consumers of the graph unless listed explicitly. A service that
+keeps crashing is given up on after max_restarts restarts, at which point the whole graph is
+stopped through the termination bus or event, if one was given.
+
+The Supervisor keeps per-service counts of crashes and restarts, the time the safe stop took
+after each crash, and the recovery time from the crash to the first cycle of the restarted
+service, all available from getStats().
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+import rossros as rr
+from rossros import log_on_start, log_on_end, log_on_error, DEBUG
+
+
+class Supervisor:
+    """
+    Runs a set of ConsumerProducer services in a thread pool, restarting any that crash
+    """
+
+    def __init__(self,
+                producer_consumer_list,
+                safe_stop=None,  # function to call as soon as a service crashes
+                termination=None,  # termination bus or event to trigger when a service is given up on
+                max_restarts=5,  # restarts of a service before it is given up on (None for no limit)
+                backoff_initial=0.1,  # seconds to wait before restarting after a first crash
+                backoff_factor=2.0,  # how much longer to wait after each further crash in a row
+                backoff_max=5.0,  # longest wait before a restart
+                stable_time=10.0,  # seconds a service has to run before its crashes stop counting as in a row
+                poll_interval=0.01,  # how often to check restarted services for their first cycle
+                actuators=None):  # services (or their names) to hold stopped while a service upstream is down
+
+        self.services = list(producer_consumer_list)
+        self.safe_stop = safe_stop
+        self.termination = termination
+        self.max_restarts = max_restarts
+        self.backoff_initial = backoff_initial
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.stable_time = stable_time
+        self.poll_interval = poll_interval
+
+        if actuators is None:
+            self.actuators = [cp for cp in self.services if type(cp) is rr.Consumer]
+        else:
+            self.actuators = [cp for cp in self.services if any(cp is a or cp.name == a for a in actuators)]
+
+        # Services downstream of each service, which are held stopped while it is down
+        self.downstream = {cp: self.findDownstream(cp) for cp in self.services}
+
+        self.stats = {cp: {"crashes": 0,
+                           "restarts": 0,
+                           "consecutive_crashes": 0,
+                           "last_error": None,
+                           "safe_stop_times": [],
+                           "recovery_times": [],
+                           "given_up": False} for cp in self.services}
+
+        self.futures = {}
+        self.start_times = {}
+        self.restart_times = {}  # services waiting to be restarted, and when
+        self.recovering = {}  # restarted services that have not run a cycle yet, with their crash time and cycles
+        self.released_on = {}  # restarted services, with the sequences of their output buses when restarted
+
+        # Services that have crashed and not yet recovered, and the actuators held stopped because
+        # of them. Both are replaced rather than changed, since the actuator threads read them
+        self.down = frozenset()
+        self.held = frozenset()
+
+        # Taken around each actuator cycle and around holding them, so that an actuator cycle that
+        # is already under way when a service crashes cannot send its command after the safe stop
+        self.hold_lock = threading.Lock()
+        self.held_cycles = 0  # actuator cycles replaced by a safe stop
+
+    def findDownstream(self, cp):
+        """Services that read the output buses of cp, directly or through other services"""
+
+        found = set()
+        frontier = [cp]
+        while frontier:
+            writer = frontier.pop()
+            for other in self.services:
+                if other not in found and other is not cp and any(
+                        bus is output for bus in other.input_buses for output in writer.output_buses):
+                    found.add(other)
+                    frontier.append(other)
+
+        return found
+
+    def setDown(self, down):
+
+        self.down = frozenset(down)
+        self.held = frozenset(actuator for actuator in self.actuators
+                              if any(actuator in self.downstream[cp] for cp in self.down))
+
+    def holdable(self, cp):
+        """Replace the function of an actuator with one that calls the safe stop while it is held"""
+
+        function = cp.consumer_producer_function
+
+        def heldFunction(*args):
+            with self.hold_lock:
+                if cp in self.held:
+                    self.held_cycles += 1
+                    self.callSafeStop(time.monotonic())
+                    return None
+                return function(*args)
+
+        cp.consumer_producer_function = heldFunction
+
+        return function
+
+    def start(self, executor, cp):
+
+        self.futures[executor.submit(cp)] = cp
+        self.start_times[cp] = time.monotonic()
+
+    def callSafeStop(self, t_crash):
+        """Call the safe-stop callback, and return how long after the crash it finished"""
+
+        if self.safe_stop is None:
+            return None
+
+        try:
+            self.safe_stop()
+        except Exception:
+            logging.exception("Supervisor: safe stop failed")
+
+        return time.monotonic() - t_crash
+
+    def handleCrash(self, cp, error):
+
+        t_crash = time.monotonic()
+        stats = self.stats[cp]
+
+        # Stop the car before anything else, and keep it stopped until the service has recovered
+        with self.hold_lock:
+            self.setDown(self.down | {cp})
+            safe_stop_time = self.callSafeStop(t_crash)
+        if safe_stop_time is not None:
+            stats["safe_stop_times"].append(safe_stop_time)
+
+        stats["crashes"] += 1
+        stats["last_error"] = repr(error)
+        logging.error("Supervisor: {0} crashed: {1!r}".format(cp.name, error))
+
+        # A service that ran for a good while before crashing starts its backoff again
+        if t_crash - self.start_times[cp] >= self.stable_time:
+            stats["consecutive_crashes"] = 0
+        stats["consecutive_crashes"] += 1
+
+        if self.max_restarts is not None and stats["restarts"] >= self.max_restarts:
+            stats["given_up"] = True
+            logging.error("Supervisor: giving up on {0} after {1} restarts".format(cp.name, stats["restarts"]))
+            if self.termination is not None:
+                self.termination.set_message(True, "Supervisor")
+            return
+
+        backoff = min(self.backoff_max, self.backoff_initial * self.backoff_factor ** (stats["consecutive_crashes"] - 1))
+        self.restart_times[cp] = (t_crash + backoff, t_crash)
+
+    def checkRecovery(self):
+        """Record the recovery time of restarted services that have started a cycle"""
+
+        for cp, (t_crash, cycles) in list(self.recovering.items()):
+            if cp.cycles > cycles:
+                # The start of the first cycle is known exactly unless more have run since
+                t_recovered = cp.last_cycle_time if cp.cycles == cycles + 1 else time.monotonic()
+                self.stats[cp]["recovery_times"].append(t_recovered - t_crash)
+                del self.recovering[cp]
+
+        # Release the actuators once a restarted service has written fresh outputs, rather than
+        # the ones it left behind when it crashed
+        for cp, sequences in list(self.released_on.items()):
+            if cp not in self.recovering and (not cp.output_buses
+                                              or cp.collectbusesToSequences(cp.output_buses) != sequences):
+                del self.released_on[cp]
+                self.setDown(self.down - {cp})
+
+    def run(self):
+
+        # Let the actuators be held stopped, and put their functions back at the end
+        functions = {}
+        if self.safe_stop is not None:
+            for cp in self.actuators:
+                functions[cp] = self.holdable(cp)
+
+        try:
+            self.runServices()
+        finally:
+            for cp, function in functions.items():
+                cp.consumer_producer_function = function
+
+    def runServices(self):
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.services)) as executor:
+
+            for cp in self.services:
+                self.start(executor, cp)
+
+            while self.futures or self.restart_times:
+
+                # Wake up for the next restart, or often enough to catch the first cycle of a restarted service
+                now = time.monotonic()
+                timeout = None
+                if self.restart_times:
+                    timeout = max(0.0, min(t_restart for t_restart, _ in self.restart_times.values()) - now)
+                if self.recovering or self.released_on:
+                    timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+
+                if self.futures:
+                    done, _ = concurrent.futures.wait(list(self.futures), timeout,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout)
+                    done = set()
+
+                for future in done:
+                    cp = self.futures.pop(future)
+                    error = future.exception()
+
+                    # A service that returned has seen its termination signal
+                    if error is not None:
+                        self.handleCrash(cp, error)
+
+                # Restart the services whose backoff is over, unless the graph is shutting down
+                now = time.monotonic()
+                for cp, (t_restart, t_crash) in list(self.restart_times.items()):
+                    if cp.checkTerminationbuses():
+                        del self.restart_times[cp]
+                    elif now >= t_restart:
+                        del self.restart_times[cp]
+                        self.stats[cp]["restarts"] += 1
+                        self.recovering[cp] = (t_crash, cp.cycles)
+                        self.released_on[cp] = cp.collectbusesToSequences(cp.output_buses)
+                        self.start(executor, cp)
+
+                self.checkRecovery()
+
+    def getStats(self):
+        """Crash, restart, safe-stop and recovery figures for each service, by name"""
+
+        report = {}
+        for cp, stats in self.stats.items():
+            report[cp.name] = {"crashes": stats["crashes"],
+                               "restarts": stats["restarts"],
+                               "given_up": stats["given_up"],
+                               "last_error": stats["last_error"],
+                               "safe_stop_times": list(stats["safe_stop_times"]),
+                               "recovery_times": list(stats["recovery_times"])}
+
+        return report
+
+
+@log_on_start(DEBUG, "runSupervised: Starting supervised execution")
+@log_on_error(DEBUG, "runSupervised: Encountered an error during supervised execution")
+@log_on_end(DEBUG, "runSupervised: Finished supervised execution")
+def runSupervised(producer_consumer_list, safe_stop=None, termination=None, **kwargs):
+    """
+    runSupervised executes a set of ConsumerProducer functions concurrently, like runConcurrently,
+    calling safe_stop and restarting any service that raises (see Supervisor for the options).
+    Once all of the services have stopped, it raises a RuntimeError if any of them was given up
+    on, and otherwise returns the Supervisor, so that its statistics can be inspected
+    """
+
+    supervisor = Supervisor(producer_consumer_list, safe_stop, termination, **kwargs)
+    supervisor.run()
+
+    failed = [name for name, stats in supervisor.getStats().items() if stats["given_up"]]
+    if failed:
+        raise RuntimeError("runSupervised: services kept crashing: {0}".format(", ".join(failed)))
+
+    return supervisor
+
+
+if __name__ == "__main__":
+
+    import random
+
+    # Simulated failure test: a controller that crashes every so often between a sensor and a motor
+    # stand-in, with a safe stop that zeroes the motor command. The motor counts the commands it is
+    # sent while the controller is down, which should be none if the safe stop holds
+    motor = {"command": 0.0, "stops": 0, "stale_commands": 0}
+
+    def sample():
+        return random.uniform(-1.0, 1.0)
+
+    def control(value):
+        control.calls += 1
+        if control.calls % 25 == 0:
+            raise RuntimeError("simulated controller fault on call {0}".format(control.calls))
+        return 30.0 * value
+    control.calls = 0
+
+    def drive(command):
+        motor["command"] = command
+        if controlMotor in supervisor.down:
+            motor["stale_commands"] += 1
+
+    def safe_stop():
+        motor["command"] = 0.0
+        motor["stops"] += 1
+
+    bSample = rr.Bus(0.0, "Sample bus")
+    bCommand = rr.Bus(0.0, "Command bus")
+    eTerminate = rr.TerminationEvent(3, "Termination event")
+
+    readSample = rr.Producer(sample, bSample, 0.02, eTerminate, "Sample")
+    controlMotor = rr.ConsumerProducer(control, bSample, bCommand, 0.02, eTerminate, "Control")
+    driveMotor = rr.Consumer(drive, bCommand, 0.02, eTerminate, "Drive")
+
+    supervisor = Supervisor([readSample, controlMotor, driveMotor], safe_stop, eTerminate,
+                            backoff_initial=0.05, stable_time=1.0)
+    supervisor.run()
+
+    print("Safe stops: {0}, {1} of them holding the motor cycles while the controller was down".format(
+        motor["stops"], supervisor.held_cycles))
+    print("Commands sent while the controller was down: {0}".format(motor["stale_commands"]))
+    for name, stats in supervisor.getStats().items():
+        print("{0}: {1} crashes, {2} restarts".format(name, stats["crashes"], stats["restarts"]))
+        if stats["crashes"]:
+            print("    safe stop after {0:.3f} ms max, recovery in {1} ms".format(
+                max(stats["safe_stop_times"]) * 1000,
+                ", ".join("{0:.1f}".format(t * 1000) for t in stats["recovery_times"])))
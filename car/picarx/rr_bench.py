@@ -0,0 +1,576 @@
+#!/usr/bin/python3
+"""
+This file benchmarks the RossROS messaging layer.
+
+tracing: measures how many bus messages per second a single thread can pass with the log_on_*
+tracing decorators switched on and off. Because the decorators are applied when rossros is
+imported, each setting is measured in a separate Python process started with the
+ROSSROS_TRACE environment variable set accordingly.
+
+topological: runs the graph from rr_demo.py (square and sawtooth producers, a multiplier and a sink
+in place of the printer) with runConcurrently and with runTopologically, and compares the
+end-to-end latency from the signal producers to the sink and the number of multiplier cycles.
+
+locks: one writer thread and 1, 4 and 8 reader threads hammer a single bus, comparing rossros.Bus
+(readerwriterlock RWLockFairD), utils.Bus (RWLockWriteD) and rossros.LockFreeBus.
+
+graphs: builds synthetic graphs out of rossros services (chains of 1 to 10 hops from a producer to
+a sink, fan-in from several producers into one stage, and fan-out from one producer to several
+sinks) and runs each of them with the thread (runConcurrently), process (runMultiprocess), async
+(runAsync) and topological (runTopologically) executors. Producers run at a fixed rate and send
+the time.monotonic() time they sampled at as the message, the stages in between pass it on, and
+the sinks record how old it was when it reached them. Sinks and producers keep their counts and
+latency samples in multiprocessing shared memory, so the figures are the same whichever process
+the services ran in. Each run reports the messages produced and delivered, delivered messages per
+second, the latency percentiles and the CPU time (this process and its children, from os.times)
+per delivered message. With --output, the results are also written to a JSON file so that runs
+before and after a change can be compared.
+
+allocations: runs producer cycles by hand under tracemalloc for the grayscale triplet, ultrasonic
+distance and camera shift payloads, once with a plain Bus and a function that returns a new
+message, and once with an ArrayBus filled in place by an InPlaceProducer. It reports how many
+distinct payload objects the readers were handed, the peak bytes allocated per cycle and the time
+per cycle (measured separately, without tracemalloc). The grayscale triplets come from Sensing on
+whichever robot_hat is available; the distance and shift are computed stand-ins.
+
+Usage:
+    python3 rr_bench.py tracing [--duration SECONDS]
+    python3 rr_bench.py topological [--duration SECONDS] [--delay SECONDS]
+    python3 rr_bench.py locks [--duration SECONDS]
+    python3 rr_bench.py allocations [--cycles N]
+    python3 rr_bench.py graphs [--duration SECONDS] [--rate HZ] [--depths N ...] [--widths N ...]
+                               [--executors NAME ...] [--output FILE]
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def bench_bus(rr, duration):
+    """Write and read back a message on a single bus as often as possible"""
+
+    bus = rr.Bus(0, "Benchmark bus")
+    count = 0
+    t_end = time.perf_counter() + duration
+
+    while time.perf_counter() < t_end:
+        for _ in range(1000):
+            bus.set_message(count, "benchmark")
+            bus.get_message("benchmark")
+        count += 1000
+
+    return count / duration
+
+
+def bench_service(rr, duration):
+    """Run a consumer-producer with no delay, passing one message per cycle, for a fixed time"""
+
+    bInput = rr.Bus(0, "Benchmark input bus")
+    bOutput = rr.Bus(0, "Benchmark output bus")
+    bTerminate = rr.Bus(0, "Benchmark termination bus")
+    t_end = time.perf_counter() + duration
+    count = [0]
+
+    def forward(value):
+        count[0] += 1
+        # Stop the service once the time is up, checking the clock every so often
+        if count[0] % 1000 == 0 and time.perf_counter() >= t_end:
+            bTerminate.set_message(1, "benchmark")
+        return value + 1
+
+    service = rr.ConsumerProducer(forward, bInput, bOutput, 0, bTerminate, "Benchmark service")
+    t_start = time.perf_counter()
+    service()
+
+    return count[0] / (time.perf_counter() - t_start)
+
+
+def tracing_child(duration):
+    """Measure message rates with whatever tracing setting this process was started with"""
+
+    import rossros as rr
+
+    results = {"trace": rr.TRACE,
+               "bus_messages_per_sec": bench_bus(rr, duration),
+               "service_cycles_per_sec": bench_service(rr, duration)}
+    print(json.dumps(results))
+
+
+def tracing(duration):
+    """Compare message rates with tracing on and off, one subprocess each"""
+
+    print("{0:<10}{1:>22}{2:>26}".format("tracing", "bus messages/sec", "service cycles/sec"))
+    for setting in ("0", "1"):
+        env = dict(os.environ, ROSSROS_TRACE=setting)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "tracing", "--child",
+                                 "--duration", str(duration)],
+                                env=env, check=True, capture_output=True, text=True).stdout
+        results = json.loads(output.strip().splitlines()[-1])
+        print("{0:<10}{1:>22.0f}{2:>26.0f}".format("on" if results["trace"] else "off",
+                                                   results["bus_messages_per_sec"],
+                                                   results["service_cycles_per_sec"]))
+
+
+def build_demo_graph(rr, duration, delay):
+    """The rr_demo.py graph, with traced buses and a sink consumer in place of the printer"""
+
+    def square():
+        return (2 * math.floor(time.time() % 2)) - 1
+
+    def sawtooth():
+        return time.time() % 1
+
+    def mult(a, b):
+        return a * b
+
+    def sink(value):
+        pass
+
+    bSquare = rr.Bus(square(), "Square wave bus", trace_age=True)
+    bSawtooth = rr.Bus(sawtooth(), "Sawtooth wave Bus", trace_age=True)
+    bMultiplied = rr.Bus(sawtooth() * square(), "Multiplied wave bus", trace_age=True)
+    bTerminate = rr.Bus(0, "Termination Bus")
+
+    services = {"square": rr.Producer(square, bSquare, delay, bTerminate, "Read square wave signal"),
+                "sawtooth": rr.Producer(sawtooth, bSawtooth, delay, bTerminate, "Read sawtooth wave signal"),
+                "multiply": rr.ConsumerProducer(mult, (bSquare, bSawtooth), bMultiplied, delay, bTerminate,
+                                                "Multiply Waves"),
+                "sink": rr.Consumer(sink, bMultiplied, delay, bTerminate, "Sink"),
+                "timer": rr.Timer(bTerminate, duration, 0.01, bTerminate, "Termination timer")}
+
+    return services
+
+
+def topological(duration, delay):
+    """Compare runConcurrently and runTopologically on the rr_demo.py graph"""
+
+    import rossros as rr
+
+    print("{0:<18}{1:>18}{2:>16}{3:>16}".format("executor", "multiply cycles", "latency p50", "latency p99"))
+    for executor_name, executor in (("runConcurrently", rr.runConcurrently),
+                                    ("runTopologically", rr.runTopologically)):
+        services = build_demo_graph(rr, duration, delay)
+        executor(list(services.values()))
+
+        # Latency from the square wave producer through the multiplier to the sink
+        report = services["sink"].getLatencyReport()
+        latency = report["Square wave bus -> Multiplied wave bus -> Sink"]
+        print("{0:<18}{1:>18}{2:>13.2f} ms{3:>13.2f} ms".format(executor_name, services["multiply"].cycles,
+                                                              latency["p50"] * 1000, latency["p99"] * 1000))
+
+
+def bench_contention(read, write, readers, duration):
+    """
+    Run one writer and a number of readers on a bus for a fixed time, and return
+    the writes per second and the total reads per second
+    """
+
+    stop = threading.Event()
+    counts = [0] * (readers + 1)
+
+    def writer():
+        n = 0
+        while not stop.is_set():
+            for _ in range(100):
+                write(n)
+                n += 1
+        counts[0] = n
+
+    def reader(idx):
+        n = 0
+        while not stop.is_set():
+            for _ in range(100):
+                read()
+            n += 100
+        counts[idx] = n
+
+    threads = [threading.Thread(target=writer)]
+    threads += [threading.Thread(target=reader, args=(idx,)) for idx in range(1, readers + 1)]
+
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    return counts[0] / duration, sum(counts[1:]) / duration
+
+
+def locks(duration):
+    """Compare the two readerwriterlock buses with the lock-free bus under 1, 4 and 8 readers"""
+
+    import rossros as rr
+    import utils
+
+    def rossros_bus():
+        bus = rr.Bus(0, "Benchmark bus")
+        return (lambda: bus.get_message("reader")), (lambda message: bus.set_message(message, "writer"))
+
+    def utils_bus():
+        bus = utils.Bus()
+        return bus.read, bus.write
+
+    def lock_free_bus():
+        bus = rr.LockFreeBus(0, "Benchmark bus")
+        return (lambda: bus.get_message("reader")), (lambda message: bus.set_message(message, "writer"))
+
+    print("{0:<34}{1:>9}{2:>16}{3:>16}".format("bus", "readers", "writes/sec", "reads/sec"))
+    for bus_name, make_bus in (("rossros.Bus (RWLockFairD)", rossros_bus),
+                               ("utils.Bus (RWLockWriteD)", utils_bus),
+                               ("rossros.LockFreeBus", lock_free_bus)):
+        for readers in (1, 4, 8):
+            read, write = make_bus()
+            writes, reads = bench_contention(read, write, readers, duration)
+            print("{0:<34}{1:>9}{2:>16.0f}{3:>16.0f}".format(bus_name, readers, writes, reads))
+
+
+def run_cycles(service, cycles):
+    """Run a number of cycles of a service in the calling thread"""
+
+    for _ in range(cycles):
+        input_values = service.beginCycle()
+        service.endCycle(service.consumer_producer_function(*input_values))
+
+
+def bench_allocations(service, bus, cycles):
+    """
+    Return the number of distinct payload objects read from the bus, the mean peak bytes
+    allocated per cycle, and the mean time per cycle, over a number of producer cycles
+    """
+
+    service.startSchedule()
+    run_cycles(service, 10)  # warm up
+
+    payloads = []
+    peak_bytes = 0
+    tracemalloc.start()
+    for _ in range(cycles):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        run_cycles(service, 1)
+        _, peak = tracemalloc.get_traced_memory()
+        peak_bytes += peak - current
+
+        # Keep the payloads alive, so that the ids of new objects cannot be reused
+        payloads.append(bus.get_message("benchmark"))
+    tracemalloc.stop()
+
+    t_start = time.perf_counter()
+    run_cycles(service, cycles)
+    cycle_time = (time.perf_counter() - t_start) / cycles
+
+    return len({id(payload) for payload in payloads}), peak_bytes / cycles, cycle_time
+
+
+def allocations(cycles):
+    """Compare allocations for each payload with a plain Bus and with an in-place ArrayBus"""
+
+    import logging
+    import rossros as rr
+    from sense_interp import Sensing
+
+    # The simulated hardware logs every register access
+    logging.getLogger().setLevel(logging.WARNING)
+
+    sensor = Sensing()
+    clock = time.perf_counter
+
+    def distance():
+        return 100.0 * (clock() % 1)
+
+    def shift():
+        return 2.0 * (clock() % 1) - 1.0
+
+    def distance_into(out):
+        out[...] = 100.0 * (clock() % 1)
+
+    def shift_into(out):
+        out[...] = 2.0 * (clock() % 1) - 1.0
+
+    payloads = (("grayscale", (3,), sensor.get_grayscale_data, sensor.read_grayscale_into),
+                ("ultrasonic", (), distance, distance_into),
+                ("camera shift", (), shift, shift_into))
+
+    print("{0:<14}{1:<16}{2:>22}{3:>18}{4:>14}".format("payload", "bus", "payload objects", "bytes/cycle",
+                                                      "us/cycle"))
+    for payload, shape, produce, produce_into in payloads:
+        bus = rr.Bus(produce(), "Benchmark bus")
+        array_bus = rr.ArrayBus(0, "Benchmark array bus", shape=shape)
+        for bus_name, service, bench_bus in (
+                ("Bus", rr.Producer(produce, bus, 0, name="Benchmark producer"), bus),
+                ("ArrayBus", rr.InPlaceProducer(produce_into, array_bus, 0, name="Benchmark producer"), array_bus)):
+            objects, peak_bytes, cycle_time = bench_allocations(service, bench_bus, cycles)
+            print("{0:<14}{1:<16}{2:>22}{3:>18.0f}{4:>14.1f}".format(
+                payload, bus_name, "{0} / {1} cycles".format(objects, cycles), peak_bytes, cycle_time * 1e6))
+
+
+class BenchSource:
+    """Producer function that sends the time it was called at, and counts its messages in shared memory"""
+
+    def __init__(self):
+        self.count = multiprocessing.Value("q", 0, lock=False)
+
+    def __call__(self):
+        self.count.value += 1
+        return time.monotonic()
+
+
+class BenchSink:
+    """
+    Consumer function that records the age of each message timestamp it receives, and counts
+    them, in shared memory. Messages beyond the capacity are counted but not recorded
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.latencies = multiprocessing.Array("d", capacity, lock=False)
+        self.count = multiprocessing.Value("q", 0, lock=False)
+
+    def __call__(self, timestamp):
+
+        # The buses start out holding NaN, which is not a message
+        if math.isnan(timestamp):
+            return
+
+        n = self.count.value
+        if n < self.capacity:
+            self.latencies[n] = time.monotonic() - timestamp
+        self.count.value = n + 1
+
+    def samples(self):
+        return np.frombuffer(self.latencies, dtype=np.float64)[:min(self.count.value, self.capacity)]
+
+
+def forward(timestamp):
+    return timestamp
+
+
+def oldest(*timestamps):
+    """Combine the inputs of a fan-in stage, passing on the oldest timestamp"""
+
+    if any(math.isnan(t) for t in timestamps):
+        return math.nan
+    return min(timestamps)
+
+
+def build_graph(rr, shape, size, executor, rate, duration, capacity):
+    """
+    Build a chain of size hops, or a fan-in or fan-out of width size, for an executor. Returns
+    the services, the sources, the sinks and the buses
+    """
+
+    if executor == "process":
+        import rossros_mp
+
+        # Processes need shared buses, which cannot wake each other up, so the stages poll them
+        def make_bus(name):
+            return rossros_mp.SharedBus(math.nan, name)
+
+        termination = rossros_mp.SharedBus(0, "Termination bus")
+        extra_services = [rr.Timer(termination, duration, 0.01, termination, "Termination timer")]
+        stage_delay = 0.0005
+        stage_options = {"skip_unchanged": True}
+    else:
+        def make_bus(name):
+            return rr.Bus(math.nan, name, notify=True)
+
+        termination = rr.TerminationEvent(duration, "Termination event")
+        extra_services = []
+        stage_delay = 0.1
+        stage_options = {"wait_for_change": True, "skip_unchanged": True}
+
+    services = []
+    sources = []
+    sinks = []
+    buses = [termination]
+
+    def add_source(bus):
+        source = BenchSource()
+        sources.append(source)
+        services.append(rr.Producer(source, bus, 0, termination, "Source {0}".format(len(sources)), rate=rate))
+
+    def add_sink(bus):
+        sink = BenchSink(capacity)
+        sinks.append(sink)
+        services.append(rr.Consumer(sink, bus, stage_delay, termination, "Sink {0}".format(len(sinks)),
+                                    **stage_options))
+
+    if shape == "chain":
+        # size hops from the source to the sink, through size - 1 forwarding stages
+        buses.append(make_bus("Chain bus 0"))
+        add_source(buses[-1])
+        for idx in range(1, size):
+            buses.append(make_bus("Chain bus {0}".format(idx)))
+            services.append(rr.ConsumerProducer(forward, buses[-2], buses[-1], stage_delay, termination,
+                                                "Stage {0}".format(idx), **stage_options))
+        add_sink(buses[-1])
+
+    elif shape == "fan_in":
+        # size sources into one combining stage, then a sink
+        inputs = []
+        for idx in range(size):
+            inputs.append(make_bus("Fan-in bus {0}".format(idx)))
+            add_source(inputs[-1])
+        combined = make_bus("Combined bus")
+        services.append(rr.ConsumerProducer(oldest, tuple(inputs), combined, stage_delay, termination,
+                                            "Combine", **stage_options))
+        add_sink(combined)
+        buses += inputs + [combined]
+
+    elif shape == "fan_out":
+        # One source read by size sinks
+        buses.append(make_bus("Fan-out bus"))
+        add_source(buses[-1])
+        for _ in range(size):
+            add_sink(buses[-1])
+
+    else:
+        raise ValueError("Unknown graph shape {0}".format(shape))
+
+    return services + extra_services, sources, sinks, buses
+
+
+def run_graph(shape, size, executor, rate, duration, capacity=100000):
+    """Build and run one graph with one executor, and return its figures"""
+
+    import rossros as rr
+    import rossros_asyncio
+    import rossros_mp
+
+    executors = {"thread": rr.runConcurrently,
+                 "process": rossros_mp.runMultiprocess,
+                 "async": lambda services: rossros_asyncio.runAsync(services, offload=[]),
+                 "topological": rr.runTopologically}
+
+    services, sources, sinks, buses = build_graph(rr, shape, size, executor, rate, duration, capacity)
+
+    cpu_start = os.times()
+    t_start = time.perf_counter()
+    executors[executor](services)
+    elapsed = time.perf_counter() - t_start
+    cpu_end = os.times()
+
+    # Remove the shared memory blocks straight away rather than when the suite exits
+    for bus in buses:
+        if isinstance(bus, rossros_mp.SharedBus):
+            bus.close()
+            bus.unlink()
+
+    cpu = sum(cpu_end[idx] - cpu_start[idx] for idx in range(4))  # user, system, children's user and system
+    produced = sum(source.count.value for source in sources)
+    delivered = sum(sink.count.value for sink in sinks)
+    samples = np.concatenate([sink.samples() for sink in sinks])
+
+    result = {"graph": shape,
+              "size": size,
+              "executor": executor,
+              "services": len(services),
+              "elapsed": elapsed,
+              "produced": produced,
+              "delivered": delivered,
+              "messages_per_sec": delivered / elapsed,
+              "cpu_ms_per_message": cpu * 1000 / delivered if delivered else None}
+
+    if samples.size:
+        result["latency_ms"] = {"mean": float(samples.mean()) * 1000,
+                                "p50": float(np.percentile(samples, 50)) * 1000,
+                                "p90": float(np.percentile(samples, 90)) * 1000,
+                                "p99": float(np.percentile(samples, 99)) * 1000,
+                                "max": float(samples.max()) * 1000}
+    else:
+        result["latency_ms"] = None
+
+    return result
+
+
+def graphs(duration, rate, depths, widths, executors, output):
+    """Run every graph with every executor, print a table, and write the results to a JSON file"""
+
+    configurations = [("chain", depth) for depth in depths]
+    configurations += [(shape, width) for shape in ("fan_in", "fan_out") for width in widths]
+
+    print("{0:<10}{1:>6}{2:>13}{3:>11}{4:>11}{5:>11}{6:>11}{7:>11}{8:>12}".format(
+        "graph", "size", "executor", "produced", "delivered", "msgs/sec", "p50 ms", "p99 ms", "cpu ms/msg"))
+
+    results = []
+    for shape, size in configurations:
+        for executor in executors:
+            result = run_graph(shape, size, executor, rate, duration)
+            results.append(result)
+
+            latency = result["latency_ms"] or {"p50": math.nan, "p99": math.nan}
+            cpu = result["cpu_ms_per_message"] if result["cpu_ms_per_message"] is not None else math.nan
+            print("{0:<10}{1:>6}{2:>13}{3:>11}{4:>11}{5:>11.0f}{6:>11.3f}{7:>11.3f}{8:>12.3f}".format(
+                shape, size, executor, result["produced"], result["delivered"], result["messages_per_sec"],
+                latency["p50"], latency["p99"], cpu))
+
+    if output:
+        report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "python": platform.python_version(),
+                  "platform": platform.platform(),
+                  "cpus": os.cpu_count(),
+                  "duration": duration,
+                  "rate": rate,
+                  "results": results}
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to {0}".format(output))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the RossROS messaging layer")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_tracing = subparsers.add_parser("tracing", help="message rates with tracing on and off")
+    parser_tracing.add_argument("--duration", type=float, default=2.0, help="seconds per measurement")
+    parser_tracing.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+
+    parser_topological = subparsers.add_parser("topological", help="runConcurrently against runTopologically")
+    parser_topological.add_argument("--duration", type=float, default=3.0, help="seconds per executor")
+    parser_topological.add_argument("--delay", type=float, default=0.05, help="delay of every service")
+
+    parser_locks = subparsers.add_parser("locks", help="locked buses against the lock-free bus")
+    parser_locks.add_argument("--duration", type=float, default=1.0, help="seconds per measurement")
+
+    parser_allocations = subparsers.add_parser("allocations", help="allocations of Bus against ArrayBus payloads")
+    parser_allocations.add_argument("--cycles", type=int, default=1000, help="producer cycles per measurement")
+
+    parser_graphs = subparsers.add_parser("graphs", help="throughput, latency and CPU of synthetic graphs")
+    parser_graphs.add_argument("--duration", type=float, default=2.0, help="seconds per graph and executor")
+    parser_graphs.add_argument("--rate", type=float, default=500.0, help="messages per second from each producer")
+    parser_graphs.add_argument("--depths", type=int, nargs="+", default=list(range(1, 11)),
+                               help="hops in the chain graphs")
+    parser_graphs.add_argument("--widths", type=int, nargs="+", default=[2, 4, 8],
+                               help="producers in the fan-in graphs and sinks in the fan-out graphs")
+    parser_graphs.add_argument("--executors", nargs="+", default=["thread", "process", "async", "topological"],
+                               choices=["thread", "process", "async", "topological"], help="executors to compare")
+    parser_graphs.add_argument("--output", help="JSON file to write the results to")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "tracing":
+        if args.child:
+            tracing_child(args.duration)
+        else:
+            tracing(args.duration)
+    elif args.benchmark == "topological":
+        topological(args.duration, args.delay)
+    elif args.benchmark == "locks":
+        locks(args.duration)
+    elif args.benchmark == "allocations":
+        allocations(args.cycles)
+    elif args.benchmark == "graphs":
+        graphs(args.duration, args.rate, args.depths, args.widths, args.executors, args.output)
@@ -24,7 +24,7 @@ import logging
 import time
 import math
 
-# logging.getLogger().setLevel(logging.DEBUG)
+# logging.getLogger().setLevel(logging.DEBUG)  # bus traces also need ROSSROS_TRACE=1 in the environment
 logging.getLogger().setLevel(logging.INFO)
 
 
@@ -65,7 +65,8 @@ readSquare = rr.Producer(
     bSquare,  # output data bus
     0.05,  # delay between data generation cycles
     bTerminate,  # bus to watch for termination signal
-    "Read square wave signal")
+    "Read square wave signal",
+    rate=20)  # sample at a fixed 20 Hz rather than sleeping for the delay after each sample
 
 # Wrap the sawtooth wave signal generator into a producer
 readSawtooth = rr.Producer(
@@ -73,7 +74,8 @@ readSawtooth = rr.Producer(
     bSawtooth,  # output data bus
     0.05,  # delay between data generation cycles
     bTerminate,  # bus to watch for termination signal
-    "Read sawtooth wave signal")
+    "Read sawtooth wave signal",
+    rate=20)  # sample at a fixed 20 Hz rather than sleeping for the delay after each sample
 
 # Wrap the multiplier function into a consumer-producer
 multiplyWaves = rr.ConsumerProducer(
@@ -115,3 +117,9 @@ producer_consumer_list = [readSquare,
 
 # Execute the list of producer-consumers concurrently
 rr.runConcurrently(producer_consumer_list)
+
+# Report the rate achieved by the fixed-rate signal generators
+for producer in (readSquare, readSawtooth):
+    stats = producer.getStats()
+    print("{name}: {achieved_rate:.2f} Hz (target {target_rate} Hz), "
+          "jitter {jitter_mean:.2e} s mean / {jitter_max:.2e} s max, {overruns} overruns".format(**stats))
@@ -1,9 +1,14 @@
 import time
+import math
 import logging
 import numpy as np
 import rossros as rr
 
 from utils import Bus
+from adc_batch import ADCGroup
+from direction_rules import directions_from_data
+from grayscale_sampler import GrayscaleSampler
+from ultrasonic_engine import UltrasonicEngine
 
 try:
     from robot_hat import ADC, Ultrasonic, Pin
@@ -16,21 +21,62 @@ logging.getLogger().setLevel(logging.DEBUG)
 
 
 class Sensing(object):
-    """Class to get sensor data from Grayscale module on PiCar-X"""
+    """Class to get sensor data from Grayscale module on PiCar-X
+
+    Args:
+        sample_rate: If given, sample the module in the background at this rate (samples per second),
+            and serve every read from the latest sample instead of reading the ADCs
+        adc_mode: How the three channels are read together, "shared" or the opt-in "block" (see adc_batch)
+    """
 
     GRAYSCALE_PINS = ['A0', 'A1', 'A2']
 
-    def __init__(self):
+    def __init__(self, sample_rate:float=None, adc_mode:str="shared"):
         self.ch0, self.ch1, self.ch2 = [ADC(pin) for pin in self.GRAYSCALE_PINS]
+        # Read the three channels together on one bus handle
+        self.adc_group = ADCGroup([self.ch0, self.ch1, self.ch2], mode=adc_mode)
         time.sleep(0.5)
 
+        self.sampler = None
+        if sample_rate is not None:
+            self.start_sampler(sample_rate)
+
         # Maybe need to calibrate the sensors at startup
 
+    def start_sampler(self, rate:float=100.0):
+        """Function to start sampling the module in the background, so that any number of readers share the samples"""
+
+        if self.sampler is None:
+            self.sampler = GrayscaleSampler(self.adc_group.read, rate=rate, name="Grayscale sampler")
+        self.sampler.start()
+
+        return self.sampler
+
+    def stop_sampler(self):
+        """Function to stop the background sampling, after which the ADCs are read on every call again"""
+
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    def read_raw(self):
+        """Function to get the raw values, from the background sampler if it is running"""
+
+        if self.sampler is not None:
+            return self.sampler.read()
+
+        return self.adc_group.read()
+
     def get_grayscale_data(self, is_normal:bool=False):
         """Function to get the values"""
 
         # Read the data
-        data = [self.ch0.read(), self.ch1.read(), self.ch2.read()]
+        data = self.read_raw()
+
+        # For the usual three channels, normalize in plain floats, which skips the numpy call overhead
+        # and gives the same values as the numpy version below
+        if len(data) == 3:
+            return np.array(self.normalize3(*data, is_normal=is_normal))
 
         # Normalize the data
         if is_normal:
@@ -42,6 +88,32 @@ class Sensing(object):
 
         return data
 
+    @staticmethod
+    def normalize3(a, b, c, is_normal:bool=False):
+        """Function to normalize three values like get_grayscale_data, with the same operations as np.mean and np.std"""
+
+        a, b, c = float(a), float(b), float(c)
+        mean = (a + b + c) / 3
+
+        if is_normal:
+            da, db, dc = a - mean, b - mean, c - mean
+            scale = math.sqrt((da * da + db * db + dc * dc) / 3) + 1e-9
+            return da / scale, db / scale, dc / scale
+
+        scale = mean + 1e-9
+        return a / scale, b / scale, c / scale
+
+    def read_grayscale_into(self, out:np.ndarray, is_normal:bool=False):
+        """Function to get the values into a preallocated float array of 3, such as the back buffer of an rr.ArrayBus
+
+        Gives the same values as get_grayscale_data, without allocating a new array
+        """
+
+        # Normalize in plain floats and write them in one by one, so that numpy makes no temporary arrays
+        out[0], out[1], out[2] = self.normalize3(*self.read_raw(), is_normal=is_normal)
+
+        return out
+
     def producer(self, sensor_bus:Bus, delay:float=0.1):
         """Function to write data to bus"""
 
@@ -61,9 +133,11 @@ class Interpret(object):
         h_th: Threshold for hard turn
         polarity: Polarity of the line (-1 for black line on white background, 1 for white line on black background)
         is_normal: Normalize the data with Normal Distribution or just divide by mean
+        sample_rate: If given, sample the sensors in the background at this rate (see Sensing)
     """
 
-    def __init__(self, l_th:float=0.35, h_th:float=0.8, polarity:int=-1, is_normal:bool=False):
+    def __init__(self, l_th:float=0.35, h_th:float=0.8, polarity:int=-1, is_normal:bool=False,
+                 sample_rate:float=None):
 
         # Set the thresholds
         self.l_th = l_th
@@ -74,13 +148,76 @@ class Interpret(object):
         self.is_normal = is_normal
 
         # Intialize the sensing module
-        self.sensor = Sensing()
+        self.sensor = Sensing(sample_rate=sample_rate)
 
         # Previous direction
         self.prev_direction = 0.0
 
     def get_direction(self, data=None):
-        """Function to get direction and degree of turn based on sensor data"""
+        """Function to get direction and degree of turn based on sensor data
+
+        Works on the three values as plain floats, since numpy calls on three elements cost far more than the
+        arithmetic, and gives the same directions as get_direction_numpy
+        """
+
+        # Get the sensor data
+        if data is None:
+            # Read the data from sensor
+            data = self.sensor.get_grayscale_data(is_normal=self.is_normal) # (3x1)
+
+        if isinstance(data, np.ndarray):
+            # Other dtypes are compared at their own precision by numpy, so leave them to the numpy version
+            if data.dtype != np.float64:
+                return self.get_direction_numpy(data)
+            d0, d1, d2 = data[:3].tolist()
+        else:
+            d0, d1, d2 = float(data[0]), float(data[1]), float(data[2])
+
+        # Edge values of extreme sensors wrt to center sensor, as in get_direction_numpy
+        edge0 = d1 - d0
+        edge1 = d1 - d2
+        val0, val1 = abs(edge0), abs(edge1)
+        sign0 = (edge0 > 0) - (edge0 < 0)
+        sign1 = (edge1 > 0) - (edge1 < 0)
+        l_th, h_th, polarity = self.l_th, self.h_th, self.polarity
+
+        # Same rules as get_direction_numpy
+        if val0 >= h_th and val1 >= h_th and sign0 == sign1 == polarity:
+            direction = 0.0
+        elif val0 <= l_th and val1 >= l_th and sign1 == polarity:
+            direction = -0.5
+        elif val0 >= h_th and val1 <= l_th and sign0 == -polarity:
+            direction = -1.0
+        elif val0 >= l_th and val1 <= l_th and sign0 == polarity:
+            direction = 0.5
+        elif val0 <= l_th and val1 >= h_th and sign1 == -polarity:
+            direction = 1.0
+        else:
+            direction = self.prev_direction
+
+        # Update the previous direction
+        self.prev_direction = direction
+
+        return direction
+
+    def get_directions(self, data):
+        """Function to get the directions for a batch of sensor data, an (N, 3) array, in one vectorized call
+
+        Gives the same directions as calling get_direction on each row in turn, carrying on from (and updating)
+        the previous direction
+        """
+
+        directions = directions_from_data(data, self.l_th, self.h_th, self.polarity, self.prev_direction)
+        if len(directions):
+            self.prev_direction = float(directions[-1])
+
+        return directions
+
+    def get_direction_numpy(self, data=None):
+        """Function to get direction and degree of turn based on sensor data, with numpy
+
+        The reference for get_direction, which it is used for when data is a numpy array of another dtype than float64
+        """
 
         # Get the sensor data
         if data is None:
@@ -140,23 +277,58 @@ class Interpret(object):
 
 
 class SenseUltra(object):
-    """Class to get sensor data from Ultrasonic module on PiCar-X"""
+    """Class to get sensor data from Ultrasonic module on PiCar-X
+
+    Args:
+        rate: If given, range in the background at this rate (pings per second), and serve every
+            read from the latest filtered distance instead of waiting on the sensor
+    """
 
     ULTRASONIC_PINS = ['D2', 'D3']
 
-    def __init__(self):
+    def __init__(self, rate:float=None):
         tring_pin, echo_pin = self.ULTRASONIC_PINS
         self.sensor = Ultrasonic(Pin(tring_pin), Pin(echo_pin))
         time.sleep(0.5)
 
+        self.engine = None
+        if rate is not None:
+            self.start_engine(rate)
+
+    def start_engine(self, rate:float=20.0):
+        """Function to start ranging in the background, so that reads never wait on the sensor"""
+
+        if self.engine is None:
+            self.engine = UltrasonicEngine(self.sensor.trig, self.sensor.echo, rate=rate, name="Ultrasonic engine")
+        self.engine.start()
+
+        return self.engine
+
+    def stop_engine(self):
+        """Function to stop ranging in the background, after which the sensor is read on every call again"""
+
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine = None
+
     def get_ultrasonic_data(self):
         """Function to get the distance from the ultrasonic sensor"""
 
         # Read the data
-        distance = self.sensor.read()
+        if self.engine is not None:
+            distance = self.engine.read()
+        else:
+            distance = self.sensor.read()
 
         return distance
 
+    def read_ultrasonic_into(self, out:np.ndarray):
+        """Function to get the distance into a preallocated scalar array, such as the back buffer of an rr.ArrayBus"""
+
+        out[...] = self.get_ultrasonic_data()
+
+        return out
+
     def producer(self, sensor_bus:Bus, delay:float=0.1):
         """Function to write data to bus"""
 
@@ -169,14 +341,19 @@ class SenseUltra(object):
 
 
 class InterpretUltra(object):
-    """Class to interpret sensor data from Ultrasonic module on PiCar-X"""
+    """Class to interpret sensor data from Ultrasonic module on PiCar-X
+
+    Args:
+        threshold: Distance in cm below which an obstacle is detected
+        rate: If given, range in the background at this rate (see SenseUltra)
+    """
 
-    def __init__(self, threshold:float=10.0):
+    def __init__(self, threshold:float=10.0, rate:float=None):
 
         self.threshold = threshold
 
         # Intialize the sensing module
-        self.sensor = SenseUltra()
+        self.sensor = SenseUltra(rate=rate)
 
     def get_obstacle(self, data=None):
         """Function to get if obstacle is detected based on sensor data"""
@@ -8,6 +8,8 @@ import math
 import os
 from time import sleep
 
+from adc_batch import ADCGroup
+
 timer = [
     {
         "arr": 0
@@ -80,6 +82,7 @@ class Pin(_Basic_class):
     PULL_NONE = "PULL_NONE"
 
     def __init__(self, *value):
+        super().__init__()
         self._pin = None
         self._mode = None
         self._pull = None
@@ -196,30 +199,39 @@ def _retry_wrapper(func):
             return False
     return wrapper
 
-#Made using ChatGPT
+#Made using ChatGPT, counts its bus transactions so that batched reads can be measured
 class DummySMBus:
+    def __init__(self):
+        self.transactions = 0
+
     def write_byte(self, addr, data):
         #print(f"DummySMBus: Write byte - Address: 0x{addr:02X}, Data: 0x{data:02X}")
+        self.transactions += 1
         return 0  # Return value for simulation
 
     def write_byte_data(self, addr, reg, data):
         #print(f"DummySMBus: Write byte data - Address: 0x{addr:02X}, Register: 0x{reg:02X}, Data: 0x{data:02X}")
+        self.transactions += 1
         return 0  # Return value for simulation
 
     def write_word_data(self, addr, reg, data):
         #print(f"DummySMBus: Write word data - Address: 0x{addr:02X}, Register: 0x{reg:02X}, Data: 0x{data:04X}")
+        self.transactions += 1
         return 0  # Return value for simulation
 
     def write_i2c_block_data(self, addr, reg, data):
         #print(f"DummySMBus: Write i2c block data - Address: 0x{addr:02X}, Register: 0x{reg:02X}, Data: {data}")
+        self.transactions += 1
         return 0  # Return value for simulation
 
     def read_byte(self, addr):
         #print(f"DummySMBus: Read byte - Address: 0x{addr:02X}")
+        self.transactions += 1
         return 0xFF  # Return value for simulation
 
     def read_i2c_block_data(self, addr, reg, num):
         #print(f"DummySMBus: Read i2c block data - Address: 0x{addr:02X}, Register: 0x{reg:02X}, Num: {num}")
+        self.transactions += 1
         return [0xFF] * num  # Return value for simulation
 
 #Modified slightly to use the ChatGPT-generated DummySMBus class
@@ -626,6 +638,9 @@ class Grayscale_Module(object):
             self.chn_1 = ADC('A1')
             self.chn_2 = ADC('A2')
 
+        # Read the three channels together on one bus handle
+        self.adc_group = ADCGroup([self.chn_0, self.chn_1, self.chn_2])
+
         if reference is None:
             self.reference = self.REFERENCE_DEFAULT
         else:
@@ -654,11 +669,7 @@ class Grayscale_Module(object):
             return 'left'
 
     def get_grayscale_data(self):
-        adc_value_list = []
-        adc_value_list.append(self.chn_0.read())
-        adc_value_list.append(self.chn_1.read())
-        adc_value_list.append(self.chn_2.read())
-        return adc_value_list
+        return self.adc_group.read()
 
     def read(self):
         return self.get_grayscale_data()
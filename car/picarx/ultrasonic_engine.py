@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+"""
+Ultrasonic ranging in the background.
+
+Ultrasonic.read() triggers a ping and busy-waits on the echo pin, timing it with time.time(),
+and retries up to ten times when no echo comes back within the 20 ms timeout, so one call can
+block its caller for around 300 ms. An UltrasonicEngine pings from its own daemon thread instead,
+at a fixed rate and against fixed deadlines, and keeps the filtered distance in a slot that
+callers read without waiting on the sensor.
+
+Each ping is a single attempt: the echo edges are timestamped with time.perf_counter_ns(), and a
+ping without an echo within the timeout counts as a miss rather than being retried. The thread
+still polls the echo pin while a ping is out, but only for that ping, and sleeps in between.
+That polling keeps one core busy for the round trip of each ping: about 0.6 ms plus 58 us per
+cm of distance, and the whole timeout for a miss. At 20 pings per second with the 20 ms timeout,
+that is around 7% of a core for an obstacle at 50 cm and up to 40% when nothing echoes, so keep
+the rate no higher than the control loop needs. The thread holds on to the GIL while it polls,
+rather than yielding it on every poll: with a CPU-bound thread running, getting the GIL back can
+take a whole switch interval (5 ms by default), by which time a short echo has come and gone.
+GPIO edge callbacks would spare the polling, but robot_hat debounces them (200 ms by default,
+and at least 1 ms), which drops the falling edge of echoes from anything closer than about 17 cm,
+just where obstacles matter most.
+
+Polling from a thread still means the interpreter can hand the GIL to another thread in the
+middle of a ping. A rising edge timestamped late gives a distance that is too short, a falling
+edge timestamped late one that is too long, and an echo that is over before the thread gets the
+GIL back is missed. The published distance is therefore the median
+of the last `window` valid pings, leaving out pings further from that median than
+`outlier_factor` times the median absolute deviation (scaled to a standard deviation), which
+drops these and other single spikes. When every ping in the window has missed, the distance is
+-1, as Ultrasonic.read() returns.
+
+The slot is a single (sequence, timestamp, distance) tuple that only the engine thread replaces,
+with one attribute assignment, which is atomic in CPython, so readers take no lock and a read is
+bounded by an attribute lookup. The timestamp is the time.monotonic() time of the latest ping.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+
+# Speed of sound in cm per ns, halved for the way there and back, as Ultrasonic.read() uses
+CM_PER_NS = 340 * 100 / 2 / 1e9
+
+
+class UltrasonicEngine(object):
+    """Class to range with the ultrasonic sensor in the background and keep the filtered distance
+
+    Args:
+        trig: Trigger pin (such as Ultrasonic.trig)
+        echo: Echo pin (such as Ultrasonic.echo)
+        rate: Pings per second
+        window: Number of latest pings the median is taken over
+        outlier_factor: Pings further than this many scaled median absolute deviations from the median are left out
+        timeout: Seconds to wait for the echo of a ping before counting it as a miss
+        name: Name used in the log
+    """
+
+    def __init__(self, trig, echo, rate:float=20.0, window:int=5, outlier_factor:float=3.0,
+                 timeout:float=0.02, name:str="Ultrasonic engine"):
+
+        if rate <= 0:
+            raise ValueError("Ranging rate should be positive, not {0}".format(rate))
+        if timeout >= 1.0 / rate:
+            raise ValueError("Echo timeout of {0} s does not fit the period of {1} s".format(timeout, 1.0 / rate))
+
+        self.trig = trig
+        self.echo = echo
+        self.period = 1.0 / rate
+        self.outlier_factor = outlier_factor
+        self.timeout_ns = int(timeout * 1e9)
+        self.name = name
+
+        # Distances of the latest pings, None for a miss
+        self.pings = collections.deque(maxlen=window)
+
+        # (sequence, timestamp, distance) of the latest filtered distance, None until the first ping
+        self.slot = None
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.ping_count = 0
+        self.misses = 0
+        self.outliers = 0  # pings left out of the median as outliers when they came in
+        self.overruns = 0  # ranging deadlines missed
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def ping(self):
+        """Send one ping and time its echo, returning the distance in cm, or None if no echo came back"""
+
+        self.trig.high()
+        time.sleep(0.00001)
+        self.trig.low()
+
+        t_trigger = time.perf_counter_ns()
+        t_deadline = t_trigger + self.timeout_ns
+
+        # Rising edge of the echo. Polled without yielding, since a thread that gives up the GIL
+        # can wait a whole switch interval to get it back and miss the echo altogether
+        t_rise = t_trigger
+        while self.echo.value() == 0:
+            t_rise = time.perf_counter_ns()
+            if t_rise > t_deadline:
+                return None
+
+        # Falling edge of the echo
+        t_fall = t_rise
+        while self.echo.value() == 1:
+            t_fall = time.perf_counter_ns()
+            if t_fall > t_deadline:
+                return None
+
+        return round((t_fall - t_rise) * CM_PER_NS, 2)
+
+    def filtered(self):
+        """
+        Median of the valid pings in the window, leaving out outliers, or -1 if every ping missed.
+        Counts the latest ping in outliers if it was left out
+        """
+
+        distances = np.array([d for d in self.pings if d is not None])
+        if len(distances) == 0:
+            return -1
+
+        median = np.median(distances)
+        deviation = np.abs(distances - median)
+        # The median absolute deviation, scaled to match the standard deviation of normal noise
+        mad = 1.4826 * np.median(deviation)
+        if mad > 0:
+            inliers = deviation <= self.outlier_factor * mad
+            if self.pings[-1] is not None and not inliers[-1]:
+                self.outliers += 1
+            median = np.median(distances[inliers])
+
+        return round(float(median), 2)
+
+    def update(self):
+        """Range once and publish the filtered distance"""
+
+        distance = self.ping()
+        self.ping_count += 1
+        if distance is None:
+            self.misses += 1
+        self.pings.append(distance)
+
+        sequence = self.slot[0] + 1 if self.slot is not None else 1
+        self.slot = (sequence, time.monotonic(), self.filtered())
+
+    def run(self):
+
+        t_next = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                self.update()
+            except OSError as error:
+                # A glitch on the GPIO should not stop the ranging
+                logging.warning("{0}: ping failed: {1}".format(self.name, error))
+
+            t_next += self.period
+            now = time.monotonic()
+            if now > t_next:
+                # Skip the deadlines that have already passed rather than pinging in a burst to catch up
+                missed = int((now - t_next) / self.period) + 1
+                self.overruns += missed
+                t_next += missed * self.period
+
+            self.stop_event.wait(t_next - now)
+
+    def start(self):
+        """Range once, so that the slot is filled as soon as this returns, and start ranging"""
+
+        if self.running:
+            return self
+
+        self.trig.low()
+        self.update()
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        """Stop ranging, and wait for the engine thread to finish"""
+
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def latest(self):
+        """Function to get the latest distance as a (sequence, timestamp, distance) tuple, without waiting on the sensor"""
+
+        slot = self.slot
+        if slot is None:
+            raise RuntimeError("{0}: no distance yet, start the engine first".format(self.name))
+
+        return slot
+
+    def read(self):
+        """Function to get the latest filtered distance in cm, -1 if nothing was detected, like Ultrasonic.read"""
+
+        return self.latest()[2]
+
+
+if __name__ == "__main__":
+
+    import random
+
+    # Caller latency of Ultrasonic.read() and of reading an engine, with a simulated sensor that
+    # echoes from an obstacle at 42 cm, with a little noise, an occasional spike and some pings
+    # that never come back
+    logging.getLogger().setLevel(logging.WARNING)
+
+    class SimulatedTrig(object):
+
+        def __init__(self):
+            self.t_ping = None
+
+        def high(self):
+            pass
+
+        def low(self):
+            self.t_ping = time.perf_counter()
+            r = random.random()
+            self.distance = None if r < 0.1 else 150.0 if r < 0.15 else random.gauss(42.0, 0.5)
+
+    class SimulatedEcho(object):
+
+        def __init__(self, trig):
+            self.trig = trig
+
+        def value(self):
+            if self.trig.t_ping is None or self.trig.distance is None:
+                return 0
+            t = time.perf_counter() - self.trig.t_ping
+            t_rise = 0.0005
+            return 1 if t_rise <= t < t_rise + self.trig.distance / (340 * 100 / 2) else 0
+
+    def latency(read, calls):
+        times = []
+        for _ in range(calls):
+            t_start = time.perf_counter()
+            read()
+            times.append(time.perf_counter() - t_start)
+        return np.mean(times), np.max(times)
+
+    from sim_robot_hat import Ultrasonic
+
+    trig = SimulatedTrig()
+    echo = SimulatedEcho(trig)
+
+    print("{0:<22}{1:>16}{2:>16}".format("caller", "mean latency", "max latency"))
+    sensor = Ultrasonic(trig, echo)
+    mean, worst = latency(sensor.read, 50)
+    print("{0:<22}{1:>13.3f} ms{2:>13.3f} ms".format("Ultrasonic.read()", mean * 1000, worst * 1000))
+
+    with UltrasonicEngine(trig, echo, rate=20) as engine:
+        mean, worst = latency(engine.read, 10000)
+        time.sleep(2)
+    print("{0:<22}{1:>13.4f} ms{2:>13.4f} ms".format("UltrasonicEngine.read()", mean * 1000, worst * 1000))
+    print("Engine: {0} pings, {1} missed, {2} outliers dropped, {3} overruns, distance {4} cm".format(
+        engine.ping_count, engine.misses, engine.outliers, engine.overruns, engine.read()))